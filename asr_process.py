@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""The audio server and the ASR in a process of their own.
+
+In one process, the Flask-SocketIO web tier and the Python side of the
+online processing (receiving, decoding, hypothesis agreement, layout)
+compete for the GIL. ASRProcess runs the audio server in a forked process,
+and its caption updates come to the web process over a multiprocessing
+queue. The web process only fans them out to the overlays, so it can run
+on an async worker (eventlet or gevent).
+"""
+
+import atexit
+import logging
+import multiprocessing
+import queue
+import signal
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+def add_asr_process_args(parser):
+    """options of the separate ASR process of the webserver
+    parser: argparse.ArgumentParser object
+    """
+    parser.add_argument("--asr-process", action="store_true", default=False, dest="asr_process",
+            help="Run the audio server and the ASR in a separate process. The web process only sends the captions to the overlays.")
+    parser.add_argument("--web-async-mode", type=str, default=None, choices=["threading", "eventlet", "gevent"], dest="web_async_mode",
+            help="The async mode of the Socket.IO web server. eventlet and gevent require --asr-process and the package of the mode. Default is the first one installed.")
+
+
+def _process_main(run, updates, stop):
+    # runs in the ASR process
+    def send(key, message):
+        updates.put((key, message))
+
+    # Ctrl-C stops the web process, this one ends with it
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    thread = threading.Thread(target=run, args=(send,), name="asr-process", daemon=True)
+    thread.start()
+    parent = multiprocessing.parent_process()
+    while thread.is_alive() and parent.is_alive() and not stop.is_set():
+        thread.join(0.5)
+    if thread.is_alive():
+        logger.info("The web process ended, the ASR process ends.")
+    # the updates that the web process didn't take are dropped
+    updates.cancel_join_thread()
+    # multiprocessing runs the finalizers of this process at its exit, e.g. closing the file of --record-asr
+
+
+class ASRProcess:
+    '''Runs run(send) in a forked process. send(key, message) sends a caption update to this process,
+    the updates are taken by receive().
+
+    It is forked, as the inference workers: the webserver runs its setup at the module level.
+    Start it before any other threads. It is not a daemon process, so it can start the inference workers.
+    '''
+
+    def __init__(self, run):
+        ctx = multiprocessing.get_context("fork")
+        self.updates = ctx.Queue()
+        self.stop = ctx.Event()
+        self.process = ctx.Process(target=_process_main, args=(run, self.updates, self.stop), name="asr-process")
+        self.process.start()
+        # before multiprocessing joins the process at exit
+        atexit.register(self.close)
+        logger.info(f"Started the ASR process {self.process.pid}")
+
+    def receive(self, limit=100):
+        """up to limit waiting updates as (key, message), without blocking"""
+        updates = []
+        try:
+            while len(updates) < limit:
+                updates.append(self.updates.get_nowait())
+        except queue.Empty:
+            pass
+        return updates
+
+    def is_alive(self):
+        return self.process.is_alive()
+
+    def close(self):
+        self.stop.set()
+        self.process.join(5)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+"""asyncio audio server.
+
+SessionManager.serve runs one thread per client, which blocks on the socket.
+AsyncAudioServer serves all the clients on one event loop instead: every
+connection is a task that reads the audio with a StreamReader, so idle and
+waiting connections cost only a few kilobytes. The online processing runs in
+an executor, one job at a time per session, while the connection keeps
+reading. The results are sent back to the client in the line protocol (see
+line_packet.py), and they are passed to an optional publisher, e.g. the
+Socket.IO overlay of the webserver.
+"""
+
+import asyncio
+import collections
+import concurrent.futures
+import logging
+import sys
+import time
+
+import numpy as np
+
+from audio_ingest import HEADER_TIMEOUT, PCMDecoder, SAMPLING_RATE, parse_stream_header
+from metrics import DROPPED_SECONDS, observe_iteration, stage
+
+logger = logging.getLogger(__name__)
+
+
+def add_async_server_args(parser):
+    """options of the asyncio server, shared by the servers
+    parser: argparse.ArgumentParser object
+    """
+    parser.add_argument("--async-server", action="store_true", default=False, dest="async_server",
+            help="Serve the audio clients on one asyncio event loop, see async_server.py, instead of one thread per client.")
+
+
+class _AudioQueue:
+    '''The audio received from one connection and not processed yet, with the backlog policy of AudioReceiver.'''
+
+    def __init__(self, max_backlog, policy):
+        self.max_backlog = int(max_backlog*SAMPLING_RATE)
+        self.policy = policy
+        self.chunks = collections.deque()  # (receive time, samples)
+        self.backlog = 0
+        self.dropped = 0
+        self.closed = False
+        self.cond = asyncio.Condition()
+
+    async def put(self, audio):
+        async with self.cond:
+            if self.policy == "block":
+                # the connection is not read meanwhile, TCP slows down the client
+                await self.cond.wait_for(lambda: self.backlog < self.max_backlog or self.closed)
+            self.chunks.append((time.monotonic(), audio))
+            self.backlog += len(audio)
+            while self.policy == "drop" and self.backlog > self.max_backlog and len(self.chunks) > 1:
+                _, a = self.chunks.popleft()
+                self.backlog -= len(a)
+                self.dropped += len(a)
+            self.cond.notify_all()
+
+    async def close(self):
+        async with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    async def get(self, min_samples, partial=True):
+        """the same as AudioReceiver.get"""
+        async with self.cond:
+            await self.cond.wait_for(lambda: self.backlog >= min(min_samples, self.max_backlog) or self.closed)
+            dropped, self.dropped = self.dropped, 0
+            if self.backlog == 0 or (not partial and self.backlog < min_samples):
+                return None, dropped
+            oldest = self.chunks[0][0]
+            chunks = [a for _, a in self.chunks]
+            self.chunks.clear()
+            self.backlog = 0
+            self.cond.notify_all()
+        if dropped:
+            DROPPED_SECONDS.inc(dropped/SAMPLING_RATE)
+            logger.warning(f"audio backlog over {self.max_backlog/SAMPLING_RATE:.1f} s, dropped {dropped/SAMPLING_RATE:.2f} s of the oldest audio")
+        logger.debug(f"took {sum(map(len, chunks))/SAMPLING_RATE:.2f} s of audio from {len(chunks)} chunks, the oldest waited {time.monotonic()-oldest:.2f} s")
+        return np.concatenate(chunks) if len(chunks) > 1 else chunks[0], dropped
+
+
+class _StreamState:
+    '''The processing state of one connection, used by one executor job at a time.'''
+
+    def __init__(self, session, chunk_controller, publish, queue):
+        self.session = session
+        self.queue = queue
+        self.chunk_controller = chunk_controller
+        self.publish = publish
+        self.stream_samples = 0  # the samples received (or dropped) so far
+        self.last_end = None
+        self.last_line = ""
+
+
+class AsyncAudioServer:
+    '''Serves the audio clients of a SessionManager on one asyncio event loop.
+
+    Each client sends 16 kHz mono S16LE audio, and gets back the committed transcript
+    in lines "beg end text" with the timestamps in milliseconds, as from whisper_online_server.py.
+    '''
+
+    def __init__(self, sessions, min_chunk, max_backlog=10.0, backlog_policy="drop",
+                 create_chunk_controller=None, create_publisher=None, executor=None):
+        """sessions: SessionManager, it creates the online processors and limits their number.
+        min_chunk: the minimum audio in seconds for one process_iter.
+        max_backlog, backlog_policy: see audio_ingest.add_ingest_args.
+        create_chunk_controller: optional callable without arguments, returns an AdaptiveChunkController or None for a new session.
+        create_publisher: optional callable(session), returns a callable(o) that publishes the results of process_iter
+            of the session elsewhere. It is called in the executor.
+        executor: runs the online processing. Default is a thread pool with a thread for every session.
+        """
+        self.sessions = sessions
+        self.min_chunk = min_chunk
+        self.max_backlog = max_backlog
+        self.backlog_policy = backlog_policy
+        self.create_chunk_controller = create_chunk_controller
+        self.create_publisher = create_publisher
+        self.executor = executor or concurrent.futures.ThreadPoolExecutor(sessions.max_sessions, thread_name_prefix="online")
+
+    def serve(self, host, ports):
+        """runs the server forever, ports: a port or a list of ports"""
+        asyncio.run(self._serve(host, [ports] if isinstance(ports, int) else list(ports)))
+
+    async def _serve(self, host, ports):
+        # bound to the event loop of this run
+        self._slots = asyncio.Semaphore(self.sessions.max_sessions)
+        servers = [await asyncio.start_server(self._handle, host, port) for port in ports]
+        logger.info(f"Listening on {host} ports {', '.join(map(str, ports))} (asyncio), serving up to {self.sessions.max_sessions} concurrent clients")
+        try:
+            await asyncio.gather(*(server.serve_forever() for server in servers))
+        finally:
+            for server in servers:
+                server.close()
+
+    async def _read_header(self, reader):
+        # the optional stream header line, see audio_ingest.parse_stream_header; returns (name, the first audio bytes)
+        data = await reader.read(65536)
+        while True:
+            name, rest = parse_stream_header(data)
+            if rest is not None:
+                return name, rest
+            # a part of the header line, the rest is on the way
+            more = await asyncio.wait_for(reader.read(65536), HEADER_TIMEOUT)
+            if not more:
+                return None, data
+            data += more
+
+    async def _open_session(self, addr):
+        # the connections over max_sessions wait here in FIFO order, without a thread or polling
+        await self._slots.acquire()
+        loop = asyncio.get_running_loop()
+        try:
+            if not self.sessions.reserve_slot(blocking=False):
+                # the slot is held by a session of another server over the same SessionManager
+                await loop.run_in_executor(None, self.sessions.reserve_slot)
+            # creating the online processor may take a while, e.g. loading the VAD model
+            return await loop.run_in_executor(None, self.sessions.open_reserved, addr)
+        except:
+            self._slots.release()
+            raise
+
+    async def _handle(self, reader, writer):
+        addr = writer.get_extra_info("peername")
+        logger.info(f"Connected to client on {addr}")
+        session = None
+        try:
+            session = await self._open_session(addr)
+            name, data = await self._read_header(reader)
+            session.set_stream(name if name is not None else str(writer.get_extra_info("sockname")[1]))
+            logger.info(f"{session} streams")
+            session.online.init()
+            queue = _AudioQueue(self.max_backlog, self.backlog_policy)
+            state = _StreamState(session,
+                    self.create_chunk_controller() if self.create_chunk_controller else None,
+                    self.create_publisher(session) if self.create_publisher else None,
+                    queue)
+            receiving = asyncio.create_task(self._receive(reader, queue, data))
+            try:
+                await self._process(state, queue, writer)
+            finally:
+                receiving.cancel()
+        except (ConnectionError, asyncio.IncompleteReadError) as e:
+            logger.info(f"connection {addr}: {e}")
+        except Exception as e:
+            logger.error(f"Error processing connection {addr}: {e}")
+        finally:
+            writer.close()
+            if session is not None:
+                self.sessions.close_session(session)
+                self._slots.release()
+            logger.info(f"Connection to client {addr} closed")
+
+    async def _receive(self, reader, queue, data=b""):
+        # data: the audio received with the header
+        decoder = PCMDecoder()
+        try:
+            while True:
+                if not data:
+                    data = await reader.read(65536)
+                    if not data:
+                        break
+                with stage("decode"):
+                    decoder.feed(data)
+                    audio = decoder.take().copy() if len(decoder) else None
+                data = None
+                if audio is not None:
+                    await queue.put(audio)
+        except ConnectionError as e:
+            logger.debug(f"audio receiving ended: {e}")
+        finally:
+            await queue.close()
+
+    async def _process(self, state, queue, writer):
+        loop = asyncio.get_running_loop()
+        is_first = True
+        while True:
+            chunk = self.min_chunk if state.chunk_controller is None else state.chunk_controller.chunk_size
+            with stage("recv_wait"):
+                audio, dropped = await queue.get(int(chunk*SAMPLING_RATE), partial=not is_first)
+            if audio is None:
+                break
+            is_first = False
+            o = await loop.run_in_executor(self.executor, self._process_chunk, state, audio, dropped)
+            line = self._format_line(state, o)
+            if line is not None and line != state.last_line:
+                with stage("send"):
+                    writer.write(line.encode("utf-8", errors="replace") + b"\n")
+                    await writer.drain()
+                state.last_line = line
+
+    def _process_chunk(self, state, audio, dropped):
+        # runs in the executor
+        online = state.session.online
+        if dropped:
+            # the transcription continues after the gap, with the right timestamps
+            state.stream_samples += dropped
+            logger.warning(f"{state.session}: skipped {dropped/SAMPLING_RATE:.2f} seconds of audio, restarting the transcription at {state.stream_samples/SAMPLING_RATE:.2f}")
+            online.init(offset=state.stream_samples/SAMPLING_RATE)
+        state.stream_samples += len(audio)
+        online.insert_audio_chunk(audio)
+        t = time.time()
+        o = online.process_iter()
+        elapsed = time.time() - t
+        if state.chunk_controller is not None:
+            state.chunk_controller.update(elapsed, len(audio)/SAMPLING_RATE)
+        observe_iteration(state.session.id, elapsed, len(audio)/SAMPLING_RATE, state.queue.backlog/SAMPLING_RATE, online.buffer_seconds())
+        if state.publish is not None:
+            try:
+                state.publish(o)
+            except Exception as e:
+                logger.error(f"Error publishing result: {e}")
+        return o
+
+    def _format_line(self, state, o):
+        # the same as ServerProcessor.format_output_transcript: the succeeding [beg,end] intervals don't overlap
+        if o[0] is None:
+            return None
+        beg, end = o[0]*1000, o[1]*1000
+        if state.last_end is not None:
+            beg = max(beg, state.last_end)
+        state.last_end = end
+        line = "%1.0f %1.0f %s" % (beg, end, o[2])
+        print(line, flush=True, file=sys.stderr)
+        return line
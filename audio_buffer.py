@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""Growable audio buffer for the streaming processors.
+
+The streaming processors append small chunks of audio (e.g. 40 ms with VAC)
+to a buffer of up to 30 seconds, and trim its beginning from time to time.
+With np.append, every insert copies the whole buffer. AudioBuffer keeps the
+samples in a preallocated array instead: appending is amortized O(1),
+trimming the beginning only moves the start index, and the content is
+always available as one contiguous array view.
+"""
+
+import numpy as np
+
+
+class AudioBuffer:
+    '''A float32 sample buffer. The samples are stored in self._data[self._start:self._end].
+
+    The arrays returned by view() and by indexing are views into the buffer storage, they are valid until
+    the next append, which may move the samples. Copy them if they are needed later.
+    '''
+
+    def __init__(self, capacity=16000, dtype=np.float32):
+        self._data = np.empty(max(1, capacity), dtype=dtype)
+        self._start = 0
+        self._end = 0
+
+    def __len__(self):
+        return self._end - self._start
+
+    def view(self):
+        """the content as a contiguous array, without copying"""
+        return self._data[self._start:self._end]
+
+    def __array__(self, dtype=None, copy=None):
+        a = self.view()
+        if dtype is not None and dtype != a.dtype:
+            return a.astype(dtype)
+        if copy:
+            return a.copy()
+        return a
+
+    def __getitem__(self, key):
+        return self.view()[key]
+
+    def append(self, audio):
+        audio = np.asarray(audio).reshape(-1)
+        n = len(audio)
+        if n == 0:
+            return
+        if self._end + n > len(self._data):
+            self._make_room(n)
+        self._data[self._end:self._end + n] = audio
+        self._end += n
+
+    def append_empty(self, n):
+        """appends n uninitialized samples and returns them as a writable view, to be filled in place"""
+        if self._end + n > len(self._data):
+            self._make_room(n)
+        self._end += n
+        return self._data[self._end - n:self._end]
+
+    def _make_room(self, n):
+        size = len(self)
+        capacity = len(self._data)
+        if size + n <= capacity // 2:
+            # enough free space at the beginning, move the content there
+            self._data[:size] = self._data[self._start:self._end]
+        else:
+            data = np.empty(max(2 * capacity, size + n), dtype=self._data.dtype)
+            data[:size] = self._data[self._start:self._end]
+            self._data = data
+        self._start = 0
+        self._end = size
+
+    def trim(self, n):
+        """drops the first n samples"""
+        n = min(max(0, int(n)), len(self))
+        self._start += n
+        if self._start == self._end:
+            self._start = self._end = 0
+
+    def keep_last(self, n):
+        """drops all but the last n samples"""
+        self.trim(len(self) - max(0, int(n)))
+
+    def clear(self):
+        self._start = self._end = 0
@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+"""Ingest of the raw audio that the clients send to the servers.
+
+The clients send 16 kHz mono S16LE PCM, e.g.
+arecord -f S16_LE -c1 -r 16000 -t raw -D default | nc <host> 43007
+and recv() may split it at any byte, also in the middle of a sample.
+
+Before the audio, a client may name its stream with one text line
+"STREAM <name>\n", e.g. (echo "STREAM studio-a"; arecord ...) | nc <host> 43007
+The webserver sends the captions of the stream only to the overlays of that
+stream. Without the line, the stream is named by the listening port.
+
+AudioReceiver reads the socket in its own thread, so the audio doesn't pile up
+in the kernel buffers while the model transcribes, and the backlog is bounded.
+"""
+
+import collections
+import logging
+import re
+import threading
+import time
+
+import numpy as np
+
+from audio_buffer import AudioBuffer
+from metrics import DROPPED_SECONDS, stage
+
+logger = logging.getLogger(__name__)
+
+SAMPLING_RATE = 16000
+
+STREAM_HEADER = b"STREAM "
+MAX_HEADER = 128  # bytes of the whole header line
+HEADER_TIMEOUT = 5.0  # seconds to wait for the rest of a started header line
+STREAM_NAME = re.compile(r"[A-Za-z0-9_.-]{1,64}")
+
+
+def add_ingest_args(parser):
+    """options of the audio receiving, shared by the servers
+    parser: argparse.ArgumentParser object
+    """
+    parser.add_argument("--max-backlog", type=float, default=10.0, dest="max_backlog",
+            help="Maximum seconds of received audio that wait for processing. When the model is slower than real time, the backlog is handled by --backlog-policy.")
+    parser.add_argument("--backlog-policy", type=str, default="drop", choices=["drop", "block"], dest="backlog_policy",
+            help="drop: drop the oldest waiting audio and restart the transcription after the gap, so the latency stays bounded. "
+                 "block: stop reading from the client until the backlog decreases.")
+
+
+def parse_stream_header(data):
+    """Parses the optional header line "STREAM <name>\\n" at the start of the received bytes.
+    Returns (name, rest): the stream name and the bytes after the line, or (None, data) if data doesn't
+    start with a valid header, i.e. it is the audio. Returns (None, None) if data is too short to tell.
+    """
+    data = bytes(data)
+    if not data.startswith(STREAM_HEADER):
+        if len(data) < len(STREAM_HEADER) and STREAM_HEADER.startswith(data):
+            return None, None
+        return None, data
+    end = data.find(b"\n", 0, MAX_HEADER)
+    if end < 0:
+        return (None, None) if len(data) < MAX_HEADER else (None, data)
+    name = data[len(STREAM_HEADER):end].decode("ascii", errors="replace").strip()
+    if not STREAM_NAME.fullmatch(name):
+        logger.warning(f"invalid stream name {name!r}, the header is ignored")
+        name = None
+    return name, data[end+1:]
+
+
+def receive_stream_header(conn, timeout=HEADER_TIMEOUT):
+    """Reads the optional header line of a connected socket, see parse_stream_header.
+    Returns (name, rest): the stream name or None, and the first audio bytes received with the header.
+    A client that stops in the middle of the header for timeout seconds raises TimeoutError,
+    a client that closes the connection there sends no header.
+    """
+    data = b""
+    try:
+        while True:
+            more = conn.recv(MAX_HEADER - len(data))
+            data += more
+            name, rest = parse_stream_header(data)
+            if rest is not None:
+                return name, rest
+            if not more:
+                return None, data
+            # a part of the header line, the rest is on the way
+            conn.settimeout(timeout)
+    finally:
+        conn.settimeout(None)
+
+
+class PCMDecoder:
+    '''Decodes S16LE bytes straight into float32 samples (scaled to [-1, 1) as soundfile does),
+    collected in a preallocated chunk buffer until they are taken.
+
+    An odd byte at the end of a packet is kept and completed by the first byte of the next packet.
+    total_samples counts all the decoded samples of the stream.
+    '''
+
+    SCALE = np.float32(1 / 32768)
+
+    def __init__(self, capacity=16000):
+        self._chunk = AudioBuffer(capacity)
+        self._odd_byte = None
+        self.total_samples = 0
+
+    def __len__(self):
+        """number of samples decoded since the last take()"""
+        return len(self._chunk)
+
+    def feed(self, data):
+        """decodes a bytes-like object of any length"""
+        data = memoryview(data).cast("B")
+        if not data:
+            return
+        first = None
+        if self._odd_byte is not None:
+            first = int.from_bytes(self._odd_byte + bytes(data[:1]), "little", signed=True)
+            data = data[1:]
+            self._odd_byte = None
+        n = len(data) // 2
+        if len(data) % 2:
+            self._odd_byte = bytes(data[-1:])
+
+        out = self._chunk.append_empty(n + (first is not None))
+        if first is not None:
+            out[0] = first * self.SCALE
+            out = out[1:]
+        if n:
+            np.multiply(np.frombuffer(data[:2*n], dtype="<i2"), self.SCALE, out=out, casting="unsafe")
+        self.total_samples += n + (first is not None)
+
+    def take(self):
+        """Returns the decoded samples and starts a new chunk.
+        The returned array is valid until the next feed(), the online processors copy it on insert.
+        """
+        audio = self._chunk.view()
+        self._chunk.clear()
+        return audio
+
+    def reset(self):
+        self._chunk.clear()
+        self._odd_byte = None
+        self.total_samples = 0
+
+
+class AudioReceiver:
+    '''Reads the audio of one client in its own thread, into a bounded queue of timestamped chunks.
+
+    recv: callable that blocks until some bytes are received, and returns them, or an empty/None value 
+        when the connection is closed. The returned bytes are decoded before the next call.
+    The consumer takes the audio with get(). The backlog is the audio in the queue. Over max_backlog
+    seconds, the policy "drop" drops the oldest chunks (get() reports how many samples were dropped), 
+    and the policy "block" stops reading until the consumer takes the audio.
+    '''
+
+    def __init__(self, recv, max_backlog=10.0, policy="drop", name="audio-receiver"):
+        if policy not in ("drop", "block"):
+            raise ValueError(f"unknown backlog policy {policy}")
+        self.recv = recv
+        self.max_backlog = int(max_backlog*SAMPLING_RATE)
+        self.policy = policy
+
+        self._decoder = PCMDecoder()
+        self._queue = collections.deque()  # (receive time, samples)
+        self._backlog = 0  # samples in the queue
+        self._dropped = 0  # samples dropped since the last get()
+        self.dropped_total = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    @property
+    def backlog(self):
+        """seconds of audio waiting in the queue"""
+        with self._cond:
+            return self._backlog / SAMPLING_RATE
+
+    def _run(self):
+        try:
+            while True:
+                data = self.recv()
+                if not data:
+                    break
+                with stage("decode"):
+                    self._decoder.feed(data)
+                    # a copy, the decoder reuses its buffer
+                    audio = self._decoder.take().copy() if len(self._decoder) else None
+                if audio is None:
+                    continue
+                with self._cond:
+                    if self.policy == "block":
+                        while self._backlog >= self.max_backlog and not self._closed:
+                            self._cond.wait()
+                    if self._closed:
+                        break
+                    self._queue.append((time.monotonic(), audio))
+                    self._backlog += len(audio)
+                    if self.policy == "drop":
+                        self._drop_over_limit()
+                    self._cond.notify_all()
+        except OSError as e:
+            # the socket is closed under us when the session ends
+            logger.debug(f"audio receiving ended: {e}")
+        finally:
+            with self._cond:
+                self._closed = True
+                self._cond.notify_all()
+
+    def close(self):
+        """Stops the receiving, e.g. when the consumer stops early. The thread ends with the next received data
+        or when the connection is closed, the waiting audio is dropped.
+        """
+        with self._cond:
+            self._closed = True
+            self._queue.clear()
+            self._backlog = 0
+            self._cond.notify_all()
+
+    def _drop_over_limit(self):
+        n = 0
+        while self._backlog > self.max_backlog and len(self._queue) > 1:
+            _, audio = self._queue.popleft()
+            self._backlog -= len(audio)
+            n += len(audio)
+        if n:
+            self._dropped += n
+            self.dropped_total += n
+            logger.debug(f"audio backlog over {self.max_backlog/SAMPLING_RATE:.1f} s, dropped the oldest {n/SAMPLING_RATE:.2f} s")
+
+    def get(self, min_samples, partial=True):
+        """Blocks until min_samples are waiting or the connection is closed, and takes all the waiting audio.
+        partial: if False, less than min_samples are not returned at the end of the stream.
+        Returns a tuple (audio, dropped): audio is a float32 array or None at the end of the stream,
+        dropped is the number of samples dropped right before it.
+        """
+        with self._cond:
+            while self._backlog < min(min_samples, self.max_backlog) and not self._closed:
+                self._cond.wait()
+            if self._backlog == 0 or (not partial and self._backlog < min_samples):
+                return None, self._take_dropped()
+            oldest = self._queue[0][0]
+            chunks = [a for _, a in self._queue]
+            self._queue.clear()
+            self._backlog = 0
+            dropped = self._take_dropped()
+            self._cond.notify_all()
+        if dropped:
+            DROPPED_SECONDS.inc(dropped/SAMPLING_RATE)
+            logger.warning(f"audio backlog over {self.max_backlog/SAMPLING_RATE:.1f} s, dropped {dropped/SAMPLING_RATE:.2f} s of the oldest audio")
+        logger.debug(f"took {sum(map(len, chunks))/SAMPLING_RATE:.2f} s of audio from {len(chunks)} chunks, the oldest waited {time.monotonic()-oldest:.2f} s")
+        return np.concatenate(chunks) if len(chunks) > 1 else chunks[0], dropped
+
+    def _take_dropped(self):
+        dropped, self._dropped = self._dropped, 0
+        return dropped
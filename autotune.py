@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+"""Startup auto-tuning of the faster-whisper configuration.
+
+With --autotune, the server times candidate configurations on this machine
+before it loads the model: compute type, CPU thread count and beam size.
+Each of them runs the online processing over a few seconds of speech
+(the warmup file, or samples/*.wav). The measured time of one process_iter
+gives the smallest chunk size that keeps the real-time factor within the
+budget. The chosen configuration has the smallest chunk size (the lowest
+latency), then the bigger beam (the better transcript), then the faster
+processing.
+
+Only the options left at their defaults are tuned, the ones given on the
+command line are kept. The choice is cached in a JSON file, keyed by the
+hardware, the model and the options that the measurements depend on. The
+next startups on the same machine reuse it without tuning.
+"""
+
+import copy
+import glob
+import json
+import logging
+import os
+import platform
+import time
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+COMPUTE_TYPES = {"cuda": ["float16", "int8_float16"], "cpu": ["int8", "int8_float32"]}
+BEAM_SIZES = [5, 1]
+CHUNK_SIZES = [0.5, 1.0, 2.0, 3.0]
+TUNING_SECONDS = 15
+SAMPLING_RATE = 16000
+TUNED = ("compute_type", "cpu_threads", "beam_size", "min_chunk_size")
+# the other options that change the measurements
+MEASURED_WITH = ("lan", "task", "vac", "vad", "buffer_trimming_sec")
+
+
+def add_autotune_args(parser):
+    """options of the auto-tuning, shared by the servers
+    parser: argparse.ArgumentParser object
+    """
+    parser.add_argument("--autotune", action="store_true", default=False,
+            help="Choose the compute type, CPU threads, beam size and --min-chunk-size of the faster-whisper backend by timing them on this machine, see autotune.py. The choice is cached.")
+    parser.add_argument("--autotune-rtf", type=float, default=0.7, dest="autotune_rtf",
+            help="The real-time factor budget of the auto-tuning: processing time / chunk duration.")
+    parser.add_argument("--autotune-cache", type=str, default=os.path.join(os.path.expanduser("~"), ".cache", "enuri", "autotune.json"), dest="autotune_cache",
+            help="The file of the cached auto-tuning results.")
+
+
+def _cpu_name():
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith("model name"):
+                    return line.split(":", 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor() or platform.machine()
+
+
+def hardware_key(args, device, fixed):
+    """identifies the machine, the model and the options that the measurements depend on.
+    fixed: the tuned options given on the command line, name -> value
+    """
+    import ctranslate2
+    model = args.model_dir or args.model
+    options = [f"{name}:{getattr(args, name, None)}" for name in MEASURED_WITH] + [f"{name}={value}" for name, value in sorted(fixed.items())]
+    return "|".join(str(x) for x in [platform.machine(), _cpu_name(), os.cpu_count(), f"cuda:{ctranslate2.get_cuda_device_count()}",
+                                     device, args.backend, model, f"rtf:{args.autotune_rtf}"] + options)
+
+
+def load_cache(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_cache(path, cache):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(cache, f, indent=1)
+    os.replace(tmp, path)
+
+
+def tuning_audio(args):
+    """up to TUNING_SECONDS of speech: the warmup file, or the samples of the repository"""
+    from whisper_online import load_audio
+    files = []
+    if getattr(args, "warmup_file", None) and os.path.isfile(args.warmup_file):
+        files.append(args.warmup_file)
+    files += sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), "samples", "*.wav")))
+    audio = []
+    n = 0
+    for f in files:
+        a = load_audio(f)
+        audio.append(a)
+        n += len(a)
+        if n >= TUNING_SECONDS*SAMPLING_RATE:
+            break
+    if not audio:
+        raise ValueError("no audio for the auto-tuning, use --warmup-file")
+    return np.concatenate(audio)[:TUNING_SECONDS*SAMPLING_RATE]
+
+
+def iteration_time(asr, audio, args, chunk=1.0):
+    """the average wall time of one process_iter, simulating a stream with chunks of chunk seconds"""
+    from whisper_online import OnlineASRProcessor
+    online = OnlineASRProcessor(asr, buffer_trimming=("segment", args.buffer_trimming_sec))
+    n = int(chunk*SAMPLING_RATE)
+    times = []
+    for i in range(0, len(audio) - n + 1, n):
+        online.insert_audio_chunk(audio[i:i+n])
+        t = time.time()
+        online.process_iter()
+        times.append(time.time() - t)
+    return sum(times) / len(times)
+
+
+def thread_candidates():
+    n = os.cpu_count() or 4
+    return sorted({c for c in (4, n // 2, n) if c >= 1})
+
+
+def benchmark(args, device, audio, fixed=None):
+    """times the candidate configurations, returns the chosen one as a dict, or None
+    fixed: the tuned options given on the command line, they are not varied
+    """
+    from whisper_online import create_asr
+
+    fixed = fixed or {}
+    compute_types = COMPUTE_TYPES[device] if "compute_type" not in fixed else [args.compute_type]
+    threads = thread_candidates() if device == "cpu" and "cpu_threads" not in fixed else [args.cpu_threads]
+    beams = BEAM_SIZES if "beam_size" not in fixed else [args.beam_size]
+    chunk_sizes = CHUNK_SIZES if "min_chunk_size" not in fixed else [args.min_chunk_size]
+    results = []
+    for compute_type in compute_types:
+        for cpu_threads in threads:
+            a = copy.copy(args)
+            a.device, a.compute_type, a.cpu_threads = device, compute_type, cpu_threads
+            try:
+                asr = create_asr(a)
+                asr.transcribe(audio[:SAMPLING_RATE])  # warm up
+            except Exception as e:
+                logger.warning(f"autotune: {compute_type} with {cpu_threads} threads is not usable: {e}")
+                continue
+            for beam_size in beams:
+                asr.beam_size = beam_size
+                t = iteration_time(asr, audio, a)
+                # process_iter takes about the same time with any chunk size, the chunk must be longer than t/budget
+                chunk = next((c for c in chunk_sizes if t / c <= args.autotune_rtf), None)
+                logger.info(f"autotune: {compute_type}, {cpu_threads} threads, beam {beam_size}: {t:.3f} s per iteration, "
+                            + (f"chunk {chunk} s" if chunk else "slower than the budget with any chunk size"))
+                results.append(dict(compute_type=compute_type, cpu_threads=cpu_threads, beam_size=beam_size,
+                                    min_chunk_size=chunk if chunk else chunk_sizes[-1], iteration_time=t, within_budget=chunk is not None))
+            del asr
+    if not results:
+        return None
+    within = [r for r in results if r["within_budget"]]
+    if within:
+        return min(within, key=lambda r: (r["min_chunk_size"], -r["beam_size"], r["iteration_time"]))
+    # none is fast enough, the fastest one lags the least
+    return min(results, key=lambda r: r["iteration_time"])
+
+
+def apply(args, config, device, fixed=None):
+    """sets the tuned options of config in args, except the fixed ones"""
+    args.device = device
+    for name in TUNED:
+        if name in (fixed or {}) or getattr(args, name, None) == config[name]:
+            continue
+        logger.info(f"autotune: --{name.replace('_', '-')} {getattr(args, name, None)} replaced by {config[name]}")
+        setattr(args, name, config[name])
+
+
+def fixed_options(args, parser):
+    """the tuned options given on the command line: the ones that differ from the parser defaults"""
+    if parser is None:
+        return {}
+    return {name: getattr(args, name) for name in TUNED if getattr(args, name, None) != parser.get_default(name)}
+
+
+def autotune(args, parser=None):
+    """Sets the compute type, CPU threads, beam size and min chunk size in args (argparse.Namespace),
+    from the cache or by benchmarking. It runs before the model is loaded.
+    parser: the argparse.ArgumentParser of args. The options not at its defaults are kept as they are.
+    """
+    if args.backend != "faster-whisper":
+        logger.warning("autotune works only with the faster-whisper backend, skipping it")
+        return
+    if getattr(args, "replay_asr", None):
+        logger.warning("autotune is not used with --replay-asr, skipping it")
+        return
+    if getattr(args, "inference_workers", 0):
+        logger.warning("autotune is not used with inference workers, skipping it")
+        return
+    from whisper_online import FasterWhisperASR
+    device, _ = FasterWhisperASR.resolve_device(args.device)
+
+    fixed = fixed_options(args, parser)
+    if fixed:
+        logger.info(f"autotune: keeping the options {fixed}")
+    key = hardware_key(args, device, fixed)
+    cache = load_cache(args.autotune_cache)
+    config = cache.get(key)
+    if config is not None:
+        logger.info(f"autotune: reusing the cached configuration {config}")
+    else:
+        t = time.time()
+        logger.info("autotune: timing the candidate configurations...")
+        config = benchmark(args, device, tuning_audio(args), fixed)
+        if config is None:
+            logger.error("autotune: no configuration could be loaded, using the command line options")
+            return
+        if not config["within_budget"]:
+            logger.warning(f"autotune: no configuration keeps the real-time factor {args.autotune_rtf}, using the fastest one")
+        logger.info(f"autotune: chose {config} in {time.time()-t:.1f} seconds")
+        cache[key] = config
+        try:
+            save_cache(args.autotune_cache, cache)
+        except OSError as e:
+            logger.warning(f"autotune: the result is not cached: {e}")
+    apply(args, config, device, fixed)
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""Cross-stream batching of the ASR transcribe calls.
+
+When several online processors share one ASR object (see session_manager.py),
+each of them calls asr.transcribe() from its own thread. BatchedASR queues
+these calls, and a scheduler thread runs the requests that arrive within a
+short time window as one asr.transcribe_batch() call. Each caller gets back
+its own result, so ts_words and segments_end_ts work as before.
+"""
+
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class _Request:
+
+    def __init__(self, audio, init_prompt, features):
+        self.audio = audio
+        self.init_prompt = init_prompt
+        self.features = features
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class BatchedASR:
+    '''It wraps an ASR object (ASRBase child) and can be used in its place by any number of online processors.
+    The attributes and methods other than transcribe (sep, ts_words, segments_end_ts, ...) are the ones of the wrapped object.
+    '''
+
+    def __init__(self, asr, batch_window=0.02, max_batch_size=8, active_streams=None):
+        """asr: the shared ASR object.
+        batch_window: how long (in seconds) to wait for more requests after the first one arrived.
+        max_batch_size: the maximum number of requests in one batch.
+        active_streams: optional callable returning the number of streams that may send a request.
+            The scheduler doesn't wait for the rest of the window when the requests of all of them are collected.
+        """
+        self.asr = asr
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+        self.active_streams = active_streams
+
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="asr-batch-scheduler", daemon=True)
+        self._thread.start()
+
+    def __getattr__(self, name):
+        return getattr(self.asr, name)
+
+    def transcribe(self, audio, init_prompt="", features=None):
+        request = _Request(audio, init_prompt, features)
+        self._queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def _batch_limit(self):
+        if self.active_streams is None:
+            return self.max_batch_size
+        return max(1, min(self.max_batch_size, self.active_streams()))
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.batch_window
+        limit = self._batch_limit()
+        while len(batch) < limit:
+            timeout = deadline - time.monotonic()
+            try:
+                if timeout > 0:
+                    batch.append(self._queue.get(timeout=timeout))
+                else:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _transcribe(self, batch):
+        try:
+            features = [r.features for r in batch]
+            if all(f is None for f in features):
+                features = None
+            return self.asr.transcribe_batch([r.audio for r in batch], [r.init_prompt for r in batch], features)
+        except Exception as e:
+            if len(batch) == 1:
+                batch[0].error = e
+                return [None]
+            # one bad request shouldn't fail the others, let's retry them separately
+            logger.error(f"batched transcription of {len(batch)} requests failed: {e}. Retrying them one by one.")
+            return [self._transcribe([r])[0] for r in batch]
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            t = time.time()
+            results = [None]*len(batch)
+            try:
+                results = self._transcribe(batch)
+                logger.debug(f"transcribed a batch of {len(batch)} requests in {time.time()-t:2.2f} seconds")
+            finally:
+                # the callers must never be left waiting
+                for r, res in zip(batch, results):
+                    r.result = res
+                    r.done.set()
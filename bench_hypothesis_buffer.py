@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""Micro-benchmark of HypothesisBuffer with long hypotheses.
+
+It replays a synthetic stream of transcription hypotheses (a growing stable
+prefix, a few changing words at the end, and repeated n-grams at the commit
+boundary) through HypothesisBuffer and through the previous list-based
+implementation, checks that both commit exactly the same words, and prints
+the per-iteration cost of insert + flush + complete + pop_commited.
+
+Usage: python3 bench_hypothesis_buffer.py [--words 300] [--iterations 2000]
+"""
+
+import argparse
+import logging
+import random
+import sys
+import time
+
+from whisper_online import HypothesisBuffer
+
+
+class ListHypothesisBuffer:
+    '''The previous implementation: lists with pop(0) and joined n-gram strings. Kept here as the reference.'''
+
+    def __init__(self, logfile=sys.stderr):
+        self.commited_in_buffer = []
+        self.buffer = []
+        self.new = []
+
+        self.last_commited_time = 0
+        self.last_commited_word = None
+
+        self.logfile = logfile
+
+    def insert(self, new, offset):
+        new = [(a+offset,b+offset,t) for a,b,t in new]
+        self.new = [(a,b,t) for a,b,t in new if a > self.last_commited_time-0.1]
+
+        if len(self.new) >= 1:
+            a,b,t = self.new[0]
+            if abs(a - self.last_commited_time) < 1:
+                if self.commited_in_buffer:
+                    cn = len(self.commited_in_buffer)
+                    nn = len(self.new)
+                    for i in range(1,min(min(cn,nn),5)+1):
+                        c = " ".join([self.commited_in_buffer[-j][2] for j in range(1,i+1)][::-1])
+                        tail = " ".join(self.new[j-1][2] for j in range(1,i+1))
+                        if c == tail:
+                            for j in range(i):
+                                self.new.pop(0)
+                            break
+
+    def flush(self):
+        commit = []
+        while self.new:
+            na, nb, nt = self.new[0]
+
+            if len(self.buffer) == 0:
+                break
+
+            if nt == self.buffer[0][2]:
+                commit.append((na,nb,nt))
+                self.last_commited_word = nt
+                self.last_commited_time = nb
+                self.buffer.pop(0)
+                self.new.pop(0)
+            else:
+                break
+        self.buffer = self.new
+        self.new = []
+        self.commited_in_buffer.extend(commit)
+        return commit
+
+    def pop_commited(self, time):
+        while self.commited_in_buffer and self.commited_in_buffer[0][1] <= time:
+            self.commited_in_buffer.pop(0)
+
+    def complete(self):
+        return self.buffer
+
+
+def hypotheses(n_words, iterations, seed=0):
+    """Yields (words, offset, trim_time) for every iteration. The words are relative to offset,
+    like ts_words of a transcription of the audio buffer that starts at offset."""
+    rnd = random.Random(seed)
+    vocab = [" w%d" % i for i in range(500)]
+    stream = [rnd.choice(vocab) for _ in range(n_words + iterations + 10)]
+    word_dur = 0.3
+    offset = 0.0
+    start = 0  # the first word in the audio buffer
+    for it in range(iterations):
+        end = start + n_words + it % 3  # the hypothesis grows and shrinks a little
+        words = []
+        for k in range(start, end):
+            t = stream[k]
+            if k >= end - 2 and rnd.random() < 0.5:
+                t = rnd.choice(vocab)  # the unstable end of the hypothesis
+            words.append((k*word_dur - offset, (k+1)*word_dur - offset, t))
+        trim = None
+        if it % 20 == 19:
+            # after this iteration, the audio buffer is trimmed by 10 words
+            trim = (start + 10)*word_dur
+        yield words, offset, trim
+        if trim is not None:
+            start += 10
+            offset = trim
+
+
+def run(buffer_cls, hyps):
+    hb = buffer_cls()
+    committed = []
+    t = time.perf_counter()
+    for words, offset, trim in hyps:
+        hb.insert(words, offset)
+        committed.extend(hb.flush())
+        hb.complete()
+        if trim is not None:
+            hb.pop_commited(trim)
+    return time.perf_counter() - t, committed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--words", type=int, default=300, help="Number of words in every hypothesis.")
+    parser.add_argument("--iterations", type=int, default=2000)
+    args = parser.parse_args()
+
+    logging.getLogger("whisper_online").setLevel(logging.WARNING)
+    hyps = list(hypotheses(args.words, args.iterations))
+
+    results = {}
+    for name, cls in [("list (previous)", ListHypothesisBuffer), ("HypothesisBuffer", HypothesisBuffer)]:
+        best = None
+        for _ in range(3):
+            elapsed, committed = run(cls, hyps)
+            best = elapsed if best is None else min(best, elapsed)
+        results[name] = committed
+        print(f"{name:18s} {best/args.iterations*1e6:8.1f} us per iteration, {len(committed)} words committed")
+
+    a, b = results.values()
+    if a != b:
+        print("MISMATCH: the committed words differ")
+        sys.exit(1)
+    print("the committed words are identical")
@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+"""Benchmark of the whole online pipeline on recorded audio.
+
+It replays WAV files (default samples/*.wav) through OnlineASRProcessor and
+VACOnlineASRProcessor, in the computation-unaware mode (the processing takes
+no time, the audio comes chunk by chunk as fast as it is processed) and in
+the real-time mode (the audio comes with the wall clock, as from a
+microphone). For every file, processor and mode it reports:
+
+- rtf: the total process_iter time / the audio duration
+- emission latency p50/p95/p99: the time when a committed text is emitted
+  minus its end timestamp in the audio. In the computation-unaware mode, the
+  emission time is the end of the audio received so far.
+- commit lag: the audio received so far minus the end of the committed
+  text, sampled after every iteration (mean and max)
+- iterations per second of process_iter
+- peak RSS of the benchmark process so far
+
+With --stub-asr, a deterministic stub replaces the Whisper model, so that the
+overhead of the pipeline itself is measured, optionally with a simulated
+model cost (--stub-rtf). The results are written as JSON with --json, with
+the git commit, to compare runs across commits.
+
+Usage: python3 bench_streaming.py [files.wav ...] --stub-asr --json results.json
+"""
+
+import argparse
+import copy
+import glob
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+import zlib
+
+import numpy as np
+
+from whisper_online import ASRBase, add_shared_args, create_asr, create_online, load_audio, set_logging
+
+logger = logging.getLogger(__name__)
+
+SAMPLING_RATE = 16000
+MODES = ["computation-unaware", "real-time"]
+PROCESSORS = ["online", "vac"]
+
+
+class StubASR(ASRBase):
+    '''A deterministic ASR without a model. Every 0.4 seconds of the audio buffer is one word, its text
+    is a hash of the audio, so the repeated transcriptions of the same audio agree.
+    Every fifth word ends a segment, and a word that ends with "." ends a sentence.
+    rtf: every transcribe call sleeps rtf * the audio duration, to simulate the cost of a model.
+    '''
+
+    sep = " "
+    word_duration = 0.4
+
+    def __init__(self, lan="en", rtf=0.0, **kw):
+        self.rtf = rtf
+        super().__init__(lan, **kw)
+
+    def load_model(self, modelsize=None, cache_dir=None, model_dir=None):
+        return None
+
+    def transcribe(self, audio, init_prompt=""):
+        audio = np.asarray(audio)
+        if self.rtf:
+            time.sleep(self.rtf*len(audio)/SAMPLING_RATE)
+        n = int(self.word_duration*SAMPLING_RATE)
+        words = []
+        for i in range(0, len(audio) - n + 1, n):
+            h = zlib.crc32(np.round(audio[i:i+n]*1000).astype(np.int16).tobytes()) % 50
+            words.append((i/SAMPLING_RATE, (i+n)/SAMPLING_RATE, "w%02d%s" % (h, "." if h % 7 == 0 else "")))
+        return words
+
+    def ts_words(self, r):
+        return list(r)
+
+    def segments_end_ts(self, r):
+        return [e for i, (_, e, _) in enumerate(r) if i % 5 == 4]
+
+    def use_vad(self):
+        pass
+
+    def set_translate_task(self):
+        pass
+
+
+def peak_rss_mb():
+    """the peak resident set size of this process, in MB, or None where it is not available"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss / (1024*1024 if sys.platform == "darwin" else 1024)
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def percentiles(values):
+    if not values:
+        return {"p50": None, "p95": None, "p99": None}
+    p = np.percentile(values, [50, 95, 99])
+    return {"p50": float(p[0]), "p95": float(p[1]), "p99": float(p[2])}
+
+
+class StreamStats:
+    '''The measurements of one replayed stream.'''
+
+    def __init__(self):
+        self.iteration_times = []
+        self.latencies = []
+        self.commit_lags = []
+        self.committed_end = 0
+        self.words = 0
+
+    def iteration(self, o, elapsed, audio_end, now):
+        """o: the result of process_iter or finish. audio_end: the stream time of the received audio.
+        now: the emission time, in the same time scale
+        """
+        self.iteration_times.append(elapsed)
+        if o[0] is not None:
+            self.latencies.append(now - o[1])
+            self.committed_end = max(self.committed_end, o[1])
+            self.words += len(o[2].split())
+        self.commit_lags.append(max(0.0, audio_end - self.committed_end))
+
+    def result(self, duration, wall):
+        processing = sum(self.iteration_times)
+        return {
+            "duration": duration,
+            "wall_time": wall,
+            "processing_time": processing,
+            "rtf": processing / duration if duration else None,
+            "iterations": len(self.iteration_times),
+            "iterations_per_second": len(self.iteration_times) / processing if processing else None,
+            "emission_latency": percentiles(self.latencies),
+            "commit_lag": {"mean": float(np.mean(self.commit_lags)) if self.commit_lags else None,
+                           "max": float(max(self.commit_lags)) if self.commit_lags else None},
+            "committed_words": self.words,
+            "peak_rss_mb": peak_rss_mb(),
+        }
+
+
+def replay_computation_unaware(online, audio, chunk):
+    stats = StreamStats()
+    n = max(1, int(chunk*SAMPLING_RATE))
+    start = time.perf_counter()
+    for beg in range(0, len(audio), n):
+        end = min(beg + n, len(audio))
+        online.insert_audio_chunk(audio[beg:end])
+        t = time.perf_counter()
+        o = online.process_iter()
+        stats.iteration(o, time.perf_counter() - t, end/SAMPLING_RATE, end/SAMPLING_RATE)
+    t = time.perf_counter()
+    o = online.finish()
+    stats.iteration(o, time.perf_counter() - t, len(audio)/SAMPLING_RATE, len(audio)/SAMPLING_RATE)
+    return stats, time.perf_counter() - start
+
+
+def replay_real_time(online, audio, chunk):
+    # the same loop as the simultaneous mode of whisper_online.py
+    stats = StreamStats()
+    duration = len(audio)/SAMPLING_RATE
+    start = time.perf_counter()
+    beg = end = 0.0
+    while end < duration:
+        now = time.perf_counter() - start
+        if now < end + chunk:
+            time.sleep(end + chunk - now)
+        end = min(time.perf_counter() - start, duration)
+        online.insert_audio_chunk(audio[int(beg*SAMPLING_RATE):int(end*SAMPLING_RATE)])
+        beg = end
+        t = time.perf_counter()
+        o = online.process_iter()
+        stats.iteration(o, time.perf_counter() - t, end, time.perf_counter() - start)
+    t = time.perf_counter()
+    o = online.finish()
+    stats.iteration(o, time.perf_counter() - t, duration, time.perf_counter() - start)
+    return stats, time.perf_counter() - start
+
+
+def run_benchmark(args, asr, files):
+    results = []
+    devnull = open(os.devnull, "w")
+    for path in files:
+        audio = load_audio(path)
+        duration = len(audio)/SAMPLING_RATE
+        for processor in args.processors:
+            a = copy.copy(args)
+            a.vac = processor == "vac"
+            try:
+                online = create_online(a, asr, logfile=devnull)
+            except ImportError as e:
+                logger.error(f"skipping the {processor} processor: {e}")
+                continue
+            chunk = a.vac_chunk_size if a.vac else a.min_chunk_size
+            for mode in args.modes:
+                online.init()
+                logger.info(f"{os.path.basename(path)}, {processor}, {mode}: {duration:.1f} s of audio...")
+                replay = replay_computation_unaware if mode == "computation-unaware" else replay_real_time
+                stats, wall = replay(online, audio, chunk)
+                r = {"file": path, "processor": processor, "mode": mode, "chunk": chunk}
+                r.update(stats.result(duration, wall))
+                results.append(r)
+                print(format_result(r), flush=True)
+    devnull.close()
+    return results
+
+
+def _fmt(x, f="%.3f"):
+    return "-" if x is None else f % x
+
+
+def format_result(r):
+    lat = r["emission_latency"]
+    return (f"{os.path.basename(r['file'])} {r['processor']} {r['mode']}: "
+            f"rtf {_fmt(r['rtf'], '%.4f')}, latency p50/p95/p99 {_fmt(lat['p50'], '%.2f')}/{_fmt(lat['p95'], '%.2f')}/{_fmt(lat['p99'], '%.2f')} s, "
+            f"commit lag mean/max {_fmt(r['commit_lag']['mean'], '%.2f')}/{_fmt(r['commit_lag']['max'], '%.2f')} s, "
+            f"{_fmt(r['iterations_per_second'], '%.1f')} it/s, {r['committed_words']} words, peak RSS {_fmt(r['peak_rss_mb'], '%.0f')} MB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("audio_paths", type=str, nargs="*",
+            help="16kHz mono WAV files. Default is samples/*.wav.")
+    parser.add_argument("--modes", type=str, nargs="+", default=MODES, choices=MODES)
+    parser.add_argument("--processors", type=str, nargs="+", default=PROCESSORS, choices=PROCESSORS,
+            help="vac is VACOnlineASRProcessor, it requires torch.")
+    parser.add_argument("--stub-asr", action="store_true", default=False, dest="stub_asr",
+            help="Use a deterministic stub instead of the Whisper model, to measure the overhead of the pipeline.")
+    parser.add_argument("--stub-rtf", type=float, default=0.0, dest="stub_rtf",
+            help="The simulated real-time factor of every transcribe call of the stub.")
+    parser.add_argument("--json", type=str, default=None,
+            help="Write the results to this JSON file.")
+    add_shared_args(parser)
+    args = parser.parse_args()
+
+    set_logging(args, logger, other="")
+
+    files = args.audio_paths or sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), "samples", "*.wav")))
+    if not files:
+        logger.error("No audio files.")
+        sys.exit(1)
+
+    if args.stub_asr:
+        asr = StubASR(args.lan if args.lan != "auto" else "en", rtf=args.stub_rtf)
+        args.buffer_trimming = "segment"  # the stub has no real sentences for a sentence tokenizer
+    else:
+        # the latencies are computed from the timestamps of the committed words
+        args.show_timestamps = True
+        asr = create_asr(args)
+        # the very first transcribe takes much more time than the others
+        asr.transcribe(load_audio(files[0])[:SAMPLING_RATE])
+
+    results = run_benchmark(args, asr, files)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"commit": git_commit(), "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                       "stub_asr": args.stub_asr, "stub_rtf": args.stub_rtf if args.stub_asr else None,
+                       "backend": None if args.stub_asr else args.backend, "model": None if args.stub_asr else args.model,
+                       "min_chunk_size": args.min_chunk_size, "vac_chunk_size": args.vac_chunk_size,
+                       "results": results}, f, indent=1)
+        logger.info(f"results written to {args.json}")
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""Coalesced, rate-limited emission of the caption updates.
+
+One iteration of the online processing can change the overlay lines several
+times (a new word, a completed line, the rest of a long text), and every
+Socket.IO emit goes to all the overlays of the stream. CaptionEmitter
+merges the pending updates of every stream into one message, and a separate
+thread emits them at most --caption-fps times per second. The ASR thread
+only updates the pending message, so a slow overlay client can't stall the
+transcription.
+"""
+
+import logging
+import threading
+import time
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+COALESCED = metrics.Counter("enuri_caption_updates_coalesced_total", "Caption updates replaced by a newer one before they were emitted.")
+
+
+def add_emitter_args(parser):
+    """options of the caption emission
+    parser: argparse.ArgumentParser object
+    """
+    parser.add_argument("--caption-fps", type=float, default=10, dest="caption_fps",
+            help="The maximum number of caption updates per second sent to the overlays. The updates between them are merged. 0 sends every update without waiting.")
+
+
+class CaptionEmitter:
+    '''Emits the latest caption state of every stream by emit(key, message), in its own thread,
+    at most fps times per second.
+    '''
+
+    def __init__(self, emit, fps=10, merge=None):
+        """emit: callable(key, message), e.g. a Socket.IO emit. key identifies the stream.
+        merge: optional callable(pending, message), returns one message with the changes of both.
+            By default, a newer message replaces the pending one, e.g. a state of the lines.
+        """
+        self.emit = emit
+        self.merge = merge
+        self.interval = 1/fps if fps > 0 else 0
+        self._pending = {}  # key -> the latest message
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def update(self, key, message):
+        """replaces the pending state of the stream key, it doesn't wait for the emit"""
+        with self._cond:
+            if key in self._pending:
+                COALESCED.inc()
+                if self.merge is not None:
+                    message = self.merge(self._pending[key], message)
+            self._pending[key] = message
+            if self._thread is None:
+                # started on the first update, not before the inference workers are forked
+                self._thread = threading.Thread(target=self._run, name="caption-emitter", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def _run(self):
+        next_frame = 0
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+            delay = next_frame - time.monotonic()
+            if delay > 0:
+                # the updates of this time are merged
+                time.sleep(delay)
+            with self._cond:
+                pending, self._pending = self._pending, {}
+            next_frame = time.monotonic() + self.interval
+            for key, message in pending.items():
+                try:
+                    with metrics.stage("emit"):
+                        self.emit(key, message)
+                except Exception as e:
+                    logger.error(f"Error emitting the captions of {key}: {e}")
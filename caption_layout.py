@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+"""Incremental layout of the committed words into caption lines.
+
+CaptionLayout takes the committed words as they arrive and keeps only the
+state of the last max_lines lines, so one word costs O(1). A line is
+broken when the next word would make it longer than max_chars, or at the
+end of a sentence, when the line has at least min_chars characters. A word
+longer than max_chars gets a line of its own, words are never dropped.
+
+The output are only the changes of the lines, as JSON-friendly operations:
+["append", text] appends text to the last line, with the separating space,
+and ["roll"] starts a new empty line, the oldest line over max_lines scrolls
+away. The overlay applies them to its own copy of the lines.
+
+The overlays get them as versioned delta messages with a sequence number
+per stream, see CaptionLines. On a reconnect or a missed sequence number,
+an overlay requests a snapshot of the lines.
+"""
+
+import collections
+import itertools
+import threading
+import time
+
+SENTENCE_END = (".", "?", "!", "…")
+
+
+class CaptionLayout:
+
+    def __init__(self, max_chars=150, min_chars=50, max_lines=2):
+        if max_chars < 1 or max_lines < 1:
+            raise ValueError("max_chars and max_lines must be positive")
+        self.max_chars = max_chars
+        self.min_chars = min(min_chars, max_chars)
+        self.max_lines = max_lines
+        self.reset()
+
+    def reset(self):
+        self._lines = collections.deque([[]], maxlen=self.max_lines)  # the words of the lines, the last one is being filled
+        self._length = 0  # characters of the last line
+        self._break = False  # the last line ends a sentence and it is long enough
+
+    def add(self, words):
+        """Lays out the next committed words (an iterable of strings without spaces).
+        Returns the list of the operations that change the lines.
+        """
+        ops = []
+        for w in words:
+            if not w:
+                continue
+            if self._length and (self._break or self._length + 1 + len(w) > self.max_chars):
+                self._lines.append([])
+                self._length = 0
+                ops.append(["roll"])
+            text = " " + w if self._length else w
+            self._lines[-1].append(w)
+            self._length += len(text)
+            self._break = self._length >= self.min_chars and w.endswith(SENTENCE_END)
+            if ops and ops[-1][0] == "append":
+                ops[-1][1] += text
+            else:
+                ops.append(["append", text])
+        return ops
+
+    def lines(self):
+        """the current lines, the oldest first"""
+        return [" ".join(words) for words in self._lines]
+
+
+def merge_ops(ops, more):
+    """the operations of ops followed by more, with the appends in a row joined"""
+    merged = list(ops)
+    for op in more:
+        if op[0] == "append" and merged and merged[-1][0] == "append":
+            merged[-1] = ["append", merged[-1][1] + op[1]]
+        else:
+            merged.append(op)
+    return merged
+
+
+PROTOCOL_VERSION = 1
+
+
+class CaptionLines:
+    '''The lines of one stream as the overlays have them: the operations sent so far, and their sequence number.
+
+    Every delta message has the next sequence number of the stream. An overlay that misses one, or that
+    (re)connects, gets the snapshot: the lines at the sequence number of the last delta.
+    The operations are those of CaptionLayout.
+    The last history completed lines are kept in a ring, as (line number, time, text).
+    '''
+
+    def __init__(self, key, max_lines=2, history=500, seq=0):
+        """seq: the sequence number before the first delta"""
+        self.key = key
+        self.lines = collections.deque([""], maxlen=max_lines)
+        self.seq = seq
+        self.history = collections.deque(maxlen=history)
+        self.completed = 0  # the number of the completed lines so far
+
+    def apply(self, ops):
+        """applies the operations, returns the delta message with them"""
+        for op in ops:
+            if op[0] == "append":
+                self.lines[-1] += op[1]
+            elif op[0] == "roll":
+                self.history.append((self.completed, time.time(), self.lines[-1]))
+                self.completed += 1
+                self.lines.append("")
+            else:
+                raise ValueError(f"unknown caption operation {op[0]}")
+        self.seq += 1
+        return {"type": "delta", "v": PROTOCOL_VERSION, "stream": self.key, "seq": self.seq, "ops": ops}
+
+    def snapshot(self, history=False):
+        """history: include the ring of the completed lines"""
+        message = {"type": "snapshot", "v": PROTOCOL_VERSION, "stream": self.key, "seq": self.seq, "lines": list(self.lines)}
+        if history:
+            message["history"] = [list(h) for h in self.history]
+        return message
+
+    def transcript(self, after=-1, limit=100):
+        """up to limit completed lines with the line number over after, and the current lines"""
+        first = self.history[0][0] if self.history else self.completed
+        start = max(0, after + 1 - first)
+        lines = [{"n": n, "time": t, "text": text} for n, t, text in itertools.islice(self.history, start, start + limit)]
+        return {"stream": self.key, "completed": self.completed, "first": first, "lines": lines,
+                "next": lines[-1]["n"] if lines and lines[-1]["n"] < self.completed - 1 else None,
+                "current": list(self.lines)}
+
+
+class CaptionStreams:
+    '''The CaptionLines of the recent streams, up to capacity of them, thread-safe.
+
+    The sequence numbers don't go back when a dropped stream comes back: its new lines start over all the dropped ones,
+    so its overlays see a gap and ask for the snapshot.
+    '''
+
+    def __init__(self, max_lines=2, history=500, capacity=64):
+        self.max_lines = max_lines
+        self.history = history
+        self.capacity = capacity
+        self._streams = collections.OrderedDict()  # key -> CaptionLines, the last updated one is the last
+        self._dropped_seq = 0  # the highest sequence number of the dropped streams
+        self._lock = threading.Lock()
+
+    def apply(self, key, ops):
+        """applies the operations to the lines of the stream key, returns the delta message"""
+        with self._lock:
+            lines = self._streams.get(key)
+            if lines is None:
+                lines = self._streams[key] = CaptionLines(key, self.max_lines, self.history, seq=self._dropped_seq + 1 if self._dropped_seq else 0)
+                if len(self._streams) > self.capacity:
+                    _, dropped = self._streams.popitem(last=False)
+                    self._dropped_seq = max(self._dropped_seq, dropped.seq)
+            self._streams.move_to_end(key)
+            return lines.apply(ops)
+
+    def _get(self, key):
+        # the caller holds the lock
+        if key is None and self._streams:
+            key = next(reversed(self._streams))
+        return key, self._streams.get(key)
+
+    def keys(self):
+        with self._lock:
+            return list(self._streams)
+
+    def snapshot(self, key=None, history=False):
+        """the snapshot message of the stream key, or of the last updated stream if key is None.
+        A stream that is not known has no lines and the sequence number 0.
+        """
+        with self._lock:
+            key, lines = self._get(key)
+            if lines is None:
+                message = {"type": "snapshot", "v": PROTOCOL_VERSION, "stream": key, "seq": 0, "lines": []}
+                if history:
+                    message["history"] = []
+                return message
+            return lines.snapshot(history)
+
+    def transcript(self, key=None, after=-1, limit=100):
+        """a page of the completed lines of the stream key (or of the last updated one), see CaptionLines.transcript,
+        or None if the stream is not known"""
+        with self._lock:
+            key, lines = self._get(key)
+            return lines.transcript(after, limit) if lines is not None else None
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""Latency-adaptive minimum chunk size of the online loop.
+
+The online loop waits for min_chunk seconds of new audio, then runs
+process_iter. process_iter transcribes the whole audio buffer, so its time
+hardly depends on the chunk size. If it takes longer than the chunk, the
+audio piles up and the stream falls behind. If it takes much shorter, the
+loop waits for audio longer than it has to, and the latency is higher than
+the hardware allows.
+
+AdaptiveChunkController measures the wall time of every process_iter and
+the audio that was waiting for it, and sets the chunk size so that the
+processing takes target_rtf of the real time, within the configured bounds.
+"""
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def add_chunk_controller_args(parser):
+    """options of the adaptive chunk size
+    parser: argparse.ArgumentParser object
+    """
+    parser.add_argument('--adaptive-chunk', action="store_true", default=False, dest='adaptive_chunk',
+            help='Adapt the minimum chunk size to the measured processing time, to keep the real-time factor at --target-rtf. --min-chunk-size (or the VAC one) is the initial value.')
+    parser.add_argument('--target-rtf', type=float, default=0.8, dest='target_rtf',
+            help='Target real-time factor of the adaptive chunk size: processing time / chunk duration.')
+    parser.add_argument('--adaptive-chunk-bounds', type=float, nargs=2, default=(0.1, 5.0), dest='adaptive_chunk_bounds', metavar=('MIN', 'MAX'),
+            help='The lowest and the highest adaptive chunk size in seconds.')
+
+
+def create_chunk_controller(args, chunk_size):
+    """the AdaptiveChunkController of one stream, if --adaptive-chunk, or None"""
+    if not getattr(args, 'adaptive_chunk', False):
+        return None
+    lo, hi = args.adaptive_chunk_bounds
+    return AdaptiveChunkController(chunk_size, min_chunk=lo, max_chunk=hi, target_rtf=args.target_rtf)
+
+
+class AdaptiveChunkController:
+    '''Sets chunk_size (in seconds) from the measured processing times of one stream.
+
+    The processing time of process_iter is smoothed with an exponential moving average.
+    The chunk size is this time / target_rtf. When more audio was waiting than one chunk
+    (the backlog grows), the chunk grows at least by the backlog factor. The chunk shrinks
+    at most by shrink_factor per update, to avoid oscillation.
+    '''
+
+    def __init__(self, chunk_size, min_chunk=0.1, max_chunk=5.0, target_rtf=0.8, smoothing=0.3, shrink_factor=0.8):
+        if not 0 < min_chunk <= max_chunk:
+            raise ValueError("the chunk size bounds must be 0 < min_chunk <= max_chunk")
+        if target_rtf <= 0:
+            raise ValueError("target_rtf must be positive")
+        self.min_chunk = min_chunk
+        self.max_chunk = max_chunk
+        self.target_rtf = target_rtf
+        self.smoothing = smoothing
+        self.shrink_factor = shrink_factor
+        self.chunk_size = self._clip(chunk_size)
+
+        self.processing_time = None  # the moving average, in seconds
+        self.last_rtf = None
+        self._logged_chunk_size = self.chunk_size
+
+    def _clip(self, chunk_size):
+        return min(self.max_chunk, max(self.min_chunk, chunk_size))
+
+    def update(self, elapsed, audio_seconds):
+        """elapsed: wall time of one process_iter. audio_seconds: the new audio it processed.
+        Returns the new chunk_size.
+        """
+        if self.processing_time is None:
+            self.processing_time = elapsed
+        else:
+            self.processing_time += self.smoothing * (elapsed - self.processing_time)
+        self.last_rtf = elapsed / audio_seconds if audio_seconds > 0 else None
+
+        chunk = self.processing_time / self.target_rtf
+        backlog = audio_seconds - self.chunk_size
+        if backlog > 0.5*self.chunk_size:
+            # the audio piles up while processing, grow at least as fast as it does
+            chunk = max(chunk, audio_seconds)
+        chunk = max(chunk, self.chunk_size * self.shrink_factor)
+        self.chunk_size = self._clip(chunk)
+
+        logger.debug(f"process_iter took {elapsed:.3f} s for {audio_seconds:.2f} s of audio, "
+                     f"average {self.processing_time:.3f} s, chunk size {self.chunk_size:.2f} s")
+        if abs(self.chunk_size - self._logged_chunk_size) > 0.2*self._logged_chunk_size:
+            logger.info(f"chunk size {self._logged_chunk_size:.2f} -> {self.chunk_size:.2f} s "
+                        f"(processing {self.processing_time:.3f} s per iteration, target RTF {self.target_rtf}, backlog {max(0, backlog):.2f} s)")
+            self._logged_chunk_size = self.chunk_size
+        return self.chunk_size
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+"""Pool of inference worker processes, for CPU-only deployments.
+
+On CPU, one Whisper model in one Python process doesn't use a many-core
+machine well with many streams. InferencePool starts N worker processes,
+each with its own model and a fixed number of CPU threads. Every session
+gets a handle that has the ASR interface used by OnlineASRProcessor, and is
+bound to one worker for the whole session (session affinity). The worker
+with the fewest sessions is chosen.
+
+The audio of a transcribe request is written to a shared memory block of the
+worker, the request and the results (the timestamped words and the segment
+ends) go over a pipe.
+"""
+
+import logging
+import multiprocessing
+import os
+import threading
+import weakref
+from multiprocessing import shared_memory
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def add_pool_args(parser):
+    """options of the inference worker pool, shared by the servers
+    parser: argparse.ArgumentParser object
+    """
+    parser.add_argument("--inference-workers", type=int, default=0, dest="inference_workers",
+            help="Run the Whisper model on CPU in this number of worker processes, each with its own model. The sessions are spread over them. 0 runs the model in the server process.")
+    parser.add_argument("--worker-cpu-threads", type=int, default=4, dest="worker_cpu_threads",
+            help="Number of CPU threads of every inference worker.")
+
+
+def _worker_main(index, conn, args, cpu_threads):
+    # runs in the worker process
+    from whisper_online import create_asr, load_audio_chunk
+
+    # the worker's own copy of the arguments
+    args.device = "cpu"
+    if getattr(args, "compute_type", "auto") == "auto":
+        args.compute_type = "int8"
+    args.cpu_threads = cpu_threads
+    args.num_workers = 1
+    # one file can't be recorded by several processes
+    args.record_asr = None
+    try:
+        asr = create_asr(args)
+        if getattr(args, "warmup_file", None) and os.path.isfile(args.warmup_file):
+            asr.transcribe(load_audio_chunk(args.warmup_file, 0, 1))
+    except Exception as e:
+        conn.send(("error", f"{type(e).__name__}: {e}"))
+        return
+    conn.send(("ready", asr.sep))
+
+    shm = None
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            break
+        if request is None:
+            break
+        shm_name, n, init_prompt = request
+        if shm is None or shm.name != shm_name:
+            if shm is not None:
+                shm.close()
+            shm = shared_memory.SharedMemory(name=shm_name)
+        audio = np.ndarray((n,), dtype=np.float32, buffer=shm.buf)
+        try:
+            res = asr.transcribe(audio, init_prompt=init_prompt)
+            conn.send(("ok", asr.ts_words(res), asr.segments_end_ts(res)))
+        except Exception as e:
+            conn.send(("error", f"{type(e).__name__}: {e}"))
+        del audio
+    if shm is not None:
+        shm.close()
+
+
+class _Worker:
+
+    def __init__(self, index, args, cpu_threads, ctx, capacity):
+        self.index = index
+        # created before the fork, so that the worker shares the resource tracker of this process
+        self.shm = shared_memory.SharedMemory(create=True, size=capacity*4)
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=_worker_main, args=(index, child_conn, args, cpu_threads),
+                                   name=f"inference-worker-{index}", daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.lock = threading.Lock()
+        self.sessions = 0
+        self.sep = None
+
+    def wait_ready(self):
+        status, value = self.conn.recv()
+        if status != "ready":
+            raise RuntimeError(f"inference worker {self.index} failed to start: {value}")
+        self.sep = value
+
+    def transcribe(self, audio, init_prompt):
+        audio = np.asarray(audio, dtype=np.float32)
+        with self.lock:
+            if audio.nbytes > self.shm.size:
+                # the worker attaches the new block on this request
+                old = self.shm
+                self.shm = shared_memory.SharedMemory(create=True, size=max(2*old.size, audio.nbytes))
+                old.close()
+                old.unlink()
+            np.ndarray(audio.shape, dtype=np.float32, buffer=self.shm.buf)[:] = audio
+            try:
+                self.conn.send((self.shm.name, len(audio), init_prompt))
+                status, *result = self.conn.recv()
+            except (EOFError, OSError) as e:
+                raise RuntimeError(f"inference worker {self.index} is not available: {e}")
+        if status != "ok":
+            raise RuntimeError(f"inference worker {self.index}: {result[0]}")
+        return result
+
+    def close(self):
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.process.join(timeout=5)
+        self.shm.close()
+        self.shm.unlink()
+
+
+class PooledASR:
+    '''The ASR object of one session, bound to one inference worker.
+    It has the interface that OnlineASRProcessor uses. The transcribe result is a pair (ts_words, segments_end_ts)
+    computed in the worker.
+    '''
+
+    accepts_features = False
+
+    def __init__(self, worker, show_timestamps=True):
+        self.worker = worker
+        self.sep = worker.sep
+        self.show_timestamps = show_timestamps
+
+    def transcribe(self, audio, init_prompt=""):
+        return self.worker.transcribe(audio, init_prompt)
+
+    def ts_words(self, res):
+        return res[0]
+
+    def segments_end_ts(self, res):
+        return res[1]
+
+
+class InferencePool:
+    '''N worker processes, each loads the model by whisper_online.create_asr(args) on CPU.
+
+    The workers are forked: the server scripts run their setup at the module level, a spawned
+    worker would run it again. Create the pool before starting any other threads.
+    '''
+
+    def __init__(self, args, workers, cpu_threads=4, capacity=16000*60):
+        """args: the parsed arguments of the server, for create_asr.
+        capacity: the initial size of the shared audio block of every worker, in samples.
+        """
+        if workers < 1:
+            raise ValueError("the pool needs at least one worker")
+        if getattr(args, "record_asr", None):
+            logger.warning("--record-asr is not supported with inference workers, the transcriptions are not recorded")
+        self.show_timestamps = getattr(args, "show_timestamps", True)
+        ctx = multiprocessing.get_context("fork")
+        logger.info(f"Starting {workers} inference workers with {cpu_threads} CPU threads each...")
+        self.workers = [_Worker(i, args, cpu_threads, ctx, capacity) for i in range(workers)]
+        for w in self.workers:
+            w.wait_ready()
+        logger.info("Inference workers are ready.")
+        self._lock = threading.Lock()
+
+    def handle(self):
+        """a PooledASR for a new session, on the worker with the fewest sessions"""
+        with self._lock:
+            worker = min(self.workers, key=lambda w: w.sessions)
+            worker.sessions += 1
+        asr = PooledASR(worker, self.show_timestamps)
+        # the session's share of the worker ends with its online processor
+        weakref.finalize(asr, self._release, worker)
+        logger.debug(f"session assigned to inference worker {worker.index}, {worker.sessions} sessions there")
+        return asr
+
+    def _release(self, worker):
+        with self._lock:
+            worker.sessions -= 1
+
+    def close(self):
+        for w in self.workers:
+            w.close()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""Streaming log-mel features for the online processors.
+
+OnlineASRProcessor transcribes the whole audio buffer (up to 15-30 seconds)
+on every process_iter, and the Whisper backend computes the log-mel
+spectrogram of all of it again, although only the last chunk is new.
+LogMelCache keeps the mel frames of the buffer and computes only the frames
+of the new samples, and it drops the frames of the samples that are trimmed
+away. Its output is the same as of faster-whisper's FeatureExtractor.
+
+PrecomputedFeatureExtractor is installed as the feature extractor of the
+faster-whisper model, it passes the cached features to WhisperModel.transcribe.
+"""
+
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+
+
+def mel_log_power(fe, audio):
+    """log10 of the mel power spectrogram of audio, computed as by faster-whisper's FeatureExtractor (fe),
+    before the normalization. Returns an array of shape (n_mels, len(audio)//hop_length + 1).
+    """
+    waveform = np.pad(np.asarray(audio, dtype=np.float32), (0, 160))
+    window = np.hanning(fe.n_fft + 1)[:-1].astype("float32")
+    stft = fe.stft(waveform, fe.n_fft, fe.hop_length, window=window, return_complex=True).astype("complex64")
+    magnitudes = np.abs(stft[..., :-1]) ** 2
+    return np.log10(np.clip(fe.mel_filters @ magnitudes, a_min=1e-10, a_max=None))
+
+
+def normalize(log_spec):
+    """the dynamic range compression and scaling of Whisper's log-mel spectrogram"""
+    log_spec = np.maximum(log_spec, log_spec.max() - 8.0)
+    return (log_spec + 4.0) / 4.0
+
+
+class LogMelCache:
+    '''The log-mel frames of one growing and trimmed audio buffer (e.g. OnlineASRProcessor.audio_buffer).
+
+    The frame k is centered at the sample k*hop_length and it covers n_fft samples around it.
+    It is final when all these samples are in the buffer, only the last few frames
+    are recomputed when audio is appended. The first two frames depend on the reflection
+    padding at the buffer start, they are recomputed after a trim.
+    The caller must report every trim() and reset() of the buffer.
+    '''
+
+    def __init__(self, feature_extractor, capacity=3000):
+        self.fe = feature_extractor
+        self.hop = feature_extractor.hop_length
+        self.half = feature_extractor.n_fft // 2
+        self._frames = np.empty((feature_extractor.mel_filters.shape[0], capacity), dtype=np.float32)
+        self.reset()
+
+    def reset(self):
+        self._start = 0
+        self._end = 0  # self._frames[:, self._start:self._end] are the final frames of the buffer
+        self._head_stale = False  # the first two frames are from before a trim
+        self._samples = 0  # the buffer length at the last features() call, or after the last trim
+
+    def __len__(self):
+        """number of the cached final frames"""
+        return self._end - self._start
+
+    def trim(self, n):
+        """the first n samples of the buffer are dropped"""
+        if n <= 0:
+            return
+        if n % self.hop or n // self.hop >= len(self):
+            # the frames would not be aligned with the new buffer start
+            self.reset()
+            return
+        self._start += n // self.hop
+        self._samples -= n
+        self._head_stale = True
+
+    def _append(self, frames):
+        n = frames.shape[1]
+        if self._end + n > self._frames.shape[1]:
+            size = len(self)
+            if size + n > self._frames.shape[1] // 2:
+                data = np.empty((self._frames.shape[0], max(2*self._frames.shape[1], size + n)), dtype=np.float32)
+            else:
+                data = self._frames
+            data[:, :size] = self._frames[:, self._start:self._end]
+            self._frames = data
+            self._start, self._end = 0, size
+        self._frames[:, self._end:self._end + n] = frames
+        self._end += n
+
+    def features(self, audio):
+        """Returns the log-mel spectrogram of audio, the whole current buffer, the same as feature_extractor(audio)."""
+        L = len(audio)
+        if L < self._samples or L < 4*self.hop + self.half:
+            # a different or a too short buffer, nothing to reuse
+            self.reset()
+
+        if self._head_stale and len(self):
+            self._frames[:, self._start:self._start + 2] = mel_log_power(self.fe, audio[:4*self.hop])[:, :2]
+        self._head_stale = False
+
+        # frames [a, n_frames) are computed from the audio from 2 frames before a, the reflection
+        # padding at the slice start affects only the 2 discarded frames
+        a = len(self)
+        if a < 2:
+            self.reset()
+            tail = mel_log_power(self.fe, audio)
+            a = 0
+        else:
+            tail = mel_log_power(self.fe, audio[(a-2)*self.hop:])[:, 2:]
+
+        # the frames that cover only the samples in the buffer are final
+        n_final = max(0, (L - self.half) // self.hop + 1 - a)
+        if n_final:
+            self._append(tail[:, :n_final])
+        self._samples = L
+        log_spec = np.concatenate([self._frames[:, self._start:self._start + a], tail], axis=1)
+        return normalize(log_spec)
+
+
+class PrecomputedFeatureExtractor:
+    '''It replaces the feature extractor of a faster-whisper model. Within precomputed(audio, features),
+    the call on exactly that audio array returns the given features, in the calling thread.
+    The other calls, and the attributes, are passed to the original feature extractor.
+    '''
+
+    def __init__(self, feature_extractor):
+        self.feature_extractor = feature_extractor
+        self._local = threading.local()
+
+    def __getattr__(self, name):
+        return getattr(self.feature_extractor, name)
+
+    @contextmanager
+    def precomputed(self, audio, features):
+        self._local.pending = (audio, features) if features is not None else None
+        try:
+            yield
+        finally:
+            self._local.pending = None
+
+    def __call__(self, waveform, padding=160, chunk_length=None):
+        pending = getattr(self._local, "pending", None)
+        if pending is not None and pending[0] is waveform and padding == 160 and chunk_length is None:
+            self._local.pending = None
+            return pending[1]
+        return self.feature_extractor(waveform, padding=padding, chunk_length=chunk_length)
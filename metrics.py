@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+"""Latency instrumentation of the processing stages, in the Prometheus text format.
+
+A minimal registry of counters, gauges and histograms, without external
+dependencies. The processing stages are timed with the monotonic
+time.perf_counter into the histogram enuri_stage_seconds{stage="..."}:
+
+- recv_wait: the online loop waits for the audio of the client
+- decode: decoding of the received PCM bytes
+- vad: the voice activity detection of VAC
+- features: the log-mel features of the audio buffer
+- transcribe: the Whisper inference
+- hypothesis: the local agreement of the hypotheses in HypothesisBuffer
+- trim: trimming of the audio buffer and the committed text
+- process_iter: one whole iteration of the online processor
+- send: sending the committed text to the audio client
+- layout, emit: the caption lines and their Socket.IO emits of the webserver
+
+The gauges have the current sessions, and per session the audio buffer and
+the backlog in seconds, and the real-time factor of the last iteration.
+The webserver serves all of it at /metrics, the plain TCP server with
+--metrics-port.
+"""
+
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def add_metrics_args(parser):
+    """options of the metrics endpoint of the plain TCP server, and of the ASR process of the webserver
+    parser: argparse.ArgumentParser object
+    """
+    parser.add_argument("--metrics-port", type=int, default=0, dest="metrics_port",
+            help="Serve the latency metrics in the Prometheus text format at http://host:port/metrics. 0 disables it. "
+                 "The webserver serves them at /metrics, and with --asr-process, the ASR process serves its own ones on this port.")
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join('%s="%s"' % (n, str(v).replace("\\", "\\\\").replace('"', '\\"')) for n, v in zip(names, values)) + "}"
+
+
+def _number(x):
+    if x == float("inf"):
+        return "+Inf"
+    return repr(float(x)) if isinstance(x, float) else str(x)
+
+
+class _Metric:
+
+    kind = None
+
+    def __init__(self, name, help, labelnames=(), registry=None):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}  # label values -> value
+        (REGISTRY if registry is None else registry).register(self)
+
+    def remove(self, *labelvalues):
+        """drops the series of these label values, e.g. of a closed session"""
+        with self._lock:
+            self._values.pop(tuple(labelvalues), None)
+
+    def _samples(self):
+        with self._lock:
+            return [(k, v) for k, v in self._values.items()]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for labelvalues, value in self._samples():
+            lines.append(f"{self.name}{_labels(self.labelnames, labelvalues)} {_number(value)}")
+        return lines
+
+
+class Counter(_Metric):
+
+    kind = "counter"
+
+    def inc(self, amount=1, labelvalues=()):
+        labelvalues = tuple(labelvalues)
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+
+class Gauge(_Metric):
+
+    kind = "gauge"
+
+    def __init__(self, *a, **kw):
+        super().__init__(*a, **kw)
+        self._function = None
+
+    def set(self, value, *labelvalues):
+        with self._lock:
+            self._values[labelvalues] = value
+
+    def set_function(self, function):
+        """the value is function() at every scrape, for a gauge without labels"""
+        self._function = function
+
+    def _samples(self):
+        if self._function is not None:
+            return [((), self._function())]
+        return super()._samples()
+
+
+class Histogram(_Metric):
+
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS, registry=None):
+        super().__init__(name, help, labelnames, registry)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labelvalues):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            h = self._values.get(labelvalues)
+            if h is None:
+                # the counts of the buckets (the last one is +Inf, not cumulative), the sum
+                h = self._values[labelvalues] = [[0]*(len(self.buckets) + 1), 0.0]
+            h[0][i] += 1
+            h[1] += value
+
+    @contextmanager
+    def time(self, *labelvalues):
+        """observes the wall time of the with-block"""
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t, *labelvalues)
+
+    def _samples(self):
+        with self._lock:
+            return [(k, (list(counts), total)) for k, (counts, total) in self._values.items()]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        names = self.labelnames + ("le",)
+        for labelvalues, (counts, total) in self._samples():
+            cumulative = 0
+            for le, n in zip(self.buckets + (float("inf"),), counts):
+                cumulative += n
+                lines.append(f"{self.name}_bucket{_labels(names, labelvalues + (_number(le),))} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labelvalues)} {_number(total)}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labelvalues)} {cumulative}")
+        return lines
+
+
+class Registry:
+
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+
+    def render(self):
+        """all the metrics in the Prometheus text exposition format"""
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for m in metrics:
+            lines.extend(m.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = Histogram("enuri_stage_seconds", "Wall time of the processing stages.", ["stage"])
+SESSIONS = Gauge("enuri_sessions", "Number of the active audio sessions.")
+BUFFER_SECONDS = Gauge("enuri_audio_buffer_seconds", "Audio in the buffer of the online processor, in seconds.", ["session"])
+BACKLOG_SECONDS = Gauge("enuri_audio_backlog_seconds", "Audio received during the last iteration of the online processor and waiting for the next one, in seconds.", ["session"])
+RTF = Gauge("enuri_rtf", "Real-time factor of the last iteration: processing time / new audio duration.", ["session"])
+DROPPED_SECONDS = Counter("enuri_audio_dropped_seconds_total", "Audio dropped over the backlog limit, in seconds.")
+
+
+def stage(name):
+    """times a processing stage: with stage("transcribe"): ..."""
+    return STAGE_SECONDS.time(name)
+
+
+def observe_iteration(session, elapsed, audio_seconds, backlog_seconds, buffer_seconds):
+    """one iteration of the online processing of a session: its wall time, the new audio it processed,
+    the audio received meanwhile and the audio buffer after it, in seconds"""
+    STAGE_SECONDS.observe(elapsed, "process_iter")
+    if audio_seconds > 0:
+        RTF.set(elapsed / audio_seconds, session)
+    BACKLOG_SECONDS.set(backlog_seconds, session)
+    BUFFER_SECONDS.set(buffer_seconds, session)
+
+
+def remove_session(session):
+    for g in (BUFFER_SECONDS, BACKLOG_SECONDS, RTF):
+        g.remove(session)
+
+
+def render():
+    return REGISTRY.render()
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("metrics request: " + format % args)
+
+
+def serve_metrics(host, port):
+    """serves render() at http://host:port/metrics in a daemon thread"""
+    server = ThreadingHTTPServer((host, port), _Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logger.info(f"Serving the metrics at http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+"""Record and replay the transcriptions of an ASR backend.
+
+RecordingASR wraps a real backend. It saves the fingerprint of every
+transcribe input (the audio and the prompt) with the output (the timestamped
+words and the segment ends) to a gzipped JSON lines file. ReplayASR serves
+these outputs later without any model, with an optional simulated inference
+delay. The online processing is deterministic, so replaying the same audio
+with the same options gives the same transcribe inputs. This way the Python
+overhead of the online processors and the servers can be profiled and load
+tested on machines without a GPU.
+
+The first line of the file is the header with the backend options, every
+other line is one transcribe call:
+{"k": fingerprint, "h": head fingerprint, "n": samples, "w": [[beg, end, text], ...], "s": [segment ends], "t": seconds}
+
+When a replayed input is not in the recording (e.g. a different chunk size),
+ReplayASR returns the recorded call with the same audio start (head
+fingerprint) and the nearest length, with the words clipped to the audio.
+"""
+
+import bisect
+import gzip
+import hashlib
+import itertools
+import json
+import logging
+import threading
+import time
+from multiprocessing import util
+
+import numpy as np
+
+from whisper_online import ASRBase
+
+logger = logging.getLogger(__name__)
+
+SAMPLING_RATE = 16000
+HEAD_SAMPLES = SAMPLING_RATE  # the audio start that identifies the buffer
+
+
+def fingerprint(audio, n=None):
+    """a short hash of the audio (the first n samples), quantized to 16 bits"""
+    audio = np.asarray(audio, dtype=np.float32)
+    if n is not None:
+        audio = audio[:n]
+    q = np.clip(np.round(audio*32767), -32768, 32767).astype(np.int16)
+    return hashlib.blake2b(q.tobytes(), digest_size=12).hexdigest()
+
+
+def input_key(audio, init_prompt):
+    return fingerprint(audio) + ":" + hashlib.blake2b(init_prompt.encode("utf-8"), digest_size=6).hexdigest()
+
+
+class RecordingASR(ASRBase):
+    '''Wraps a loaded ASR backend and records every transcription to a file.
+    Its transcribe results are the results of the wrapped backend.
+    '''
+
+    def __init__(self, asr, path, header=None):
+        """asr: the ASR object to record. header: dict of the backend options, saved in the file."""
+        # no model of its own, ASRBase.__init__ is not used
+        self.asr = asr
+        self.sep = asr.sep
+        self.show_timestamps = getattr(asr, "show_timestamps", True)
+        self.accepts_features = asr.accepts_features
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = gzip.open(path, "wt", encoding="utf-8")
+        self._write(dict(header or {}, sep=asr.sep))
+        self.calls = 0
+        # closed at the exit of this process, also of a forked one (e.g. the ASR process of the webserver), which skips atexit
+        util.Finalize(self, self.close, exitpriority=10)
+        logger.info(f"Recording the transcriptions to {path}")
+
+    def _write(self, record):
+        with self._lock:
+            self._file.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n")
+
+    def _record(self, audio, init_prompt, res, elapsed):
+        self._write({"k": input_key(audio, init_prompt), "h": fingerprint(audio, HEAD_SAMPLES), "n": len(audio),
+                     "w": [[float(b), float(e), t] for b, e, t in self.asr.ts_words(res)],
+                     "s": [float(e) for e in self.asr.segments_end_ts(res)], "t": round(elapsed, 4)})
+        self.calls += 1
+
+    def transcribe(self, audio, init_prompt="", features=None):
+        t = time.time()
+        if features is None:
+            res = self.asr.transcribe(audio, init_prompt=init_prompt)
+        else:
+            res = self.asr.transcribe(audio, init_prompt=init_prompt, features=features)
+        self._record(audio, init_prompt, res, time.time() - t)
+        return res
+
+    def transcribe_batch(self, audios, init_prompts, features=None):
+        t = time.time()
+        results = self.asr.transcribe_batch(audios, init_prompts, features=features)
+        # the batch time is shared by its items
+        elapsed = (time.time() - t) / max(1, len(audios))
+        for a, p, r in zip(audios, init_prompts, results):
+            self._record(a, p, r, elapsed)
+        return results
+
+    def ts_words(self, res):
+        return self.asr.ts_words(res)
+
+    def segments_end_ts(self, res):
+        return self.asr.segments_end_ts(res)
+
+    def feature_cache(self):
+        return self.asr.feature_cache()
+
+    def use_vad(self):
+        self.asr.use_vad()
+
+    def set_translate_task(self):
+        self.asr.set_translate_task()
+
+    def close(self):
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+                logger.info(f"Recorded {self.calls} transcriptions to {self.path}")
+
+
+class ReplayASR(ASRBase):
+    '''Serves the transcriptions recorded by RecordingASR, without a model.
+    The transcribe result is a pair (ts_words, segments_end_ts).
+    '''
+
+    def __init__(self, path, delay="0", show_timestamps=True):
+        """path: the file of RecordingASR. delay: see --replay-delay."""
+        delay = str(delay)
+        if delay == "recorded":
+            self.delay = ("recorded", 0.0)
+        elif delay.endswith("x"):
+            self.delay = ("rtf", float(delay[:-1]))
+        else:
+            self.delay = ("seconds", float(delay))
+        super().__init__("auto", model_dir=path, show_timestamps=show_timestamps)
+
+    def load_model(self, modelsize=None, cache_dir=None, model_dir=None):
+        self.records = {}
+        self.heads = {}  # head fingerprint -> sorted list of (samples, line number, record)
+        with gzip.open(model_dir, "rt", encoding="utf-8") as f:
+            self.header = json.loads(f.readline())
+            # the same input can be recorded more than once, e.g. by several sessions of the same audio
+            for i, line in zip(itertools.count(), f):
+                r = json.loads(line)
+                self.records[r["k"]] = r
+                bisect.insort(self.heads.setdefault(r["h"], []), (r["n"], i, r))
+        self.sep = self.header.get("sep", " ")
+        self.hits = self.misses = 0
+        logger.info(f"Replaying {len(self.records)} transcriptions from {model_dir}, recorded with {self.header}")
+        return None
+
+    def _nearest(self, audio):
+        candidates = self.heads.get(fingerprint(audio, HEAD_SAMPLES))
+        if not candidates:
+            return None
+        i = bisect.bisect_left(candidates, (len(audio),))
+        return min(candidates[max(0, i-1):i+1], key=lambda c: abs(c[0] - len(audio)))[2]
+
+    def _sleep(self, audio, record):
+        kind, value = self.delay
+        if kind == "recorded":
+            t = record["t"] if record is not None else 0
+        elif kind == "rtf":
+            t = value * len(audio) / SAMPLING_RATE
+        else:
+            t = value
+        if t > 0:
+            time.sleep(t)
+
+    def transcribe(self, audio, init_prompt=""):
+        r = self.records.get(input_key(audio, init_prompt))
+        if r is not None:
+            self.hits += 1
+            words, ends = r["w"], r["s"]
+        else:
+            self.misses += 1
+            if self.misses == 1 or self.misses % 100 == 0:
+                logger.warning(f"{self.misses} transcribe inputs were not recorded, replaying the nearest recorded ones")
+            r = self._nearest(audio)
+            duration = len(audio) / SAMPLING_RATE
+            words = [w for w in r["w"] if w[1] <= duration] if r is not None else []
+            ends = [e for e in r["s"] if e <= duration] if r is not None else []
+        self._sleep(audio, r)
+        return [tuple(w) for w in words], list(ends)
+
+    def ts_words(self, res):
+        return res[0]
+
+    def segments_end_ts(self, res):
+        return res[1]
+
+    def use_vad(self):
+        # the recording was made with the backend options
+        pass
+
+    def set_translate_task(self):
+        pass
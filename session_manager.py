@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""Serving of several concurrent audio clients over one loaded ASR model.
+
+Every client connection gets its own online processor (OnlineASRProcessor or
+VACOnlineASRProcessor), so the stream state -- audio buffer, hypothesis and
+committed text -- is per connection, while the Whisper model behind them is
+loaded only once and shared.
+
+Every session belongs to a stream, named by the "STREAM <name>" header line
+of the connection or by the listening port (see audio_ingest.py). The
+servers can listen on several ports, e.g. one port per captioned channel.
+"""
+
+import itertools
+import logging
+import selectors
+import socket
+import threading
+import time
+
+import metrics
+from audio_ingest import receive_stream_header
+
+logger = logging.getLogger(__name__)
+
+
+def add_session_args(parser):
+    """options of serving several clients, shared by the servers
+    parser: argparse.ArgumentParser object
+    """
+    parser.add_argument("--max-sessions", type=int, default=4, dest="max_sessions",
+            help="Maximum number of concurrently served audio clients. All of them share one loaded Whisper model. The clients over the limit wait until a session ends.")
+    parser.add_argument("--batch-window", type=float, default=0.02, dest="batch_window",
+            help="Seconds to wait for the transcribe requests of other sessions, to run them as one batch. 0 disables the cross-stream batching. It is used only with --max-sessions > 1.")
+    parser.add_argument("--max-batch-size", type=int, default=8, dest="max_batch_size",
+            help="Maximum number of transcribe requests in one batch.")
+
+
+class Session:
+    '''One audio connection: the connection address, its stream and its own online processor.'''
+
+    def __init__(self, session_id, addr, online):
+        self.id = session_id
+        self.addr = addr
+        self.online = online
+        self.stream = str(session_id)  # set by the server from the connection
+        self.first_audio = b""  # the audio bytes received with the stream header
+        self.started = time.time()
+
+    def __repr__(self):
+        return f"Session({self.id}, {self.addr}, stream {self.stream})"
+
+    def set_stream(self, stream):
+        self.stream = stream
+        # the lines of the session in the shared --transcript-file, see whisper_online.TranscriptSink
+        sink = getattr(self.online, "transcript_sink", None)
+        if hasattr(sink, "label"):
+            sink.label = f"{stream}#{self.id}"
+
+
+class SessionManager:
+    '''It accepts up to max_sessions concurrent clients. Each client is served in its own thread
+    by handler(session, conn), with a fresh online processor from create_online().
+    The handler reads the audio from session.first_audio first, then from conn.
+    Clients over the limit wait in the listen backlog until a session ends.
+    '''
+
+    def __init__(self, create_online, max_sessions=4):
+        """create_online: callable without arguments, returns a new online processor over the shared ASR object.
+        max_sessions: the maximum number of concurrently served clients.
+        """
+        if max_sessions < 1:
+            raise ValueError("max_sessions must be at least 1")
+        self.create_online = create_online
+        self.max_sessions = max_sessions
+
+        self._slots = threading.BoundedSemaphore(max_sessions)
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self.sessions = {}
+
+    def open_session(self, addr=None, blocking=True):
+        """Reserves a session slot and creates the online processor for it.
+        Returns the new Session, or None if blocking is False and all the slots are taken.
+        """
+        if not self.reserve_slot(blocking):
+            return None
+        return self.open_reserved(addr)
+
+    def reserve_slot(self, blocking=True):
+        """Reserves a session slot for open_reserved. Returns False if blocking is False and all the slots are taken."""
+        return self._slots.acquire(blocking=blocking)
+
+    def open_reserved(self, addr=None):
+        """Creates the session in a slot reserved by reserve_slot. The slot is released on failure."""
+        try:
+            online = self.create_online()
+        except:
+            self._slots.release()
+            raise
+        session = Session(next(self._ids), addr, online)
+        with self._lock:
+            self.sessions[session.id] = session
+            n = len(self.sessions)
+        logger.info(f"{session} opened, {n}/{self.max_sessions} sessions active")
+        return session
+
+    def close_session(self, session):
+        with self._lock:
+            if self.sessions.pop(session.id, None) is None:
+                return
+            n = len(self.sessions)
+        self._slots.release()
+        metrics.remove_session(session.id)
+        logger.info(f"{session} closed after {time.time()-session.started:.1f} seconds, {n}/{self.max_sessions} sessions active")
+
+    def active_sessions(self):
+        with self._lock:
+            return len(self.sessions)
+
+    def _serve_client(self, conn, addr, handler):
+        # runs in the client thread, the slot is already reserved by the accept loop
+        session = None
+        try:
+            session = self.open_reserved(addr)
+            name, session.first_audio = receive_stream_header(conn)
+            session.set_stream(name if name is not None else str(conn.getsockname()[1]))
+            logger.info(f"{session} streams")
+            handler(session, conn)
+        except Exception as e:
+            logger.error(f"Error processing connection {addr}: {e}")
+        finally:
+            conn.close()
+            if session is not None:
+                self.close_session(session)
+            logger.info(f"Connection to client {addr} closed")
+
+    def serve(self, host, ports, handler):
+        """Runs the accept loop forever. Every client is handled in a new thread by handler(session, conn).
+        ports: a port or a list of ports to listen on, all of them share the sessions.
+        """
+        ports = [ports] if isinstance(ports, int) else list(ports)
+        with selectors.DefaultSelector() as selector:
+            listening = []
+            try:
+                for port in ports:
+                    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                    listening.append(s)
+                    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                    s.bind((host, port))
+                    s.listen(self.max_sessions)
+                    selector.register(s, selectors.EVENT_READ)
+                logger.info(f"Listening on {host} ports {', '.join(map(str, ports))}, serving up to {self.max_sessions} concurrent clients")
+                while True:
+                    # wait for a free slot; the clients over the limit wait in the listen backlog
+                    self._slots.acquire()
+                    try:
+                        key, _ = selector.select()[0]
+                        conn, addr = key.fileobj.accept()
+                    except:
+                        self._slots.release()
+                        raise
+                    logger.info(f"Connected to client on {addr}")
+                    t = threading.Thread(target=self._serve_client, args=(conn, addr, handler), daemon=True)
+                    t.start()
+            finally:
+                for s in listening:
+                    s.close()
@@ -98,26 +98,102 @@ class VADIterator:
 #######################
 # because Silero now requires exactly 512-sized audio chunks 
 
+import math
 import numpy as np
+from audio_buffer import AudioBuffer
+
 class FixedVADIterator(VADIterator):
     '''It fixes VADIterator by allowing to process any audio length, not only exactly 512 frames at once.
     If audio to be processed at once is long and multiple voiced segments detected, 
     then __call__ returns the start of the first segment, and end (or middle, which means no end) of the last segment. 
+
+    It gives the same results as calling VADIterator on every 512-sample window, but faster: 
+    the model runs on views of the buffered windows and its outputs are collected with one device sync per call,
+    and the start/end state machine jumps between the windows where the state can change instead of visiting every one.
+    The windows can't be passed to the model as one batch, the model would treat them as independent streams
+    instead of continuing its recurrent state from one window to the next.
     '''
 
+    WINDOW = 512
+
     def reset_states(self):
         super().reset_states()
-        self.buffer = np.array([],dtype=np.float32)
+        self.buffer = AudioBuffer(2*self.WINDOW)
+
+    def speech_probs(self, n):
+        """runs the model on the first n buffered windows, returns their speech probabilities as numpy array"""
+        windows = torch.from_numpy(self.buffer[:n*self.WINDOW]).view(n, self.WINDOW)
+        with torch.no_grad():
+            probs = [self.model(w, self.sampling_rate) for w in windows]
+        return torch.cat(probs).reshape(-1).cpu().numpy()
+
+    def _event(self, name, sample, return_seconds):
+        return {name: int(sample) if not return_seconds else round(sample / self.sampling_rate, 1)}
+
+    def detect(self, probs, return_seconds=False):
+        """Runs the VADIterator start/end logic over the speech probabilities of consecutive windows.
+        Returns the list of events, e.g. [{'start': 1200}, {'end': 9800}].
+        """
+        n = len(probs)
+        w = self.WINDOW
+        first_sample = self.current_sample + w  # current_sample after the first window
+        self.current_sample += n*w
+
+        high = np.flatnonzero(probs >= self.threshold)
+        low = np.flatnonzero(probs < self.threshold - 0.15)
+
+        def next_index(indices, k):
+            # the first index in indices that is >= k, or n
+            i = np.searchsorted(indices, k)
+            return indices[i] if i < len(indices) else n
+
+        events = []
+        k = 0
+        while k < n:
+            if not self.triggered:
+                k = next_index(high, k)
+                if k == n:
+                    break
+                self.triggered = True
+                self.temp_end = 0
+                events.append(self._event('start', first_sample + k*w - self.speech_pad_samples, return_seconds))
+                k += 1
+            elif not self.temp_end:
+                k = next_index(low, k)
+                if k == n:
+                    break
+                self.temp_end = first_sample + k*w
+                # the end check below applies already to this window
+            else:
+                # the silence is ended either by a speech window, or by a silent window that is late enough
+                late = max(k, math.ceil((self.temp_end + self.min_silence_samples - first_sample) / w))
+                end_k = next_index(low, late)
+                speech_k = next_index(high, k)
+                if end_k < speech_k:
+                    events.append(self._event('end', self.temp_end + self.speech_pad_samples, return_seconds))
+                    self.temp_end = 0
+                    self.triggered = False
+                    k = end_k + 1
+                elif speech_k < n:
+                    self.temp_end = 0
+                    k = speech_k + 1
+                else:
+                    break
+        return events
 
     def __call__(self, x, return_seconds=False):
-        self.buffer = np.append(self.buffer, x) 
+        self.buffer.append(x)
+        n = len(self.buffer) // self.WINDOW
+        if n == 0:
+            return None
+        probs = self.speech_probs(n)
+        self.buffer.trim(n*self.WINDOW)
+
         ret = None
-        while len(self.buffer) >= 512:
-            r = super().__call__(self.buffer[:512], return_seconds=return_seconds)
-            self.buffer = self.buffer[512:]
+        for r in self.detect(probs, return_seconds=return_seconds):
             if ret is None:
                 ret = r
-            elif r is not None:
+            else:
                 if 'end' in r:
                     ret['end'] = r['end']  # the latter end
                 if 'start' in r and 'end' in ret:  # there is an earlier start.
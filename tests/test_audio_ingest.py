@@ -0,0 +1,99 @@
+import socket
+import time
+
+import numpy as np
+import pytest
+
+from audio_ingest import AudioReceiver, PCMDecoder, parse_stream_header, receive_stream_header
+
+
+def pcm(n, seed=0):
+    samples = np.random.default_rng(seed).integers(-32768, 32768, n).astype("<i2")
+    return samples, samples.tobytes()
+
+
+@pytest.mark.parametrize("packet", [1, 2, 3, 7, 64, 1001])
+def test_decoder_splits_at_any_byte(packet):
+    samples, data = pcm(3000)
+    d = PCMDecoder(capacity=16)
+    out = []
+    for i in range(0, len(data), packet):
+        d.feed(data[i:i+packet])
+        out.append(d.take().copy())
+    decoded = np.concatenate(out)
+    assert decoded.dtype == np.float32
+    np.testing.assert_array_equal(decoded, samples.astype(np.float32) / 32768)
+    assert d.total_samples == len(samples)
+
+
+def test_decoder_keeps_the_odd_byte():
+    samples, data = pcm(2)
+    d = PCMDecoder()
+    d.feed(data[:3])
+    assert len(d) == 1
+    d.feed(memoryview(data)[3:])
+    assert len(d) == 2
+    np.testing.assert_array_equal(d.take(), samples.astype(np.float32) / 32768)
+    d.feed(b"")
+    assert len(d) == 0
+
+
+def test_decoder_reset_drops_the_odd_byte():
+    d = PCMDecoder()
+    d.feed(b"\x01")
+    d.reset()
+    d.feed(b"\x00\x40")
+    assert d.take().tolist() == [0.5]
+    assert d.total_samples == 1
+
+
+@pytest.mark.parametrize("data, expected", [
+    (b"STREAM studio-a\nPCM", ("studio-a", b"PCM")),
+    (b"STREAM  news.1 \n", ("news.1", b"")),
+    (b"STR", (None, None)),  # maybe a header, too short to tell
+    (b"", (None, None)),
+    (b"STREAM studio", (None, None)),  # the rest of the line is on the way
+    (b"\x01\x02STREAM x\n", (None, b"\x01\x02STREAM x\n")),  # audio
+    (b"STRx", (None, b"STRx")),
+    (b"STREAM a b\nPCM", (None, b"PCM")),  # an invalid name, the line is consumed
+    (b"STREAM " + b"x"*200, (None, b"STREAM " + b"x"*200)),  # no line end within MAX_HEADER, audio
+])
+def test_parse_stream_header(data, expected):
+    assert parse_stream_header(data) == expected
+
+
+def test_receive_stream_header_returns_the_first_audio():
+    a, b = socket.socketpair()
+    with a, b:
+        a.sendall(b"STREAM ch1\n\x01\x02")
+        assert receive_stream_header(b) == ("ch1", b"\x01\x02")
+        a.sendall(b"\x03\x04")
+        assert receive_stream_header(b) == (None, b"\x03\x04")
+
+
+def test_receive_stream_header_peer_closes_mid_header():
+    a, b = socket.socketpair()
+    with b:
+        with a:
+            a.sendall(b"STRE")
+        assert receive_stream_header(b, timeout=10) == (None, b"STRE")
+
+
+def test_receive_stream_header_times_out_mid_header():
+    a, b = socket.socketpair()
+    with a, b:
+        a.sendall(b"STREAM ch")
+        with pytest.raises(TimeoutError):
+            receive_stream_header(b, timeout=0.05)
+        assert b.gettimeout() is None
+
+
+def test_receiver_close_ends_a_blocked_thread():
+    # the client sends faster than the consumer takes, which stops early
+    r = AudioReceiver(lambda: bytes(3200), max_backlog=0.5, policy="block")
+    while r.backlog < 0.5:
+        time.sleep(0.01)
+    r.close()
+    r._thread.join(1)
+    assert not r._thread.is_alive()
+    assert r.get(1600) == (None, 0)
@@ -0,0 +1,137 @@
+import random
+
+import pytest
+
+from caption_layout import PROTOCOL_VERSION, CaptionLayout, CaptionLines, CaptionStreams, merge_ops
+
+
+def text_words(n, seed=0):
+    rnd = random.Random(seed)
+    return ["w" * rnd.randint(1, 12) + ("." if rnd.random() < 0.15 else "") for _ in range(n)]
+
+
+def replay(ops, max_lines):
+    # the lines as an overlay builds them from the operations
+    lines = [""]
+    for op in ops:
+        if op[0] == "append":
+            lines[-1] += op[1]
+        else:
+            lines.append("")
+    return lines[-max_lines:]
+
+
+@pytest.mark.parametrize("max_chars, min_chars, max_lines", [(20, 5, 2), (40, 40, 3), (150, 50, 1)])
+def test_ops_rebuild_the_lines(max_chars, min_chars, max_lines):
+    layout = CaptionLayout(max_chars=max_chars, min_chars=min_chars, max_lines=max_lines)
+    words = text_words(500)
+    ops = []
+    for k in range(0, len(words), 3):
+        ops += layout.add(words[k:k+3])
+        assert replay(ops, max_lines) == layout.lines()
+    assert len(layout.lines()) == max_lines
+    all_lines = replay(ops, len(ops) + 1)
+    assert " ".join(all_lines).split() == words
+    for line in all_lines:
+        assert len(line) <= max_chars
+
+
+def test_line_breaks():
+    layout = CaptionLayout(max_chars=20, min_chars=10, max_lines=2)
+    # a short sentence doesn't break the line
+    assert layout.add(["Hi.", "there"]) == [["append", "Hi. there"]]
+    # a long enough one does
+    assert layout.add(["friend."]) == [["append", " friend."]]
+    assert layout.add(["Next", "one"]) == [["roll"], ["append", "Next one"]]
+    # over max_chars
+    assert layout.add(["abcdefghijkl"]) == [["roll"], ["append", "abcdefghijkl"]]
+    assert layout.lines() == ["Next one", "abcdefghijkl"]
+
+
+def test_long_word_gets_its_own_line():
+    layout = CaptionLayout(max_chars=5, min_chars=5, max_lines=3)
+    assert layout.add(["ab", "abcdefgh", "c", ""]) == [["append", "ab"], ["roll"], ["append", "abcdefgh"], ["roll"], ["append", "c"]]
+
+
+def test_invalid_sizes():
+    with pytest.raises(ValueError):
+        CaptionLayout(max_chars=0)
+    with pytest.raises(ValueError):
+        CaptionLayout(max_lines=0)
+
+
+def test_merge_ops():
+    assert merge_ops([["append", "a"]], [["append", " b"], ["roll"], ["append", "c"]]) == [["append", "a b"], ["roll"], ["append", "c"]]
+    ops = [["append", "a"]]
+    merge_ops(ops, [["append", "b"]])
+    assert ops == [["append", "a"]]
+
+
+def test_caption_lines_deltas_and_snapshot():
+    lines = CaptionLines("s", max_lines=2)
+    assert lines.apply([["append", "a b"]])["seq"] == 1
+    delta = lines.apply([["roll"], ["append", "c"], ["roll"], ["append", "d"]])
+    assert delta == {"type": "delta", "v": PROTOCOL_VERSION, "stream": "s", "seq": 2,
+                     "ops": [["roll"], ["append", "c"], ["roll"], ["append", "d"]]}
+    lines.apply([["append", "e"]])
+    assert lines.snapshot() == {"type": "snapshot", "v": PROTOCOL_VERSION, "stream": "s", "seq": 3, "lines": ["c", "de"]}
+    with pytest.raises(ValueError):
+        lines.apply([["unknown"]])
+
+
+def test_merged_deltas_give_the_same_lines():
+    layout = CaptionLayout(max_chars=20, min_chars=5, max_lines=2)
+    each, merged = CaptionLines("s", 2), CaptionLines("s", 2)
+    pending = []
+    for k, words in enumerate(text_words(300)):
+        ops = layout.add([words])
+        each.apply(ops)
+        pending = merge_ops(pending, ops)
+        if k % 7 == 0:
+            merged.apply(pending)
+            pending = []
+            assert merged.snapshot()["lines"] == each.snapshot()["lines"] == layout.lines()
+
+
+def test_caption_streams():
+    streams = CaptionStreams(max_lines=2, capacity=2)
+    streams.apply("a", [["append", "x"]])
+    streams.apply("b", [["append", "y"]])
+    assert streams.snapshot()["stream"] == "b"
+    assert streams.snapshot("a")["lines"] == ["x"]
+    # an unknown stream has no lines
+    assert streams.snapshot("c") == {"type": "snapshot", "v": PROTOCOL_VERSION, "stream": "c", "seq": 0, "lines": []}
+    streams.apply("c", [["append", "z"]])
+    # the least recently updated stream is dropped
+    assert streams.keys() == ["b", "c"]
+    # a dropped stream that comes back doesn't repeat its sequence numbers
+    assert streams.apply("a", [["append", "w"]])["seq"] == 3
+    assert streams.snapshot("a")["lines"] == ["w"]
+
+
+def test_transcript_paging():
+    lines = CaptionLines("s", max_lines=2, history=5)
+    for i in range(8):
+        lines.apply([["append", "l%d" % i], ["roll"]])
+    # the lines 0-7 are completed, the ring keeps 3-7
+    page = lines.transcript(limit=2)
+    assert (page["completed"], page["first"]) == (8, 3)
+    assert [l["n"] for l in page["lines"]] == [3, 4]
+    assert page["next"] == 4
+    page = lines.transcript(after=page["next"], limit=2)
+    assert [l["text"] for l in page["lines"]] == ["l5", "l6"]
+    page = lines.transcript(after=page["next"], limit=2)
+    assert [l["text"] for l in page["lines"]] == ["l7"]
+    assert page["next"] is None
+    assert page["current"] == ["l7", ""]
+    assert lines.transcript(after=7)["lines"] == []
+    assert [h[0] for h in lines.snapshot(history=True)["history"]] == [3, 4, 5, 6, 7]
+
+
+def test_transcript_of_streams():
+    streams = CaptionStreams(history=10)
+    assert streams.transcript("a") is None
+    streams.apply("a", [["append", "x"], ["roll"]])
+    page = streams.transcript("a")
+    assert page["stream"] == "a"
+    assert [l["text"] for l in page["lines"]] == ["x"]
@@ -0,0 +1,69 @@
+import io
+
+import pytest
+
+from whisper_online import CommittedHistory, TranscriptSink
+
+
+def words(n, start=0.0):
+    # a word every 0.5 s, of varying length
+    return [(start + 0.5*i, start + 0.5*i + 0.4, "w%d%s" % (i, "x"*(i % 7))) for i in range(n)]
+
+
+@pytest.mark.parametrize("sep", ["", " "])
+def test_trim_keeps_the_prompt(sep):
+    ws = words(400)
+    full = CommittedHistory()
+    trimmed = CommittedHistory()
+    for k in range(0, len(ws), 10):
+        full.extend(ws[k:k+10])
+        trimmed.extend(ws[k:k+10])
+        # the audio buffer starts a few words before the last committed one
+        time = ws[max(0, k-5)][1]
+        trimmed.trim(time)
+        assert trimmed.prompt(time, sep) == full.prompt(time, sep)
+    assert trimmed.dropped > 0
+    assert len(trimmed) + trimmed.dropped == len(full)
+    assert len(trimmed) < 100
+
+
+def test_prompt_is_limited():
+    h = CommittedHistory()
+    h.extend(words(100))
+    prompt, context = h.prompt(h[60][1], " ")
+    assert len(prompt) <= CommittedHistory.PROMPT_CHARS + len(max(h.texts, key=len)) + 1
+    assert prompt.split()[-1] == h.texts[60]
+    assert context.split()[0] == h.texts[61]
+
+
+def test_split_index_keeps_the_last_word():
+    h = CommittedHistory()
+    h.extend(words(3))
+    assert h.split_index(100.0) == 2
+    assert h.split_index(0.0) == 0
+
+
+def test_sink_gets_every_word_once():
+    sink = io.StringIO()
+    ws = words(300)
+    h = CommittedHistory(sink=sink)
+    for k in range(0, len(ws), 7):
+        h.extend(ws[k:k+7])
+        h.trim(ws[k][0])
+    h.spill()
+    h.spill()
+    lines = sink.getvalue().splitlines()
+    assert lines == ["%1.0f %1.0f %s" % (b*1000, e*1000, t) for b, e, t in ws]
+
+
+def test_shared_sink_labels_the_sessions():
+    f = io.StringIO()
+    shared = TranscriptSink(f)
+    a, b = shared.writer(), shared.writer()
+    a.label = "studio#1"
+    ha, hb = CommittedHistory(sink=a), CommittedHistory(sink=b)
+    ha.extend(words(2))
+    hb.extend(words(1, start=10.0))
+    ha.spill()
+    hb.spill()
+    assert f.getvalue().splitlines() == ["studio#1 0 400 w0", "studio#1 500 900 w1x", "10000 10400 w0"]
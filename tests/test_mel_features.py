@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+
+feature_extractor = pytest.importorskip("faster_whisper.feature_extractor")
+
+from audio_buffer import AudioBuffer
+from mel_features import LogMelCache
+
+
+def test_cache_matches_feature_extractor():
+    fe = feature_extractor.FeatureExtractor()
+    rng = np.random.default_rng(0)
+    audio = (0.1*rng.standard_normal(16000*60)).astype(np.float32)
+    buffer = AudioBuffer()
+    cache = LogMelCache(fe)
+    pos = 0
+    while pos < len(audio):
+        n = int(rng.integers(100, 16000))
+        buffer.append(audio[pos:pos+n])
+        pos += n
+        if len(buffer) > 16000*12 or rng.random() < 0.05:
+            k = int(rng.integers(0, len(buffer)//2))
+            # mostly at a frame boundary, where the frames are kept
+            if rng.random() < 0.7:
+                k -= k % fe.hop_length
+            buffer.trim(k)
+            cache.trim(k)
+        expected = fe(buffer.view())
+        features = cache.features(buffer.view())
+        assert features.shape == expected.shape
+        np.testing.assert_allclose(features, expected, atol=1e-5)
@@ -0,0 +1,60 @@
+import re
+
+from whisper_online import CommittedHistory, SentenceSegmenter, sentence_spans
+
+
+class DotTokenizer:
+    # splits after ".", like MosesTokenizer.split
+
+    def split(self, text):
+        return [s for s in re.split(r"(?<=\.)\s+", text) if s]
+
+
+def words(n):
+    return [(0.5*i, 0.5*i + 0.4, "w%d%s" % (i, "." if i % 6 == 5 else "")) for i in range(n)]
+
+
+def full_sentences(ws):
+    spans = sentence_spans(ws, DotTokenizer().split(" ".join(w[2] for w in ws)))
+    return [(ws[i][0], ws[j][1], s) for i, j, s in spans]
+
+
+def test_incremental_equals_full_segmentation():
+    ws = words(100)
+    h = CommittedHistory()
+    seg = SentenceSegmenter(DotTokenizer())
+    for k in range(0, len(ws), 4):
+        h.extend(ws[k:k+4])
+        assert seg.sentences(h) == full_sentences(ws[:k+4])
+    # only the open sentence is segmented again
+    assert seg.tail_start == 96
+
+
+def test_trimmed_history_keeps_the_last_dropped_sentence():
+    ws = words(120)
+    h = CommittedHistory()
+    seg = SentenceSegmenter(DotTokenizer())
+    for k in range(0, len(ws), 5):
+        h.extend(ws[k:k+5])
+        out = seg.sentences(h)
+        full = full_sentences(ws[:k+5])
+        assert out == full[len(full)-len(out):]
+        h.trim(ws[max(0, k-20)][1])
+    assert h.dropped > 0
+    # only the sentences with words in the history are kept, and the one before them
+    assert all(last >= h.dropped for _, last, *_ in list(seg.complete)[1:])
+
+
+def test_tail_without_sentence_end_is_capped():
+    ws = [(0.5*i, 0.5*i + 0.4, "w%d" % i) for i in range(SentenceSegmenter.MAX_TAIL_WORDS + 50)]
+    h = CommittedHistory()
+    h.extend(ws)
+    out = SentenceSegmenter(DotTokenizer()).sentences(h)
+    assert len(out) == 1
+    assert len(out[0][2].split()) == SentenceSegmenter.MAX_TAIL_WORDS
+    assert out[0][1] == ws[-1][1]
+
+
+def test_sentence_spans():
+    ws = [(0, 1, "Hello"), (1, 2, "world."), (2, 3, "Bye.")]
+    assert sentence_spans(ws, ["Hello world.", "Bye."]) == [(0, 1, "Hello world."), (2, 2, "Bye.")]
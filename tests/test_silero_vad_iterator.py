@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from silero_vad_iterator import FixedVADIterator, VADIterator
+
+
+class ProbModel:
+    # replays the given speech probabilities instead of the silero model
+    def __init__(self, probs=()):
+        self.probs = iter(probs)
+
+    def reset_states(self):
+        pass
+
+    def __call__(self, x, sampling_rate):
+        return torch.tensor([next(self.probs)])
+
+
+def random_probs(rng):
+    # runs of probabilities around the start (0.5) and the end (0.35) thresholds, long enough for the silences
+    levels = [0.05, 0.34, 0.35, 0.4, 0.49, 0.5, 0.9]
+    runs = [np.full(rng.integers(1, 30), rng.choice(levels)) for _ in range(rng.integers(1, 12))]
+    return np.concatenate(runs)
+
+
+def test_detect_matches_per_window_iterator():
+    rng = np.random.default_rng(0)
+    window = torch.zeros(FixedVADIterator.WINDOW)
+    for _ in range(3000):
+        probs = random_probs(rng)
+        options = dict(min_silence_duration_ms=int(rng.choice([0, 100, 500, 510])), speech_pad_ms=int(rng.choice([0, 30, 100])))
+        reference = VADIterator(ProbModel(probs), **options)
+        expected = [e for e in (reference(window) for _ in probs) if e is not None]
+
+        fixed = FixedVADIterator(ProbModel(), **options)
+        events = []
+        # the state continues over the calls
+        cuts = np.sort(rng.integers(0, len(probs) + 1, size=3))
+        for a, b in zip([0, *cuts], [*cuts, len(probs)]):
+            events += fixed.detect(probs[a:b])
+        assert events == expected
+        assert (fixed.triggered, fixed.temp_end, fixed.current_sample) == (reference.triggered, reference.temp_end, reference.current_sample)
@@ -9,6 +9,14 @@ import logging
 import io
 import soundfile as sf
 import math
+import bisect
+import threading
+from collections import deque
+
+from audio_buffer import AudioBuffer
+from mel_features import LogMelCache, PrecomputedFeatureExtractor
+from chunk_controller import add_chunk_controller_args, create_chunk_controller
+from metrics import stage
 
 logger = logging.getLogger(__name__)
 
@@ -31,6 +39,8 @@ class ASRBase:
     sep = " "   # join transcribe words with this character (" " for whisper_timestamped,
                 # "" for faster-whisper because it emits the spaces when neeeded)
 
+    accepts_features = False  # transcribe() can take the precomputed log-mel features of the audio, see feature_cache()
+
     def __init__(self, lan, modelsize=None, cache_dir=None, model_dir=None, logfile=sys.stderr, show_timestamps=True):
         self.logfile = logfile
         self.show_timestamps = show_timestamps
@@ -50,6 +60,21 @@ class ASRBase:
     def transcribe(self, audio, init_prompt=""):
         raise NotImplemented("must be implemented in the child class")
 
+    def transcribe_batch(self, audios, init_prompts, features=None):
+        """Transcribes several independent audios (e.g. from several streams, see batch_scheduler.py).
+        Returns the list of transcribe results in the same order.
+        features: None, or the list of the precomputed features (or None) of the audios, if accepts_features.
+        This default runs them one by one. A child class can override it and batch them on the device.
+        """
+        if features is None:
+            features = [None]*len(audios)
+        return [self.transcribe(a, init_prompt=p) if f is None else self.transcribe(a, init_prompt=p, features=f)
+                for a, p, f in zip(audios, init_prompts, features)]
+
+    def feature_cache(self):
+        """a new LogMelCache for one stream, if accepts_features"""
+        raise NotImplemented("must be implemented in the child class")
+
     def use_vad(self):
         raise NotImplemented("must be implemented in the child class")
 
@@ -98,12 +123,45 @@ class WhisperTimestampedASR(ASRBase):
 
 
 
+# FasterWhisperASR.transcribe_batch uses private methods of this faster-whisper version
+FASTER_WHISPER_BATCH_VERSION = "1.2.1"
+
 class FasterWhisperASR(ASRBase):
     """Uses faster-whisper library as the backend. Works much faster, appx 4-times (in offline mode). For GPU, it requires installation with a specific CUDNN version.
     """
 
     sep = ""
 
+    # tested: beam_size=5 is faster and better than 1 (on one 200 second document from En ESIC, min chunk 0.01)
+    beam_size = 5
+
+    accepts_features = True
+
+    def __init__(self, *a, device="auto", compute_type="auto", cpu_threads=0, num_workers=1, **kw):
+        """device: "cuda", "cpu", or "auto": CUDA if a CUDA device is available, otherwise CPU.
+        compute_type: CTranslate2 compute type, "auto" is float16 on CUDA and int8 on CPU.
+        cpu_threads: number of CPU threads of the model, 0 is the CTranslate2 default.
+        num_workers: number of model workers, to transcribe in parallel from several threads (e.g. several sessions without batching).
+        """
+        self.device, self.compute_type = self.resolve_device(device, compute_type)
+        self.cpu_threads = cpu_threads
+        self.num_workers = num_workers
+        super().__init__(*a, **kw)
+
+    @staticmethod
+    def resolve_device(device="auto", compute_type="auto"):
+        """Returns the (device, compute_type) pair with the "auto" values chosen."""
+        if device == "auto":
+            import ctranslate2
+            device = "cuda" if ctranslate2.get_cuda_device_count() > 0 else "cpu"
+            logger.info(f"Using {device} for faster-whisper.")
+        if compute_type == "auto":
+            # tested: float16 worked fast and reliably on NVIDIA L40. On GPU, int8_float16 gave different,
+            # probably worse transcripts, and it was slightly (appx 20%) slower.
+            # int8 is the fastest on CPU.
+            compute_type = "float16" if device == "cuda" else "int8"
+        return device, compute_type
+
     def load_model(self, modelsize=None, cache_dir=None, model_dir=None):
         from faster_whisper import WhisperModel
 #        logging.getLogger("faster_whisper").setLevel(logger.level)
@@ -116,26 +174,145 @@ class FasterWhisperASR(ASRBase):
             raise ValueError("modelsize or model_dir parameter must be set")
 
 
-        # this worked fast and reliably on NVIDIA L40
-        model = WhisperModel(model_size_or_path, device="cuda", compute_type="float16", download_root=cache_dir)
-
-        # or run on GPU with INT8
-        # tested: the transcripts were different, probably worse than with FP16, and it was slightly (appx 20%) slower
-        #model = WhisperModel(model_size, device="cuda", compute_type="int8_float16")
+        logger.debug(f"faster-whisper on {self.device} with {self.compute_type}, cpu_threads={self.cpu_threads}, num_workers={self.num_workers}")
+        # tested on CPU with INT8: works, but slow, appx 10-times than cuda FP16
+        model = WhisperModel(model_size_or_path, device=self.device, compute_type=self.compute_type, 
+                             cpu_threads=self.cpu_threads, num_workers=self.num_workers, download_root=cache_dir)
 
-        # or run on CPU with INT8
-        # tested: works, but slow, appx 10-times than cuda FP16
-#        model = WhisperModel(modelsize, device="cpu", compute_type="int8") #, download_root="faster-disk-cache-dir/")
+        # transcribe() passes the features from the online processor's LogMelCache through it
+        model.feature_extractor = PrecomputedFeatureExtractor(model.feature_extractor)
         return model
 
-    def transcribe(self, audio, init_prompt=""):
+    def feature_cache(self):
+        return LogMelCache(self.model.feature_extractor.feature_extractor)
 
-        # tested: beam_size=5 is faster and better than 1 (on one 200 second document from En ESIC, min chunk 0.01)
-        segments, info = self.model.transcribe(audio, language=self.original_language, initial_prompt=init_prompt, beam_size=5, word_timestamps=True, condition_on_previous_text=True, **self.transcribe_kargs)
+    def transcribe(self, audio, init_prompt="", features=None):
+        """features: optional log-mel spectrogram of audio, from feature_cache()"""
+        with self.model.feature_extractor.precomputed(audio, features):
+            segments, info = self.model.transcribe(audio, language=self.original_language, initial_prompt=init_prompt, beam_size=self.beam_size, word_timestamps=True, condition_on_previous_text=True, **self.transcribe_kargs)
         #print(info)  # info contains language detection result
 
         return list(segments)
 
+    def transcribe_batch(self, audios, init_prompts, features=None):
+        """Encodes and decodes the audios of several streams together, in padded batches.
+        It follows faster-whisper's WhisperModel.generate_segments with the options used in transcribe(). 
+        It uses private methods of faster-whisper, see FASTER_WHISPER_BATCH_VERSION.
+        A stream whose window is too repetitive or improbable for temperature 0 (the thresholds of transcribe()) 
+        is transcribed again by transcribe(), with its temperature fallback, so the text is the same as unbatched.
+        Falls back to one-by-one transcription when batching doesn't apply: a single audio, language detection, 
+        VAD filter (it would cut every audio differently), or a faster-whisper without the private methods.
+        """
+        if (len(audios) < 2 or self.original_language is None or self.transcribe_kargs.get("vad_filter")
+                or not self._batch_supported()):
+            return super().transcribe_batch(audios, init_prompts, features)
+        if features is None:
+            features = [None]*len(audios)
+        compression_ratio_threshold = self.transcribe_kargs.get("compression_ratio_threshold", 2.4)
+        log_prob_threshold = self.transcribe_kargs.get("log_prob_threshold", -1.0)
+
+        from faster_whisper.audio import pad_or_trim
+        from faster_whisper.tokenizer import Tokenizer
+        from faster_whisper.transcribe import Segment, Word, get_suppressed_tokens, get_compression_ratio
+        from faster_whisper.utils import get_end
+
+        model = self.model
+        fe = model.feature_extractor
+        tokenizer = Tokenizer(model.hf_tokenizer, model.model.is_multilingual, 
+                              task=self.transcribe_kargs.get("task", "transcribe"), language=self.original_language)
+        suppress_tokens = get_suppressed_tokens(tokenizer, [-1])
+        max_initial_timestamp_index = int(round(1.0 / model.time_precision))
+
+        class Stream:
+            def __init__(self, audio, init_prompt, features):
+                self.audio, self.init_prompt, self.given_features = audio, init_prompt, features
+                self.fallback = False  # transcribed by transcribe()
+                self.features = fe(audio) if features is None else features
+                self.content_frames = self.features.shape[-1] - 1
+                self.seek = 0
+                # the same as generate_segments does with a string initial_prompt
+                self.all_tokens = tokenizer.encode(" " + init_prompt.strip())
+                self.segments = []
+                self.last_speech_timestamp = 0.0
+
+        streams = [Stream(a, p, f) for a, p, f in zip(audios, init_prompts, features)]
+        # every round decodes the next 30-second window of all the unfinished streams
+        active = [st for st in streams if st.seek < st.content_frames]
+        while active:
+            sizes = [min(fe.nb_max_frames, st.content_frames - st.seek) for st in active]
+            batch = np.stack([pad_or_trim(st.features[:, st.seek:st.seek + n]) for st, n in zip(active, sizes)])
+            encoder_output = model.encode(batch)
+            prompts = [model.get_prompt(tokenizer, st.all_tokens) for st in active]
+            results = model.model.generate(encoder_output, prompts, 
+                    beam_size=self.beam_size, patience=1, length_penalty=1, max_length=model.max_length,
+                    return_scores=True, return_no_speech_prob=True, 
+                    suppress_blank=True, suppress_tokens=suppress_tokens, 
+                    max_initial_timestamp_index=max_initial_timestamp_index)
+
+            decoded = []  # (stream, window size, result, avg_logprob, current segments, single timestamp ending)
+            for st, n, result in zip(active, sizes, results):
+                tokens = result.sequences_ids[0]
+                avg_logprob = result.scores[0] * len(tokens) / (len(tokens) + 1)
+                if result.no_speech_prob > 0.6 and avg_logprob <= -1.0:
+                    # no voice activity, fast-forward to the next window
+                    st.seek += n
+                    continue
+                if ((compression_ratio_threshold is not None and get_compression_ratio(tokenizer.decode(tokens).strip()) > compression_ratio_threshold)
+                        or (log_prob_threshold is not None and avg_logprob < log_prob_threshold)):
+                    # transcribe() would decode it again with a higher temperature
+                    st.fallback = True
+                    continue
+                time_offset = st.seek * fe.time_per_frame
+                current, seek, single = model._split_segments_by_timestamps(tokenizer=tokenizer, tokens=tokens, 
+                        time_offset=time_offset, segment_size=n, segment_duration=n * fe.time_per_frame, seek=st.seek)
+                decoded.append((st, n, result, avg_logprob, current, single))
+                st.window_seek, st.seek = st.seek, seek
+
+            if decoded:
+                if len(decoded) == len(active):
+                    align_output = encoder_output
+                else:
+                    # the alignment needs the encoder output of exactly the decoded windows
+                    align_output = model.encode(np.stack([pad_or_trim(st.features[:, st.window_seek:st.window_seek + n]) for st, n, *_ in decoded]))
+                # Note: the last speech timestamp is carried from one stream to the next one here, while
+                # generate_segments carries it within one stream. It only affects a heuristic that shortens the first word after a pause.
+                model.add_word_timestamps([d[4] for d in decoded], tokenizer, align_output, [d[1] for d in decoded], 
+                        "\"'“¿([{-", "\"'.。,，!！?？:：”)]}、", last_speech_timestamp=decoded[0][0].last_speech_timestamp)
+
+            for st, n, result, avg_logprob, current, single in decoded:
+                if not single:
+                    last_word_end = get_end(current)
+                    if last_word_end is not None and last_word_end > st.window_seek * fe.time_per_frame:
+                        st.seek = round(last_word_end * model.frames_per_second)
+                last_word_end = get_end(current)
+                if last_word_end is not None:
+                    st.last_speech_timestamp = last_word_end
+                for segment in current:
+                    text = tokenizer.decode(segment["tokens"])
+                    if segment["start"] == segment["end"] or not text.strip():
+                        continue
+                    st.all_tokens.extend(segment["tokens"])
+                    st.segments.append(Segment(id=len(st.segments)+1, seek=st.window_seek, 
+                            start=segment["start"], end=segment["end"], text=text, tokens=segment["tokens"], 
+                            temperature=0.0, avg_logprob=avg_logprob, compression_ratio=get_compression_ratio(text.strip()),
+                            no_speech_prob=result.no_speech_prob, words=[Word(**w) for w in segment["words"]]))
+
+            active = [st for st in active if st.seek < st.content_frames and not st.fallback]
+
+        for st in streams:
+            if st.fallback:
+                st.segments = self.transcribe(st.audio, st.init_prompt, st.given_features)
+        return [st.segments for st in streams]
+
+    def _batch_supported(self):
+        if not hasattr(self, "_batch_checked"):
+            self._batch_checked = all(hasattr(self.model, m) for m in ("_split_segments_by_timestamps", "add_word_timestamps", "get_prompt", "encode"))
+            if not self._batch_checked:
+                import faster_whisper
+                logger.warning(f"faster-whisper {faster_whisper.__version__} doesn't have the methods of the batched transcription "
+                               f"(written for {FASTER_WHISPER_BATCH_VERSION}), the sessions are transcribed one by one")
+        return self._batch_checked
+
     def ts_words(self, segments):
         o = []
         for segment in segments:
@@ -153,6 +330,8 @@ class FasterWhisperASR(ASRBase):
 
     def use_vad(self):
         self.transcribe_kargs["vad_filter"] = True
+        # the VAD filter cuts the audio, the features of the whole buffer are not usable
+        self.accepts_features = False
 
     def set_translate_task(self):
         self.transcribe_kargs["task"] = "translate"
@@ -359,86 +538,250 @@ class OpenaiApiASR(ASRBase):
 
 
 class HypothesisBuffer:
+    """Keeps the unconfirmed hypothesis and commits its prefix on which the last two transcriptions agree (LocalAgreement-2).
+
+    The words are (beg, end, "text") tuples. Every text is also interned to an integer ID, 
+    so that the words of the hypotheses and of the commited n-grams are compared as integers, without joining strings.
+    The commited words in the buffer are in deques, to pop them from the beginning in O(1).
+    """
 
     def __init__(self, logfile=sys.stderr):
-        self.commited_in_buffer = []
+        self.commited_in_buffer = deque()
+        self.commited_ids = deque()
         self.buffer = []
+        self.buffer_ids = []
         self.new = []
+        self.new_ids = []
 
         self.last_commited_time = 0
         self.last_commited_word = None
 
+        self.word_ids = {}
+
         self.logfile = logfile
 
+    def word_id(self, text):
+        i = self.word_ids.get(text)
+        if i is None:
+            i = self.word_ids[text] = len(self.word_ids)
+        return i
+
     def insert(self, new, offset):
         # compare self.commited_in_buffer and new. It inserts only the words in new that extend the commited_in_buffer, it means they are roughly behind last_commited_time and new in content
         # the new tail is added to self.new
         
-        new = [(a+offset,b+offset,t) for a,b,t in new]
-        self.new = [(a,b,t) for a,b,t in new if a > self.last_commited_time-0.1]
+        min_beg = self.last_commited_time-0.1
+        self.new = [(a+offset,b+offset,t) for a,b,t in new if a+offset > min_beg]
+        self.new_ids = [self.word_id(t) for _,_,t in self.new]
 
         if len(self.new) >= 1:
             a,b,t = self.new[0]
             if abs(a - self.last_commited_time) < 1:
                 if self.commited_in_buffer:
                     # it's going to search for 1, 2, ..., 5 consecutive words (n-grams) that are identical in commited and new. If they are, they're dropped.
-                    cn = len(self.commited_in_buffer)
-                    nn = len(self.new)
+                    cn = len(self.commited_ids)
+                    nn = len(self.new_ids)
                     for i in range(1,min(min(cn,nn),5)+1):  # 5 is the maximum 
-                        c = " ".join([self.commited_in_buffer[-j][2] for j in range(1,i+1)][::-1])
-                        tail = " ".join(self.new[j-1][2] for j in range(1,i+1))
-                        if c == tail:
-                            words = []
-                            for j in range(i):
-                                words.append(repr(self.new.pop(0)))
-                            words_msg = " ".join(words)
+                        if all(self.commited_ids[cn-i+j] == self.new_ids[j] for j in range(i)):
+                            words_msg = " ".join(repr(w) for w in self.new[:i])
+                            del self.new[:i]
+                            del self.new_ids[:i]
                             logger.debug(f"removing last {i} words: {words_msg}")
                             break
 
     def flush(self):
         # returns commited chunk = the longest common prefix of 2 last inserts. 
 
-        commit = []
-        while self.new:
-            na, nb, nt = self.new[0]
-
-            if len(self.buffer) == 0:
-                break
+        k = 0
+        n = min(len(self.new_ids), len(self.buffer_ids))
+        while k < n and self.new_ids[k] == self.buffer_ids[k]:
+            k += 1
+        commit = self.new[:k]
+        if commit:
+            _, self.last_commited_time, self.last_commited_word = commit[-1]
+        self.commited_in_buffer.extend(commit)
+        self.commited_ids.extend(self.new_ids[:k])
 
-            if nt == self.buffer[0][2]:
-                commit.append((na,nb,nt))
-                self.last_commited_word = nt
-                self.last_commited_time = nb
-                self.buffer.pop(0)
-                self.new.pop(0)
-            else:
-                break
-        self.buffer = self.new
+        self.buffer = self.new[k:]
+        self.buffer_ids = self.new_ids[k:]
         self.new = []
-        self.commited_in_buffer.extend(commit)
+        self.new_ids = []
         return commit
 
     def pop_commited(self, time):
         while self.commited_in_buffer and self.commited_in_buffer[0][1] <= time:
-            self.commited_in_buffer.pop(0)
+            self.commited_in_buffer.popleft()
+            self.commited_ids.popleft()
 
     def complete(self):
         return self.buffer
 
+class CommittedHistory:
+    """The committed words of one stream, as parallel lists of begin and end timestamps and texts, in time order.
+
+    It keeps only the words that are needed later: the ones that end after the start of the audio buffer 
+    (the context), and the words of the 200-character prompt before them. The older words are dropped by trim(), 
+    after they are written to the optional transcript sink, so the memory and the cost of prompt() don't grow with the session length.
+    """
+
+    PROMPT_CHARS = 200
+
+    def __init__(self, sink=None):
+        """sink: a file-like object. Every committed word is appended to it as "beg end text" line, 
+        with the timestamps in milliseconds, at latest when it is dropped from memory.
+        """
+        self.begs = []
+        self.ends = []
+        self.texts = []
+        self.sink = sink
+        self.written = 0  # number of the kept words that are already written to the sink
+        self.dropped = 0  # number of the words dropped from the beginning
+
+    def __len__(self):
+        return len(self.texts)
+
+    def __getitem__(self, i):
+        return (self.begs[i], self.ends[i], self.texts[i])
+
+    def __iter__(self):
+        return zip(self.begs, self.ends, self.texts)
+
+    def __repr__(self):
+        return repr(list(self))
+
+    def extend(self, words):
+        for b, e, t in words:
+            self.begs.append(b)
+            self.ends.append(e)
+            self.texts.append(t)
+
+    def split_index(self, time):
+        """Index of the first word in the context of the audio buffer that starts at time. 
+        The words before it are for the prompt. The last word is always in the context.
+        """
+        return min(max(0, len(self.texts)-1), bisect.bisect_right(self.ends, time))
+
+    def prompt_start(self, k):
+        """index of the first prompt word, when the prompt ends before the word k"""
+        l = 0
+        while k > 0 and l < self.PROMPT_CHARS:
+            k -= 1
+            l += len(self.texts[k])+1
+        return k
+
+    def prompt(self, time, sep):
+        """Returns a tuple: (prompt, context), see OnlineASRProcessor.prompt"""
+        k = self.split_index(time)
+        p = self.prompt_start(k)
+        return sep.join(self.texts[p:k]), sep.join(self.texts[k:])
+
+    def trim(self, time):
+        """drops the words that are not needed anymore for the prompt, when the audio buffer starts at time"""
+        p = self.prompt_start(self.split_index(time))
+        if p == 0:
+            return
+        self.spill(p)
+        del self.begs[:p]
+        del self.ends[:p]
+        del self.texts[:p]
+        self.written -= p
+        self.dropped += p
+
+    def spill(self, n=None):
+        """writes the first n (default all) words to the sink, if they are not written yet"""
+        if n is None:
+            n = len(self.texts)
+        if self.sink is not None and n > self.written:
+            self.sink.write("".join("%1.0f %1.0f %s\n" % (self.begs[i]*1000, self.ends[i]*1000, self.texts[i].strip()) for i in range(self.written, n)))
+            self.sink.flush()
+        self.written = max(self.written, n)
+
+
+def sentence_spans(words, sents):
+    """Aligns the sentences from tokenizer.split with the timestamped words [(beg,end,"word"),...] they were joined from.
+    Returns [(i, j, "sentence"),...], where words[i] and words[j] are the first and the last word of the sentence.
+    i is None if the sentence doesn't start with a word.
+    """
+    out = []
+    k = 0
+    for sent in sents:
+        sent = sent.strip()
+        fsent = sent
+        first = None
+        while k < len(words):
+            w = words[k][2].strip()
+            k += 1
+            if first is None and sent.startswith(w):
+                first = k-1
+            if sent == w:
+                out.append((first, k-1, fsent))
+                break
+            sent = sent[len(w):].strip()
+    return out
+
+
+class SentenceSegmenter:
+    """Incremental sentence segmentation of the committed words, for the "sentence" buffer trimming.
+
+    A sentence that is followed by another one is complete. The complete sentences are cached with 
+    the stream indices of their words, and only the words after the last complete sentence (the tail) 
+    are segmented again by the tokenizer when new words are committed. The tail is capped at MAX_TAIL_WORDS, 
+    so a long text without any sentence end doesn't make every call slower.
+    """
+
+    MAX_TAIL_WORDS = 200
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.reset()
+
+    def reset(self):
+        self.complete = deque()  # (first, last, beg, end, "sentence"), first and last are stream word indices
+        self.tail_start = 0  # stream index of the first word after the last complete sentence
+
+    def sentences(self, history):
+        """Segments the words of history (CommittedHistory) that are new since the last call.
+        Returns the kept complete sentences and the open one at the end: [(beg,end,"sentence"),...]
+        """
+        n = history.dropped + len(history)
+        start = max(self.tail_start, history.dropped, n - self.MAX_TAIL_WORDS)
+        k = start - history.dropped
+        words = list(zip(history.begs[k:], history.ends[k:], history.texts[k:]))
+        spans = sentence_spans(words, self.tokenizer.split(" ".join(w[2] for w in words))) if words else []
+
+        for i, j, sent in spans[:-1]:
+            beg = words[i][0] if i is not None else None
+            self.complete.append((start+i if i is not None else None, start+j, beg, words[j][1], sent))
+        if len(spans) > 1:
+            self.tail_start = start + spans[-2][1] + 1
+        # the sentences whose words are dropped from the history are not needed, except the last one
+        while len(self.complete) > 1 and self.complete[0][1] < history.dropped:
+            self.complete.popleft()
+
+        out = [(b, e, sent) for _, _, b, e, sent in self.complete]
+        if spans:
+            i, j, sent = spans[-1]
+            out.append((words[i][0] if i is not None else None, words[j][1], sent))
+        return out
+
+
 class OnlineASRProcessor:
 
     SAMPLING_RATE = 16000
 
-    def __init__(self, asr, tokenizer=None, buffer_trimming=("segment", 15), logfile=sys.stderr):
+    def __init__(self, asr, tokenizer=None, buffer_trimming=("segment", 15), logfile=sys.stderr, transcript_sink=None):
         """asr: WhisperASR object
         tokenizer: sentence tokenizer object for the target language. Must have a method *split* that behaves like the one of MosesTokenizer. It can be None, if "segment" buffer trimming option is used, then tokenizer is not used at all.
         ("segment", 15)
         buffer_trimming: a pair of (option, seconds), where option is either "sentence" or "segment", and seconds is a number. Buffer is trimmed if it is longer than "seconds" threshold. Default is the most recommended option.
         logfile: where to store the log. 
+        transcript_sink: optional file-like object, the committed words are appended to it, see CommittedHistory.
         """
         self.asr = asr
         self.tokenizer = tokenizer
         self.logfile = logfile
+        self.transcript_sink = transcript_sink
+        self.commited = None
 
         self.init()
 
@@ -446,35 +789,31 @@ class OnlineASRProcessor:
 
     def init(self, offset=None):
         """run this when starting or restarting processing"""
-        self.audio_buffer = np.array([],dtype=np.float32)
+        self.audio_buffer = AudioBuffer(self.SAMPLING_RATE)
+        # the log-mel features of audio_buffer, computed incrementally, if the ASR backend takes them
+        self.mel_cache = self.asr.feature_cache() if self.asr.accepts_features else None
         self.transcript_buffer = HypothesisBuffer(logfile=self.logfile)
         self.buffer_time_offset = 0
         if offset is not None:
             self.buffer_time_offset = offset
         self.transcript_buffer.last_commited_time = self.buffer_time_offset
-        self.commited = []
+        if self.commited is not None:
+            self.commited.spill()
+        self.commited = CommittedHistory(sink=self.transcript_sink)
+        self.segmenter = SentenceSegmenter(self.tokenizer)
 
     def insert_audio_chunk(self, audio):
-        self.audio_buffer = np.append(self.audio_buffer, audio)
+        self.audio_buffer.append(audio)
+
+    def buffer_seconds(self):
+        """the duration of the audio buffer that is transcribed on every process_iter"""
+        return len(self.audio_buffer)/self.SAMPLING_RATE
 
     def prompt(self):
         """Returns a tuple: (prompt, context), where "prompt" is a 200-character suffix of commited text that is inside of the scrolled away part of audio buffer. 
         "context" is the commited text that is inside the audio buffer. It is transcribed again and skipped. It is returned only for debugging and logging reasons.
         """
-        k = max(0,len(self.commited)-1)
-        while k > 0 and self.commited[k-1][1] > self.buffer_time_offset:
-            k -= 1
-
-        p = self.commited[:k]
-        p = [t for _,_,t in p]
-        prompt = []
-        l = 0
-        while p and l < 200:  # 200 characters prompt size
-            x = p.pop(-1)
-            l += len(x)+1
-            prompt.append(x)
-        non_prompt = self.commited[k:]
-        return self.asr.sep.join(prompt[::-1]), self.asr.sep.join(t for _,_,t in non_prompt)
+        return self.commited.prompt(self.buffer_time_offset, self.asr.sep)
 
     def process_iter(self):
         """Runs on the current audio buffer.
@@ -486,33 +825,42 @@ class OnlineASRProcessor:
         logger.debug(f"PROMPT: {prompt}")
         logger.debug(f"CONTEXT: {non_prompt}")
         logger.debug(f"transcribing {len(self.audio_buffer)/self.SAMPLING_RATE:2.2f} seconds from {self.buffer_time_offset:2.2f}")
-        res = self.asr.transcribe(self.audio_buffer, init_prompt=prompt)
+        audio = self.audio_buffer.view()
+        if self.mel_cache is not None:
+            with stage("features"):
+                features = self.mel_cache.features(audio)
+            with stage("transcribe"):
+                res = self.asr.transcribe(audio, init_prompt=prompt, features=features)
+        else:
+            with stage("transcribe"):
+                res = self.asr.transcribe(audio, init_prompt=prompt)
 
-        # transform to [(beg,end,"word1"), ...]
-        tsw = self.asr.ts_words(res)
+        with stage("hypothesis"):
+            # transform to [(beg,end,"word1"), ...]
+            tsw = self.asr.ts_words(res)
 
-        self.transcript_buffer.insert(tsw, self.buffer_time_offset)
-        o = self.transcript_buffer.flush()
-        self.commited.extend(o)
-        completed = self.to_flush(o)
-        logger.debug(f">>>>COMPLETE NOW: {completed}")
-        the_rest = self.to_flush(self.transcript_buffer.complete())
-        logger.debug(f"INCOMPLETE: {the_rest}")
+            self.transcript_buffer.insert(tsw, self.buffer_time_offset)
+            o = self.transcript_buffer.flush()
+            self.commited.extend(o)
+            completed = self.to_flush(o)
+            logger.debug(f">>>>COMPLETE NOW: {completed}")
+            the_rest = self.to_flush(self.transcript_buffer.complete())
+            logger.debug(f"INCOMPLETE: {the_rest}")
 
         # there is a newly confirmed text
 
-        if o and self.buffer_trimming_way == "sentence":  # trim the completed sentences
-            if len(self.audio_buffer)/self.SAMPLING_RATE > self.buffer_trimming_sec:  # longer than this
-                self.chunk_completed_sentence()
+        with stage("trim"):
+            if o and self.buffer_trimming_way == "sentence":  # trim the completed sentences
+                if len(self.audio_buffer)/self.SAMPLING_RATE > self.buffer_trimming_sec:  # longer than this
+                    self.chunk_completed_sentence()
 
-        
-        if self.buffer_trimming_way == "segment":
-            s = self.buffer_trimming_sec  # trim the completed segments longer than s,
-        else:
-            s = 30 # if the audio buffer is longer than 30s, trim it
-        
-        if len(self.audio_buffer)/self.SAMPLING_RATE > s:
-            self.chunk_completed_segment(res)
+            if self.buffer_trimming_way == "segment":
+                s = self.buffer_trimming_sec  # trim the completed segments longer than s,
+            else:
+                s = 30 # if the audio buffer is longer than 30s, trim it
+
+            if len(self.audio_buffer)/self.SAMPLING_RATE > s:
+                self.chunk_completed_segment(res)
 
             # alternative: on any word
             #l = self.buffer_time_offset + len(self.audio_buffer)/self.SAMPLING_RATE - 10
@@ -528,9 +876,9 @@ class OnlineASRProcessor:
         return self.to_flush(o)
 
     def chunk_completed_sentence(self):
-        if self.commited == []: return
+        if not self.commited: return
         logger.debug(self.commited)
-        sents = self.words_to_sentences(self.commited)
+        sents = self.segmenter.sentences(self.commited)
         for s in sents:
             logger.debug(f"\t\tSENT: {s}")
         if len(sents) < 2:
@@ -539,12 +887,15 @@ class OnlineASRProcessor:
             sents.pop(0)
         # we will continue with audio processing at this timestamp
         chunk_at = sents[-2][1]
+        if chunk_at <= self.buffer_time_offset:
+            # the sentence is already scrolled away, e.g. it is in the prompt
+            return
 
         logger.debug(f"--- sentence chunked at {chunk_at:2.2f}")
         self.chunk_at(chunk_at)
 
     def chunk_completed_segment(self, res):
-        if self.commited == []: return
+        if not self.commited: return
 
         ends = self.asr.segments_end_ts(res)
 
@@ -573,34 +924,21 @@ class OnlineASRProcessor:
         """
         self.transcript_buffer.pop_commited(time)
         cut_seconds = time - self.buffer_time_offset
-        self.audio_buffer = self.audio_buffer[int(cut_seconds*self.SAMPLING_RATE):]
+        # rounded, not truncated: the float error shouldn't move the cut off the 10 ms feature frames
+        cut = int(round(cut_seconds*self.SAMPLING_RATE))
+        self.audio_buffer.trim(cut)
+        if self.mel_cache is not None:
+            self.mel_cache.trim(cut)
         self.buffer_time_offset = time
+        self.commited.trim(time)
 
     def words_to_sentences(self, words):
         """Uses self.tokenizer for sentence segmentation of words.
         Returns: [(beg,end,"sentence 1"),...]
         """
-        
-        cwords = [w for w in words]
-        t = " ".join(o[2] for o in cwords)
-        s = self.tokenizer.split(t)
-        out = []
-        while s:
-            beg = None
-            end = None
-            sent = s.pop(0).strip()
-            fsent = sent
-            while cwords:
-                b,e,w = cwords.pop(0)
-                w = w.strip()
-                if beg is None and sent.startswith(w):
-                    beg = b
-                elif end is None and sent == w:
-                    end = e
-                    out.append((beg,end,fsent))
-                    break
-                sent = sent[len(w):].strip()
-        return out
+        words = list(words)
+        s = self.tokenizer.split(" ".join(o[2] for o in words))
+        return [(words[i][0] if i is not None else None, words[j][1], sent) for i, j, sent in sentence_spans(words, s)]
 
     def finish(self):
         """Flush the incomplete text when the whole processing ends.
@@ -609,6 +947,7 @@ class OnlineASRProcessor:
         o = self.transcript_buffer.complete()
         f = self.to_flush(o)
         logger.debug(f"last, noncommited: {f}")
+        self.commited.spill()
         self.buffer_time_offset += len(self.audio_buffer)/16000
         return f
 
@@ -639,8 +978,12 @@ class VACOnlineASRProcessor(OnlineASRProcessor):
     When it detects end of speech (non-voice for 500ms), it makes OnlineASRProcessor to end the utterance immediately.
     '''
 
-    def __init__(self, online_chunk_size, *a, **kw):
+    def __init__(self, online_chunk_size, *a, chunk_controller=None, **kw):
+        """online_chunk_size: the minimum audio in seconds, for which the OnlineASRProcessor is run.
+        chunk_controller: optional AdaptiveChunkController, it sets online_chunk_size from the processing times.
+        """
         self.online_chunk_size = online_chunk_size
+        self.chunk_controller = chunk_controller
 
         self.online = OnlineASRProcessor(*a, **kw)
 
@@ -654,34 +997,42 @@ class VACOnlineASRProcessor(OnlineASRProcessor):
         self.vac = FixedVADIterator(model)  # we use the default options there: 500ms silence, 100ms padding, etc.  
 
         self.logfile = self.online.logfile
+        self.transcript_sink = self.online.transcript_sink
         self.init()
 
-    def init(self):
-        self.online.init()
+    def init(self, offset=None):
+        """offset: the stream time in seconds, at which the processing (re)starts"""
+        self.online.init(offset)
         self.vac.reset_states()
+        # the VAD sample positions count from here
+        self.stream_offset = 0 if offset is None else int(round(offset*self.SAMPLING_RATE))
         self.current_online_chunk_buffer_size = 0
 
         self.is_currently_final = False
 
         self.status = None  # or "voice" or "nonvoice"
-        self.audio_buffer = np.array([],dtype=np.float32)
+        self.audio_buffer = AudioBuffer(self.SAMPLING_RATE)
         self.buffer_offset = 0  # in frames
 
     def clear_buffer(self):
         self.buffer_offset += len(self.audio_buffer)
-        self.audio_buffer = np.array([],dtype=np.float32)
+        self.audio_buffer.clear()
 
 
+    def buffer_seconds(self):
+        return self.online.buffer_seconds()
+
     def insert_audio_chunk(self, audio):
-        res = self.vac(audio)
-        self.audio_buffer = np.append(self.audio_buffer, audio)
+        with stage("vad"):
+            res = self.vac(audio)
+        self.audio_buffer.append(audio)
 
         if res is not None:
             frame = list(res.values())[0]-self.buffer_offset
             if 'start' in res and 'end' not in res:
                 self.status = 'voice'
                 send_audio = self.audio_buffer[frame:]
-                self.online.init(offset=(frame+self.buffer_offset)/self.SAMPLING_RATE)
+                self.online.init(offset=(frame+self.buffer_offset+self.stream_offset)/self.SAMPLING_RATE)
                 self.online.insert_audio_chunk(send_audio)
                 self.current_online_chunk_buffer_size += len(send_audio)
                 self.clear_buffer()
@@ -697,29 +1048,33 @@ class VACOnlineASRProcessor(OnlineASRProcessor):
                 end = res["end"]-self.buffer_offset
                 self.status = 'nonvoice'
                 send_audio = self.audio_buffer[beg:end]
-                self.online.init(offset=(beg+self.buffer_offset)/self.SAMPLING_RATE)
+                self.online.init(offset=(beg+self.buffer_offset+self.stream_offset)/self.SAMPLING_RATE)
                 self.online.insert_audio_chunk(send_audio)
                 self.current_online_chunk_buffer_size += len(send_audio)
                 self.is_currently_final = True
                 self.clear_buffer()
         else:
             if self.status == 'voice':
-                self.online.insert_audio_chunk(self.audio_buffer)
+                self.online.insert_audio_chunk(self.audio_buffer.view())
                 self.current_online_chunk_buffer_size += len(self.audio_buffer)
                 self.clear_buffer()
             else:
                 # We keep 1 second because VAD may later find start of voice in it.
                 # But we trim it to prevent OOM. 
                 self.buffer_offset += max(0,len(self.audio_buffer)-self.SAMPLING_RATE)
-                self.audio_buffer = self.audio_buffer[-self.SAMPLING_RATE:]
+                self.audio_buffer.keep_last(self.SAMPLING_RATE)
 
 
     def process_iter(self):
         if self.is_currently_final:
             return self.finish()
         elif self.current_online_chunk_buffer_size > self.SAMPLING_RATE*self.online_chunk_size:
+            audio_seconds = self.current_online_chunk_buffer_size/self.SAMPLING_RATE
             self.current_online_chunk_buffer_size = 0
+            t = time.time()
             ret = self.online.process_iter()
+            if self.chunk_controller is not None:
+                self.online_chunk_size = self.chunk_controller.update(time.time()-t, audio_seconds)
             return ret
         else:
             print("no online update, only VAD", self.status, file=self.logfile)
@@ -735,11 +1090,42 @@ class VACOnlineASRProcessor(OnlineASRProcessor):
 
 WHISPER_LANG_CODES = "af,am,ar,as,az,ba,be,bg,bn,bo,br,bs,ca,cs,cy,da,de,el,en,es,et,eu,fa,fi,fo,fr,gl,gu,ha,haw,he,hi,hr,ht,hu,hy,id,is,it,ja,jw,ka,kk,km,kn,ko,la,lb,ln,lo,lt,lv,mg,mi,mk,ml,mn,mr,ms,mt,my,ne,nl,nn,no,oc,pa,pl,ps,pt,ro,ru,sa,sd,si,sk,sl,sn,so,sq,sr,su,sv,sw,ta,te,tg,th,tk,tl,tr,tt,uk,ur,uz,vi,yi,yo,zh".split(",")
 
-def create_tokenizer(lan):
-    """returns an object that has split function that works like the one of MosesTokenizer"""
+WTP_MODEL = "wtp-canine-s-12l-no-adapters"
 
-    assert lan in WHISPER_LANG_CODES, "language must be Whisper's supported lang code: " + " ".join(WHISPER_LANG_CODES)
+class _LockedTokenizer:
+    """serializes the split calls of a tokenizer object that is shared by several sessions (threads)"""
 
+    def __init__(self, tokenizer, lock=None):
+        self.tokenizer = tokenizer
+        self.lock = lock if lock is not None else threading.Lock()
+
+    def split(self, text):
+        with self.lock:
+            return self.tokenizer.split(text)
+
+# the loaded tokenizers and WtP models, shared by all the sessions of the process
+_tokenizers = {}
+_wtp_models = {}
+_tokenizers_lock = threading.Lock()
+_loading_locks = {}
+
+def _loading_lock(key):
+    with _tokenizers_lock:
+        return _loading_locks.setdefault(key, threading.Lock())
+
+def _load_wtp(wtp_model):
+    # one WtP model serves all the languages
+    with _loading_lock(("wtp", wtp_model)):
+        if wtp_model not in _wtp_models:
+            from wtpsplit import WtP
+            t = time.time()
+            logger.info(f"Loading WtP sentence segmenter {wtp_model}...")
+            # a local directory, or a model name that is downloaded from huggingface on the first use
+            _wtp_models[wtp_model] = (WtP(wtp_model), threading.Lock())
+            logger.info(f"done. It took {round(time.time()-t,2)} seconds.")
+        return _wtp_models[wtp_model]
+
+def _load_tokenizer(lan, wtp_model):
     if lan == "uk":
         import tokenize_uk
         class UkrainianTokenizer:
@@ -750,20 +1136,38 @@ def create_tokenizer(lan):
     # supported by fast-mosestokenizer
     if lan in "as bn ca cs de el en es et fi fr ga gu hi hu is it kn lt lv ml mni mr nl or pa pl pt ro ru sk sl sv ta te yue zh".split():
         from mosestokenizer import MosesTokenizer
-        return MosesTokenizer(lan)
+        return _LockedTokenizer(MosesTokenizer(lan))
 
     # the following languages are in Whisper, but not in wtpsplit:
     if lan in "as ba bo br bs fo haw hr ht jw lb ln lo mi nn oc sa sd sn so su sw tk tl tt".split():
         logger.debug(f"{lan} code is not supported by wtpsplit. Going to use None lang_code option.")
         lan = None
 
-    from wtpsplit import WtP
-    # downloads the model from huggingface on the first use
-    wtp = WtP("wtp-canine-s-12l-no-adapters")
+    wtp, lock = _load_wtp(wtp_model)
     class WtPtok:
         def split(self, sent):
             return wtp.split(sent, lang_code=lan)
-    return WtPtok()
+    return _LockedTokenizer(WtPtok(), lock)
+
+def create_tokenizer(lan, wtp_model=None):
+    """Returns an object that has split function that works like the one of MosesTokenizer.
+    The tokenizer of every language is loaded only once, on the first request, and then it is shared 
+    by all the callers. It is safe to call and to use from several threads.
+    wtp_model: name or local directory of the WtP model, for the languages that are not supported by MosesTokenizer.
+    """
+
+    assert lan in WHISPER_LANG_CODES, "language must be Whisper's supported lang code: " + " ".join(WHISPER_LANG_CODES)
+
+    if wtp_model is None:
+        wtp_model = WTP_MODEL
+    key = (lan, wtp_model)
+    tokenizer = _tokenizers.get(key)
+    if tokenizer is None:
+        with _loading_lock(key):
+            tokenizer = _tokenizers.get(key)
+            if tokenizer is None:
+                tokenizer = _tokenizers[key] = _load_tokenizer(lan, wtp_model)
+    return tokenizer
 
 
 def add_shared_args(parser):
@@ -778,19 +1182,35 @@ def add_shared_args(parser):
     parser.add_argument('--lan', '--language', type=str, default='auto', help="Source language code, e.g. en,de,cs, or 'auto' for language detection.")
     parser.add_argument('--task', type=str, default='transcribe', choices=["transcribe","translate"],help="Transcribe or translate.")
     parser.add_argument('--backend', type=str, default="faster-whisper", choices=["faster-whisper", "whisper_timestamped", "mlx-whisper", "openai-api"],help='Load only this backend for Whisper processing.')
+    parser.add_argument('--device', type=str, default='auto', choices=["auto", "cuda", "cpu"], help='Device of the faster-whisper backend. auto uses CUDA if it is available, otherwise CPU.')
+    parser.add_argument('--compute-type', type=str, default='auto', dest='compute_type', help='CTranslate2 compute type of the faster-whisper backend, e.g. float16, int8_float16, int8. auto is float16 on CUDA and int8 on CPU.')
+    parser.add_argument('--cpu-threads', type=int, default=0, dest='cpu_threads', help='Number of CPU threads of the faster-whisper model. 0 is the CTranslate2 default.')
+    parser.add_argument('--beam-size', type=int, default=None, dest='beam_size', help='Beam size of the faster-whisper backend. Default is 5.')
+    parser.add_argument('--num-workers', type=int, default=1, dest='num_workers', help='Number of faster-whisper model workers, for parallel transcription from several sessions when they are not batched (--batch-window 0).')
     parser.add_argument('--vac', action="store_true", default=False, help='Use VAC = voice activity controller. Recommended. Requires torch.')
     parser.add_argument('--vac-chunk-size', type=float, default=0.04, help='VAC sample size in seconds.')
     parser.add_argument('--vad', action="store_true", default=False, help='Use VAD = voice activity detection, with the default parameters.')
     parser.add_argument('--buffer_trimming', type=str, default="segment", choices=["sentence", "segment"],help='Buffer trimming strategy -- trim completed sentences marked with punctuation mark and detected by sentence segmenter, or the completed segments returned by Whisper. Sentence segmenter must be installed for "sentence" option.')
+    parser.add_argument('--wtp-model', type=str, default=WTP_MODEL, dest='wtp_model', help='The WtP sentence segmenter for the "sentence" buffer trimming in the languages that MosesTokenizer does not support. A model name on Hugging Face, or a local directory with a downloaded model, for working offline.')
+    parser.add_argument('--preload-tokenizer', action="store_true", default=False, dest='preload_tokenizer', help='Load the sentence segmenter for the "sentence" buffer trimming at the start, next to the warmup, and not when the first session starts.')
     parser.add_argument('--buffer_trimming_sec', type=float, default=15, help='Buffer trimming length threshold in seconds. If buffer length is longer, trimming sentence/segment is triggered.')
+    parser.add_argument('--transcript-file', type=str, default=None, dest='transcript_file', help='Append the committed words to this file as "beg end text" lines (timestamps in milliseconds). Only the recent words needed for the prompt are kept in memory, the older ones are written here when they are dropped. With several sessions, every line starts with "<stream>#<session id>".')
+    add_chunk_controller_args(parser)
+    parser.add_argument('--record-asr', type=str, default=None, dest='record_asr', metavar='FILE', help='Record the inputs and the outputs of every transcribe call of the backend to this file, for --replay-asr. See replay_asr.py.')
+    parser.add_argument('--replay-asr', type=str, default=None, dest='replay_asr', metavar='FILE', help='Do not load any model, replay the transcriptions recorded with --record-asr.')
+    parser.add_argument('--replay-delay', type=str, default='0', dest='replay_delay', help='The simulated inference time of every replayed transcribe call: seconds, "recorded" for the recorded time, or e.g. "0.2x" for 0.2 times the audio duration.')
     parser.add_argument('--show-timestamps', action="store_true", default=False, help='Show timestamps in the output. Default is False.')
     parser.add_argument("-l", "--log_level", dest="log_level", choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'], help="Set the log level", default='DEBUG')
 
-def asr_factory(args, logfile=sys.stderr):
+def create_asr(args):
     """
-    Creates and configures an ASR and ASR Online instance based on the specified backend and arguments.
+    Loads the Whisper model of the specified backend and applies the options that are common for all the streams.
+    The returned ASR object can be shared by several online processors, see create_online.
     """
     backend = args.backend
+    if getattr(args, 'replay_asr', None):
+        from replay_asr import ReplayASR
+        return ReplayASR(args.replay_asr, delay=args.replay_delay, show_timestamps=args.show_timestamps)
     if backend == "openai-api":
         logger.debug("Using OpenAI API.")
         asr = OpenaiApiASR(lan=args.lan, show_timestamps=args.show_timestamps)
@@ -804,35 +1224,108 @@ def asr_factory(args, logfile=sys.stderr):
 
         t = time.time()
         logger.info(f"Loading Whisper model {args.model} for {args.lan}...")
-        asr = asr_cls(modelsize=args.model, lan=args.lan, cache_dir=args.model_cache_dir, model_dir=args.model_dir, show_timestamps=args.show_timestamps)
+        kw = {}
+        if backend == "faster-whisper":
+            kw = dict(device=getattr(args, 'device', 'auto'), compute_type=getattr(args, 'compute_type', 'auto'),
+                      cpu_threads=getattr(args, 'cpu_threads', 0), num_workers=getattr(args, 'num_workers', 1))
+        asr = asr_cls(modelsize=args.model, lan=args.lan, cache_dir=args.model_cache_dir, model_dir=args.model_dir, show_timestamps=args.show_timestamps, **kw)
         e = time.time()
         logger.info(f"done. It took {round(e-t,2)} seconds.")
 
+    if backend == "faster-whisper" and getattr(args, 'beam_size', None):
+        asr.beam_size = args.beam_size
+
     # Apply common configurations
     if getattr(args, 'vad', False):  # Checks if VAD argument is present and True
         logger.info("Setting VAD filter")
         asr.use_vad()
 
-    language = args.lan
     if args.task == "translate":
         asr.set_translate_task()
-        tgt_language = "en"  # Whisper translates into English
-    else:
-        tgt_language = language  # Whisper transcribes in this language
 
-    # Create the tokenizer
-    if args.buffer_trimming == "sentence":
-        tokenizer = create_tokenizer(tgt_language)
-    else:
-        tokenizer = None
+    if getattr(args, 'record_asr', None):
+        from replay_asr import RecordingASR
+        asr = RecordingASR(asr, args.record_asr, header=dict(backend=backend, model=args.model_dir or args.model, lan=args.lan,
+                                                             task=args.task, vad=getattr(args, 'vad', False)))
+    return asr
+
+def create_online(args, asr, logfile=sys.stderr, transcript_sink=None):
+    """
+    Creates a new OnlineASRProcessor (or VACOnlineASRProcessor) over an already loaded ASR object.
+    Every audio stream needs its own online processor, they keep the stream state.
+    transcript_sink: optional file-like object for the committed words, e.g. a writer of open_transcript_sink.
+    """
+    tokenizer = sentence_tokenizer(args)
 
     # Create the OnlineASRProcessor
     if args.vac:
         
-        online = VACOnlineASRProcessor(args.min_chunk_size, asr,tokenizer,logfile=logfile,buffer_trimming=(args.buffer_trimming, args.buffer_trimming_sec))
+        online = VACOnlineASRProcessor(args.min_chunk_size, asr,tokenizer,logfile=logfile,buffer_trimming=(args.buffer_trimming, args.buffer_trimming_sec),transcript_sink=transcript_sink,
+                                       chunk_controller=create_chunk_controller(args, args.min_chunk_size))
     else:
-        online = OnlineASRProcessor(asr,tokenizer,logfile=logfile,buffer_trimming=(args.buffer_trimming, args.buffer_trimming_sec))
+        online = OnlineASRProcessor(asr,tokenizer,logfile=logfile,buffer_trimming=(args.buffer_trimming, args.buffer_trimming_sec),transcript_sink=transcript_sink)
+
+    return online
+
+def sentence_tokenizer(args):
+    """the shared sentence tokenizer of the target language for the "sentence" buffer trimming, or None"""
+    if args.buffer_trimming != "sentence":
+        return None
+    if args.task == "translate":
+        tgt_language = "en"  # Whisper translates into English
+    else:
+        tgt_language = args.lan  # Whisper transcribes in this language
+    return create_tokenizer(tgt_language, wtp_model=getattr(args, 'wtp_model', None))
+
+def preload_tokenizer(args):
+    """loads the sentence tokenizer now, if it is requested by --preload-tokenizer"""
+    if getattr(args, 'preload_tokenizer', False) and args.buffer_trimming == "sentence":
+        sentence_tokenizer(args)
+        logger.info("Sentence tokenizer is loaded.")
+
+class TranscriptSink:
+    """The --transcript-file, shared by the sessions of a server. writer() returns the file-like sink of one session.
+    The lines of a writer with a label are prefixed by it, and the writes of the sessions are serialized.
+    """
 
+    def __init__(self, f):
+        self.f = f
+        self.lock = threading.Lock()
+
+    def writer(self, label=None):
+        return TranscriptWriter(self, label)
+
+
+class TranscriptWriter:
+    """file-like sink of one session in a TranscriptSink, see CommittedHistory. label can be set later, e.g. "<stream>#<session id>"."""
+
+    def __init__(self, sink, label=None):
+        self.sink = sink
+        self.label = label
+
+    def write(self, text):
+        if self.label is not None:
+            text = "".join(f"{self.label} {line}\n" for line in text.splitlines())
+        with self.sink.lock:
+            self.sink.f.write(text)
+            self.sink.f.flush()
+
+    def flush(self):
+        pass  # every write is flushed
+
+def open_transcript_sink(args):
+    """opens the --transcript-file for appending as a TranscriptSink, or returns None"""
+    if getattr(args, 'transcript_file', None) is None:
+        return None
+    return TranscriptSink(open(args.transcript_file, "a", encoding="utf-8"))
+
+def asr_factory(args, logfile=sys.stderr):
+    """
+    Creates and configures an ASR and ASR Online instance based on the specified backend and arguments.
+    """
+    asr = create_asr(args)
+    sink = open_transcript_sink(args)
+    online = create_online(args, asr, logfile=logfile, transcript_sink=sink.writer() if sink is not None else None)
     return asr, online
 
 def set_logging(args,logger,other="_server"):
@@ -6,21 +6,39 @@ import argparse
 import os
 import logging
 import numpy as np
+import time
+from session_manager import SessionManager, add_session_args
+from async_server import AsyncAudioServer, add_async_server_args
+from audio_ingest import AudioReceiver, add_ingest_args
+from batch_scheduler import BatchedASR
+from inference_pool import InferencePool, add_pool_args
+import metrics
+from metrics import observe_iteration, stage
+from autotune import autotune, add_autotune_args
 
 logger = logging.getLogger(__name__)
 parser = argparse.ArgumentParser()
 
 # server options
 parser.add_argument("--host", type=str, default='0.0.0.0')
-parser.add_argument("--port", type=int, default=43007)
+parser.add_argument("--port", type=int, nargs="+", default=[43007],
+        help="The port(s) of the audio clients. A client that doesn't name its stream (see audio_ingest.py) streams to the stream of the port.")
 parser.add_argument("--warmup-file", type=str, dest="warmup_file", 
         help="The path to a speech audio wav file to warm up Whisper so that the very first chunk processing is fast. It can be e.g. https://github.com/ggerganov/whisper.cpp/raw/master/samples/jfk.wav .")
+add_session_args(parser)
+add_ingest_args(parser)
+add_async_server_args(parser)
+add_pool_args(parser)
+add_autotune_args(parser)
+metrics.add_metrics_args(parser)
 
 # options from whisper_online
 add_shared_args(parser)
 args = parser.parse_args()
 
 set_logging(args,logger,other="")
+if args.autotune:
+    autotune(args, parser)
 
 # setting whisper object by args 
 
@@ -28,7 +46,13 @@ SAMPLING_RATE = 16000
 
 size = args.model
 language = args.lan
-asr, online = asr_factory(args)
+pool = None
+if args.inference_workers > 0:
+    # every worker process loads its own model, the sessions get ASR handles bound to one of them
+    pool = InferencePool(args, args.inference_workers, args.worker_cpu_threads)
+    asr = None
+else:
+    asr = create_asr(args)
 min_chunk = args.min_chunk_size
 
 # warm up the ASR because the very first transcribe takes more time than the others. 
@@ -36,14 +60,16 @@ min_chunk = args.min_chunk_size
 msg = "Whisper is not warmed up. The first chunk processing may take longer."
 if args.warmup_file:
     if os.path.isfile(args.warmup_file):
-        a = load_audio_chunk(args.warmup_file,0,1)
-        asr.transcribe(a)
+        if pool is None:  # the workers warm up their models themselves
+            a = load_audio_chunk(args.warmup_file,0,1)
+            asr.transcribe(a)
         logger.info("Whisper is warmed up.")
     else:
         logger.critical("The warm up file is not available. "+msg)
         sys.exit(1)
 else:
     logger.warning(msg)
+preload_tokenizer(args)
 
 
 ######### Server objects
@@ -53,11 +79,13 @@ import socket
 
 class Connection:
     '''it wraps conn object'''
-    PACKET_SIZE = 32000*5*60 # 5 minutes # was: 65536
+    PACKET_SIZE = 65536  # the receiver thread drains the socket continuously
 
-    def __init__(self, conn):
+    def __init__(self, conn, first_audio=b""):
         self.conn = conn
+        self.first_audio = first_audio  # received with the stream header, returned first
         self.last_line = ""
+        self.audio_packet = bytearray(self.PACKET_SIZE)
 
         self.conn.setblocking(True)
 
@@ -73,50 +101,56 @@ class Connection:
         return in_line
 
     def non_blocking_receive_audio(self):
+        # returns a view of the received bytes, valid until the next call
+        if self.first_audio:
+            data, self.first_audio = self.first_audio, b""
+            return data
         try:
-            r = self.conn.recv(self.PACKET_SIZE)
-            return r
+            n = self.conn.recv_into(self.audio_packet)
+            return memoryview(self.audio_packet)[:n]
         except ConnectionResetError:
             return None
 
 
-import io
-import soundfile
 
 # wraps socket and ASR object, and serves one client connection. 
 # next client should be served by a new instance of this object
 class ServerProcessor:
 
-    def __init__(self, c, online_asr_proc, min_chunk):
+    def __init__(self, c, online_asr_proc, min_chunk, chunk_controller=None, session_id=None):
         self.connection = c
         self.online_asr_proc = online_asr_proc
         self.min_chunk = min_chunk
+        # optional AdaptiveChunkController, it overrides min_chunk
+        self.chunk_controller = chunk_controller
+        self.session_id = session_id  # the label of the metrics
 
         self.last_end = None
 
         self.is_first = True
+        self.stream_samples = 0  # the samples received (or dropped) so far
 
     def receive_audio_chunk(self):
-        # receive all audio that is available by this time
+        # receive all audio that is available by this time, from the receiver thread
         # blocks operation if less than self.min_chunk seconds is available
         # unblocks if connection is closed or a chunk is available
-        out = []
         minlimit = self.min_chunk*SAMPLING_RATE
-        while sum(len(x) for x in out) < minlimit:
-            raw_bytes = self.connection.non_blocking_receive_audio()
-            if not raw_bytes:
-                break
-#            print("received audio:",len(raw_bytes), "bytes", raw_bytes[:10])
-            sf = soundfile.SoundFile(io.BytesIO(raw_bytes), channels=1,endian="LITTLE",samplerate=SAMPLING_RATE, subtype="PCM_16",format="RAW")
-            audio, _ = librosa.load(sf,sr=SAMPLING_RATE,dtype=np.float32)
-            out.append(audio)
-        if not out:
-            return None
-        conc = np.concatenate(out)
-        if self.is_first and len(conc) < minlimit:
+        if self.chunk_controller is not None:
+            minlimit = self.chunk_controller.chunk_size*SAMPLING_RATE
+        a, dropped = self.receiver.get(int(minlimit), partial=not self.is_first)
+        if dropped:
+            self.skip_gap(dropped)
+        if a is None:
             return None
         self.is_first = False
-        return np.concatenate(out)
+        self.stream_samples += len(a)
+        return a
+
+    def skip_gap(self, dropped):
+        # the receiver dropped audio over the backlog limit, the transcription continues after the gap
+        self.stream_samples += dropped
+        logger.warning(f"skipped {dropped/SAMPLING_RATE:.2f} seconds of audio, restarting the transcription at {self.stream_samples/SAMPLING_RATE:.2f}")
+        self.online_asr_proc.init(offset=self.stream_samples/SAMPLING_RATE)
 
     def format_output_transcript(self,o):
         # output format in stdout is like:
@@ -150,17 +184,29 @@ class ServerProcessor:
     def process(self):
         # handle one client connection
         self.online_asr_proc.init()
-        while True:
-            a = self.receive_audio_chunk()
-            if a is None:
-                break
-            self.online_asr_proc.insert_audio_chunk(a)
-            o = online.process_iter()
-            try:
-                self.send_result(o)
-            except BrokenPipeError:
-                logger.info("broken pipe -- connection closed?")
-                break
+        # the socket is read in another thread while this one transcribes
+        self.receiver = AudioReceiver(self.connection.non_blocking_receive_audio, args.max_backlog, args.backlog_policy)
+        try:
+            while True:
+                with stage("recv_wait"):
+                    a = self.receive_audio_chunk()
+                if a is None:
+                    break
+                self.online_asr_proc.insert_audio_chunk(a)
+                t = time.time()
+                o = self.online_asr_proc.process_iter()
+                elapsed = time.time() - t
+                if self.chunk_controller is not None:
+                    self.chunk_controller.update(elapsed, len(a)/SAMPLING_RATE)
+                observe_iteration(self.session_id, elapsed, len(a)/SAMPLING_RATE, self.receiver.backlog, self.online_asr_proc.buffer_seconds())
+                try:
+                    with stage("send"):
+                        self.send_result(o)
+                except BrokenPipeError:
+                    logger.info("broken pipe -- connection closed?")
+                    break
+        finally:
+            self.receiver.close()
 
 #        o = online.finish()  # this should be working
 #        self.send_result(o)
@@ -169,16 +215,25 @@ class ServerProcessor:
 
 # server loop
 
-with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-    s.bind((args.host, args.port))
-    s.listen(1)
-    logger.info('Listening on'+str((args.host, args.port)))
-    while True:
-        conn, addr = s.accept()
-        logger.info('Connected to client on {}'.format(addr))
-        connection = Connection(conn)
-        proc = ServerProcessor(connection, online, args.min_chunk_size)
-        proc.process()
-        conn.close()
-        logger.info('Connection to client closed')
+def serve_client(session, conn):
+    connection = Connection(conn, session.first_audio)
+    # with VAC, the VAC processor adapts its own chunk size
+    chunk_controller = None if args.vac else create_chunk_controller(args, args.min_chunk_size)
+    proc = ServerProcessor(connection, session.online, args.min_chunk_size, chunk_controller, session.id)
+    proc.process()
+
+if pool is None and args.max_sessions > 1 and args.batch_window > 0:
+    # the sessions' transcribe calls are batched together
+    asr = BatchedASR(asr, batch_window=args.batch_window, max_batch_size=args.max_batch_size, active_streams=lambda: sessions.active_sessions())
+transcript_sink = open_transcript_sink(args)
+sessions = SessionManager(lambda: create_online(args, asr if pool is None else pool.handle(),
+        transcript_sink=transcript_sink.writer() if transcript_sink is not None else None), max_sessions=args.max_sessions)
+metrics.SESSIONS.set_function(sessions.active_sessions)
+if args.metrics_port:
+    metrics.serve_metrics(args.host, args.metrics_port)
+if args.async_server:
+    AsyncAudioServer(sessions, args.min_chunk_size, args.max_backlog, args.backlog_policy,
+            create_chunk_controller=lambda: None if args.vac else create_chunk_controller(args, args.min_chunk_size)).serve(args.host, args.port)
+else:
+    sessions.serve(args.host, args.port, serve_client)
 logger.info('Connection closed, terminating.')
@@ -1,49 +1,109 @@
 #!/usr/bin/env python3
 from whisper_online import *
-from flask import Flask, render_template_string, request
-from flask_socketio import SocketIO
+from flask import Flask, Response, jsonify, render_template_string, request
+from flask_socketio import SocketIO, join_room
 import sys
 import argparse
 import os
 import logging
 import numpy as np
 import threading
-import socket
-import soundfile
-import io
+import time
+import collections
 import re  # Add import for regular expressions
+from session_manager import SessionManager, add_session_args
+from async_server import AsyncAudioServer, add_async_server_args
+from batch_scheduler import BatchedASR
+from inference_pool import InferencePool, add_pool_args
+from caption_emitter import CaptionEmitter, add_emitter_args
+from caption_layout import CaptionLayout, CaptionStreams, PROTOCOL_VERSION, merge_ops
+import metrics
+from metrics import observe_iteration, stage
+from autotune import autotune, add_autotune_args
+from asr_process import ASRProcess, add_asr_process_args
+from audio_ingest import AudioReceiver, add_ingest_args
 
 logger = logging.getLogger(__name__)
 parser = argparse.ArgumentParser()
 
 # server options
 parser.add_argument("--host", type=str, default='0.0.0.0')
-parser.add_argument("--port", type=int, default=43007)
+parser.add_argument("--port", type=int, nargs="+", default=[43007],
+        help="The port(s) of the audio clients. A client that doesn't name its stream (see audio_ingest.py) streams to the stream of the port.")
 parser.add_argument("--web-port", type=int, default=5000)
 parser.add_argument("--warmup-file", type=str, dest="warmup_file",
         help="The path to a speech audio wav file to warm up Whisper.")
+add_session_args(parser)
+add_ingest_args(parser)
+add_async_server_args(parser)
+add_pool_args(parser)
+add_autotune_args(parser)
+add_asr_process_args(parser)
+metrics.add_metrics_args(parser)
 parser.add_argument("--min-chars", type=int, default=50,
-        help="Minimum number of characters before displaying a line")
+        help="Minimum number of characters of a line before it is broken at a sentence end")
 parser.add_argument("--max-chars", type=int, default=150,
         help="Maximum number of characters per line")
 parser.add_argument("--max-lines", type=int, default=2,
         help="Maximum number of lines to display")
+add_emitter_args(parser)
+parser.add_argument("--caption-history", type=int, default=500, dest="caption_history",
+        help="Number of the recent completed caption lines kept for every stream, sent to the overlays on connect and served at /transcript.")
 
 # options from whisper_online
 add_shared_args(parser)
 args = parser.parse_args()
+if args.web_async_mode in ("eventlet", "gevent") and not args.asr_process:
+    parser.error(f"--web-async-mode {args.web_async_mode} requires --asr-process")
 
 set_logging(args, logger, other="")
+if args.autotune:
+    autotune(args, parser)
 
 SAMPLING_RATE = 16000
 
 # Initialize Flask and SocketIO
 app = Flask(__name__)
-socketio = SocketIO(app, cors_allowed_origins="*", logger=True, engineio_logger=True)
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode=args.web_async_mode, logger=True, engineio_logger=True)
+# the lines of the streams as the overlays have them, with the sequence numbers of the deltas
+caption_streams = CaptionStreams(max_lines=args.max_lines, history=args.caption_history)
+# the overlays without ?stream= show the stream of the first audio port
+default_stream = str(args.port[0])
+
+def stream_room(stream):
+    # the Socket.IO room of the overlays of a stream
+    return f"stream:{stream}"
+
+# in the ASR process: callable(key, ops) that sends the caption updates to the web process
+caption_sink = None
+
+def fan_out_captions(key, ops):
+    socketio.emit('transcription', caption_streams.apply(key, ops), to=stream_room(key))
+
+def emit_captions(key, ops):
+    if caption_sink is not None:
+        caption_sink(key, ops)
+    else:
+        fan_out_captions(key, ops)
+
+# the caption updates are emitted from their own thread, merged and rate limited
+caption_emitter = CaptionEmitter(emit_captions, fps=args.caption_fps,
+                                 merge=merge_ops)
 
 @socketio.on('connect')
-def handle_connect():
-    logger.info(f'Client connected from {request.remote_addr}')
+def handle_connect(auth=None):
+    # the overlay gets only the captions of its stream
+    stream = str((auth or {}).get('stream') or default_stream)
+    join_room(stream_room(stream))
+    logger.info(f'Client connected from {request.remote_addr} to stream {stream}')
+    # the overlay shows the current lines right away, it gets them with the recent transcript
+    socketio.emit('transcription', caption_streams.snapshot(stream, history=True), to=request.sid)
+
+@socketio.on('snapshot')
+def handle_snapshot(data=None):
+    # an overlay missed a delta, it gets all the lines of the stream
+    stream = str((data or {}).get('stream') or default_stream)
+    socketio.emit('transcription', caption_streams.snapshot(stream), to=request.sid)
 
 @socketio.on('disconnect')
 def handle_disconnect(sid=None):
@@ -97,14 +157,16 @@ HTML_TEMPLATE = """
     </style>
 </head>
 <body>
-    <div id="transcription">
-        <div id="top-line" class="transcription-line top-line"></div>
-        <div id="bottom-line" class="transcription-line bottom-line"></div>
-    </div>
+    <div id="transcription"></div>
 
     <script src="https://cdnjs.cloudflare.com/ajax/libs/socket.io/4.0.1/socket.io.js"></script>
     <script>
+        const params = new URLSearchParams(window.location.search);
+        // the overlay shows the stream ?stream=<name>, or the stream of the first audio port
+        const stream = params.get('stream') || {{ default_stream|tojson }};
         const socket = io({
+            // the server sends only the captions of this stream, and its snapshot on connect
+            auth: {stream: stream},
             reconnection: true,
             reconnectionDelay: 1000,
             reconnectionDelayMax: 5000,
@@ -112,51 +174,120 @@ HTML_TEMPLATE = """
             transports: ['websocket']
         });
 
-        const topLine = document.getElementById('top-line');
-        const bottomLine = document.getElementById('bottom-line');
-        let previousText = '';
+        const container = document.getElementById('transcription');
+        const maxLines = {{ max_lines }};
+        const protocolVersion = {{ protocol_version }};
+        // the sequence number of the last applied delta; the deltas wait in queued until the snapshot comes
+        let seq = 0;
+        let synced = false;
+        let queued = [];
+        // the caption lines, the last one is being filled; lastAdded is its newly added text
+        let lines = [''];
+        let lastAdded = '';
+
+        function render(status) {
+            container.innerHTML = '';
+            const shown = lines.length < maxLines ? Array(maxLines - lines.length).fill('').concat(lines) : lines;
+            shown.forEach((text, i) => {
+                const div = document.createElement('div');
+                const last = i === shown.length - 1;
+                div.className = 'transcription-line ' + (last ? 'bottom-line' : 'top-line');
+                if (last && status) {
+                    div.textContent = status;
+                } else if (last && lastAdded && text.endsWith(lastAdded)) {
+                    div.textContent = text.slice(0, text.length - lastAdded.length);
+                    const span = document.createElement('span');
+                    span.className = 'last-word';
+                    span.textContent = lastAdded;
+                    div.appendChild(span);
+                } else {
+                    div.textContent = text;
+                }
+                container.appendChild(div);
+            });
+        }
+
+        function applyOps(ops) {
+            lastAdded = '';
+            for (const op of ops) {
+                if (op[0] === 'roll') {
+                    lines.push('');
+                    if (lines.length > maxLines) lines.shift();
+                    lastAdded = '';
+                } else if (op[0] === 'append') {
+                    lines[lines.length - 1] += op[1];
+                    lastAdded += op[1];
+                }
+            }
+            render();
+        }
+
+        function requestSnapshot() {
+            synced = false;
+            queued = [];
+            socket.emit('snapshot', {stream: stream});
+        }
+
+        function applySnapshot(data) {
+            if (data.stream !== stream) return;
+            seq = data.seq;
+            lines = data.lines.length ? data.lines.slice(-maxLines) : [''];
+            lastAdded = '';
+            synced = true;
+            const waiting = queued;
+            queued = [];
+            render();
+            waiting.forEach(applyDelta);
+        }
+
+        function applyDelta(data) {
+            if (data.seq <= seq) return;  // it is in the snapshot already
+            if (data.seq !== seq + 1) {
+                // a delta was missed
+                requestSnapshot();
+                queued.push(data);
+                return;
+            }
+            seq = data.seq;
+            applyOps(data.ops);
+        }
 
         socket.on('connect', () => {
             console.log('Connected to server');
-            bottomLine.textContent = '';
-            topLine.textContent = '';
-            previousText = '';
+            lines = [''];
+            lastAdded = '';
+            seq = 0;
+            synced = false;
+            queued = [];
+            render();
         });
 
         socket.on('connect_error', (error) => {
             console.log('Connection error:', error);
-            bottomLine.textContent = 'Connection error, retrying...';
+            render('Connection error, retrying...');
         });
 
         socket.on('disconnect', () => {
             console.log('Disconnected from server');
-            bottomLine.textContent = 'Disconnected from server...';
+            render('Disconnected from server...');
         });
 
         socket.on('transcription', function(data) {
-            if (!data.text) return;
-            
-            if (data.type === 'word') {
-                // Find the newly added text by comparing with previous text
-                const newText = data.text;
-                let highlightedText = '';
-                
-                if (previousText && newText.startsWith(previousText)) {
-                    const addedText = newText.slice(previousText.length).trim();
-                    highlightedText = previousText + ' <span class="last-word">' + addedText + '</span>';
-                } else {
-                    highlightedText = '<span class="last-word">' + newText + '</span>';
+            if (data.v !== protocolVersion) return;
+            if (data.type === 'snapshot') {
+                applySnapshot(data);
+            } else if (data.type === 'delta') {
+                // the changes of the lines, see caption_layout.py
+                if (data.stream !== stream) return;
+                if (!synced) {
+                    queued.push(data);
+                    return;
                 }
-                
-                bottomLine.innerHTML = highlightedText;
-                previousText = newText;
-            } else if (data.type === 'line_complete') {
-                // Move completed line to top and clear bottom
-                topLine.textContent = data.text;
-                bottomLine.textContent = '';
-                previousText = '';
+                applyDelta(data);
             }
         });
+
+        render();
     </script>
 </body>
 </html>
@@ -164,221 +295,225 @@ HTML_TEMPLATE = """
 
 @app.route('/')
 def index():
-    return render_template_string(HTML_TEMPLATE, web_port=args.web_port)
+    return render_template_string(HTML_TEMPLATE, max_lines=args.max_lines, protocol_version=PROTOCOL_VERSION,
+                                  default_stream=default_stream)
+
+@app.route('/transcript')
+def transcript_endpoint():
+    # the recent completed caption lines of a stream, ?stream=<name>&after=<line number>&limit=<lines>
+    stream = request.args.get('stream', default_stream)
+    after = request.args.get('after', -1, type=int)
+    if 'after' in request.args and after < 0:
+        return jsonify({"error": "after must be a line number"}), 400
+    limit = max(1, min(request.args.get('limit', 100, type=int), 1000))
+    page = caption_streams.transcript(stream, after=after, limit=limit)
+    if page is None:
+        return jsonify({"error": "unknown stream", "streams": caption_streams.keys()}), 404
+    page["streams"] = caption_streams.keys()
+    return jsonify(page)
+
+@app.route('/metrics')
+def metrics_endpoint():
+    # the latency metrics in the Prometheus text format, see metrics.py
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
 
 class Connection:
     '''it wraps conn object'''
-    PACKET_SIZE = 32000*5*60 # 5 minutes
+    PACKET_SIZE = 65536  # the receiver thread drains the socket continuously
 
-    def __init__(self, conn):
+    def __init__(self, conn, first_audio=b""):
         self.conn = conn
+        self.first_audio = first_audio  # received with the stream header, returned first
+        self.audio_packet = bytearray(self.PACKET_SIZE)
         self.conn.setblocking(True)
 
     def non_blocking_receive_audio(self):
+        # returns a view of the received bytes, valid until the next call
+        if self.first_audio:
+            data, self.first_audio = self.first_audio, b""
+            return data
         try:
-            r = self.conn.recv(self.PACKET_SIZE)
-            return r
+            n = self.conn.recv_into(self.audio_packet)
+            return memoryview(self.audio_packet)[:n]
         except ConnectionResetError:
             return None
 
+class CaptionPublisher:
+    '''Lays out the committed text of one audio stream into the overlay lines, see caption_layout.py,
+    and sends the changes of the lines to the Socket.IO overlays of the stream.
+    The sessions of one stream, e.g. a reconnected audio source, continue the same lines.'''
+
+    _layouts = collections.OrderedDict()  # stream -> (CaptionLayout, its lock), the last used one is the last
+    _layouts_lock = threading.Lock()
+
+    def __init__(self, stream):
+        """stream: the name of the stream, the key in the caption emitter"""
+        self.key = stream
+        with self._layouts_lock:
+            if stream not in self._layouts:
+                self._layouts[stream] = (CaptionLayout(max_chars=args.max_chars, min_chars=args.min_chars, max_lines=args.max_lines),
+                                         threading.Lock())
+                # as many as the lines of caption_streams
+                if len(self._layouts) > caption_streams.capacity:
+                    self._layouts.popitem(last=False)
+            self._layouts.move_to_end(stream)
+            self.layout, self.lock = self._layouts[stream]
+
+    def publish(self, o):
+        # o: the result of process_iter
+        if not (o and o[2]):
+            return
+        # Clean the text
+        text = re.sub(r'\[.*?\]', '', o[2])
+        # the updates of the concurrent sessions of the stream are emitted in the order of the layout
+        with self.lock:
+            with metrics.stage("layout"):
+                ops = self.layout.add(text.split())
+            if ops:
+                caption_emitter.update(self.key, ops)
+
 class ServerProcessor:
-    def __init__(self, c, online_asr_proc, min_chunk):
+    def __init__(self, c, online_asr_proc, min_chunk, chunk_controller=None, session_id=None, stream=None):
         self.connection = c
         self.online_asr_proc = online_asr_proc
         self.min_chunk = min_chunk
-        self.last_end = None
-        self.current_line = ""
-        self.previous_text = ""
+        # optional AdaptiveChunkController, it overrides min_chunk
+        self.chunk_controller = chunk_controller
+        self.session_id = session_id  # the label of the metrics
         self.is_first = True
-        self.buffer = ""
-
-    def split_text_by_max_chars(self, text, max_chars):
-        words = text.split()
-        first_part = []
-        remaining_part = []
-        current_length = 0
-
-        for word in words:
-            # Add space to length calculation if not first word
-            if current_length > 0:
-                word_length = len(word) + 1  # +1 for space
-            else:
-                word_length = len(word)
-
-            if current_length + word_length <= max_chars:
-                first_part.append(word)
-                current_length += word_length
-            else:
-                remaining_part.append(word)
-
-        return ' '.join(first_part), ' '.join(remaining_part)
+        self.publisher = CaptionPublisher(stream if stream is not None else str(session_id))
+        self.stream_samples = 0  # the samples received (or dropped) so far
 
     def receive_audio_chunk(self):
-        out = []
         minlimit = self.min_chunk*SAMPLING_RATE
-        while sum(len(x) for x in out) < minlimit:
-            raw_bytes = self.connection.non_blocking_receive_audio()
-            if not raw_bytes:
-                break
-            sf = soundfile.SoundFile(io.BytesIO(raw_bytes), channels=1, endian="LITTLE", 
-                                   samplerate=SAMPLING_RATE, subtype="PCM_16", format="RAW")
-            audio, _ = librosa.load(sf, sr=SAMPLING_RATE, dtype=np.float32)
-            out.append(audio)
-        if not out:
-            return None
-        conc = np.concatenate(out)
-        if self.is_first and len(conc) < minlimit:
+        if self.chunk_controller is not None:
+            minlimit = self.chunk_controller.chunk_size*SAMPLING_RATE
+        a, dropped = self.receiver.get(int(minlimit), partial=not self.is_first)
+        if dropped:
+            self.skip_gap(dropped)
+        if a is None:
             return None
         self.is_first = False
-        return np.concatenate(out)
-
-    def format_output_transcript(self, o):
-        if o[2]:  # if there's text
-            # Just send the text, without timestamps
-            text = o[2].replace('[', '').replace(']', '')  # Remove any remaining brackets
-            # Remove any timestamp patterns at the start of the text
-            text = re.sub(r'^\d+s\s*-\s*\d+s\s*', '', text)
-            return {"text": text.strip()}
-        return None
-
-    def send_result(self, o):
-        result = self.format_output_transcript(o)
-        if result is not None:
-            socketio.emit('transcription', result)
+        self.stream_samples += len(a)
+        return a
+
+    def skip_gap(self, dropped):
+        # the receiver dropped audio over the backlog limit, the transcription continues after the gap
+        self.stream_samples += dropped
+        logger.warning(f"skipped {dropped/SAMPLING_RATE:.2f} seconds of audio, restarting the transcription at {self.stream_samples/SAMPLING_RATE:.2f}")
+        self.online_asr_proc.init(offset=self.stream_samples/SAMPLING_RATE)
 
     def process(self):
         self.online_asr_proc.init()
-        
-        while True:
-            a = self.receive_audio_chunk()
-            if a is None:
-                break
-                
-            self.online_asr_proc.insert_audio_chunk(a)
-            o = self.online_asr_proc.process_iter()
-            
-            try:
-                if o and o[2]:
-                    # Clean the text
-                    text = re.sub(r'\[.*?\]', '', o[2])
-                    text = ' '.join(text.split())
-                    
-                    if text and text != self.previous_text:
-                        # Check if adding new text would exceed max_chars
-                        new_buffer = f"{self.buffer} {text}".strip()
-                        
-                        if len(new_buffer) <= args.max_chars:
-                            # If it fits, add it to current buffer
-                            self.buffer = new_buffer
-                            socketio.emit('transcription', {
-                                "type": "word",
-                                "text": self.buffer
-                            })
-                        else:
-                            # If current buffer is empty, split the new text
-                            if not self.buffer:
-                                first_part, remaining = self.split_text_by_max_chars(text, args.max_chars)
-                                self.buffer = first_part
-                                
-                                # Emit the first part
-                                socketio.emit('transcription', {
-                                    "type": "word",
-                                    "text": self.buffer
-                                })
-                                
-                                if remaining:
-                                    # Move current line to top and start new line with remaining
-                                    socketio.emit('transcription', {
-                                        "type": "line_complete",
-                                        "text": self.buffer
-                                    })
-                                    self.buffer = remaining
-                                    socketio.emit('transcription', {
-                                        "type": "word",
-                                        "text": self.buffer
-                                    })
-                            else:
-                                # Move current buffer to top line
-                                socketio.emit('transcription', {
-                                    "type": "line_complete",
-                                    "text": self.buffer
-                                })
-                                # Start new line with new text
-                                first_part, remaining = self.split_text_by_max_chars(text, args.max_chars)
-                                self.buffer = first_part
-                                socketio.emit('transcription', {
-                                    "type": "word",
-                                    "text": self.buffer
-                                })
-                                
-                                if remaining:
-                                    # Handle remaining text
-                                    socketio.emit('transcription', {
-                                        "type": "line_complete",
-                                        "text": self.buffer
-                                    })
-                                    self.buffer = remaining
-                                    socketio.emit('transcription', {
-                                        "type": "word",
-                                        "text": self.buffer
-                                    })
-
-                        self.previous_text = text
-
-            except Exception as e:
-                logger.error(f"Error sending result: {e}")
-                break
+        # the socket is read in another thread while this one transcribes
+        self.receiver = AudioReceiver(self.connection.non_blocking_receive_audio, args.max_backlog, args.backlog_policy)
+        try:
+            while True:
+                with stage("recv_wait"):
+                    a = self.receive_audio_chunk()
+                if a is None:
+                    break
+
+                self.online_asr_proc.insert_audio_chunk(a)
+                t = time.time()
+                o = self.online_asr_proc.process_iter()
+                elapsed = time.time() - t
+                if self.chunk_controller is not None:
+                    self.chunk_controller.update(elapsed, len(a)/SAMPLING_RATE)
+                observe_iteration(self.session_id, elapsed, len(a)/SAMPLING_RATE, self.receiver.backlog, self.online_asr_proc.buffer_seconds())
+
+                try:
+                    self.publisher.publish(o)
+
+                except Exception as e:
+                    logger.error(f"Error sending result: {e}")
+                    break
+        finally:
+            self.receiver.close()
+
+def serve_client(session, conn):
+    connection = Connection(conn, session.first_audio)
+    # with VAC, the VAC processor adapts its own chunk size
+    chunk_controller = None if args.vac else create_chunk_controller(args, args.min_chunk_size)
+    proc = ServerProcessor(connection, session.online, args.min_chunk_size, chunk_controller, session.id, session.stream)
+    proc.process()
 
 def run_audio_server():
     # Initialize Whisper with timestamps disabled
     args.show_timestamps = False  # Force timestamps off for web interface
-    asr, online = asr_factory(args)
-    min_chunk = args.min_chunk_size
+    asr = create_asr(args) if pool is None else None
 
-    # Warm up Whisper if specified
-    if args.warmup_file and os.path.isfile(args.warmup_file):
+    # Warm up Whisper if specified, the inference workers warm up their models themselves
+    if pool is None and args.warmup_file and os.path.isfile(args.warmup_file):
         a = load_audio_chunk(args.warmup_file, 0, 1)
         asr.transcribe(a)
         logger.info("Whisper is warmed up.")
-
-    # Start audio server
+    preload_tokenizer(args)
+
+    # Start audio server, every client gets its own online processor over the shared model
+    if pool is None and args.max_sessions > 1 and args.batch_window > 0:
+        # the sessions' transcribe calls are batched together
+        asr = BatchedASR(asr, batch_window=args.batch_window, max_batch_size=args.max_batch_size, active_streams=lambda: sessions.active_sessions())
+    transcript_sink = open_transcript_sink(args)
+    sessions = SessionManager(lambda: create_online(args, asr if pool is None else pool.handle(),
+        transcript_sink=transcript_sink.writer() if transcript_sink is not None else None), max_sessions=args.max_sessions)
+    metrics.SESSIONS.set_function(sessions.active_sessions)
+    if args.async_server:
+        # all the clients on one event loop, the captions are published from the online processing threads
+        server = AsyncAudioServer(sessions, args.min_chunk_size, args.max_backlog, args.backlog_policy,
+                create_chunk_controller=lambda: None if args.vac else create_chunk_controller(args, args.min_chunk_size),
+                create_publisher=lambda session: CaptionPublisher(session.stream).publish)
     while True:
         try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                # Add socket reuse option
-                s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-                s.bind((args.host, args.port))
-                s.listen(1)
-                logger.info(f'Listening for audio on {args.host}:{args.port}')
-                
-                while True:
-                    try:
-                        conn, addr = s.accept()
-                        logger.info(f'Connected to client on {addr}')
-                        connection = Connection(conn)
-                        proc = ServerProcessor(connection, online, args.min_chunk_size)
-                        proc.process()
-                    except Exception as e:
-                        logger.error(f'Error processing connection: {e}')
-                    finally:
-                        conn.close()
-                        logger.info('Connection to client closed')
+            if args.async_server:
+                server.serve(args.host, args.port)
+            else:
+                sessions.serve(args.host, args.port, serve_client)
         except Exception as e:
             logger.error(f'Server error: {e}')
-            import time
             time.sleep(1)  # Wait before attempting to restart
 
+def run_asr_process(send):
+    # runs in the ASR process, the caption updates go to the web process
+    global caption_sink, pool
+    caption_sink = send
+    if args.inference_workers > 0:
+        args.show_timestamps = False
+        pool = InferencePool(args, args.inference_workers, args.worker_cpu_threads)
+    if args.metrics_port:
+        metrics.serve_metrics(args.host, args.metrics_port)
+    run_audio_server()
+
+def forward_captions(asr_process):
+    # runs in the web process, it sends the caption updates of the ASR process to the overlays
+    while asr_process.is_alive():
+        for key, ops in asr_process.receive():
+            fan_out_captions(key, ops)
+        socketio.sleep(0.01)
+    logger.error('The ASR process ended, no more captions.')
+
 if __name__ == '__main__':
-    # Start the audio server in a separate thread
-    audio_thread = threading.Thread(target=run_audio_server)
-    audio_thread.daemon = True
-    audio_thread.start()
+    pool = None
+    if args.asr_process:
+        # forked before any other thread starts, the inference workers are forked from it
+        asr_process = ASRProcess(run_asr_process)
+        socketio.start_background_task(forward_captions, asr_process)
+    else:
+        # the inference workers are forked before any other thread starts
+        if args.inference_workers > 0:
+            args.show_timestamps = False
+            pool = InferencePool(args, args.inference_workers, args.worker_cpu_threads)
+
+        # Start the audio server in a separate thread
+        audio_thread = threading.Thread(target=run_audio_server)
+        audio_thread.daemon = True
+        audio_thread.start()
 
     # Start the web server with improved settings
-    logger.info(f'Starting web server on port {args.web_port}')
+    logger.info(f'Starting web server on port {args.web_port} ({socketio.async_mode})')
     socketio.run(app, 
                 host=args.host, 
                 port=args.web_port, 
-                debug=True,
+                debug=not args.asr_process,
                 allow_unsafe_werkzeug=True,  # Required for debug mode
                 use_reloader=False)  # Disable reloader to prevent duplicate threads
\ No newline at end of file